@@ -0,0 +1,227 @@
+"""
+This module contains async versions of the interactive database endpoints for BankClients application
+The router is included in the app instead of the sync endpoints when DB_ASYNC mode is on:
+database calls go through the asyncpg engine, the scoring and the metrics computations run in the threadpool,
+so they never block the event loop
+"""
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from starlette.concurrency import run_in_threadpool
+
+from .imports import AsyncSession, AsyncIterator, time, pd, select
+from .db import AsyncSessionLocal, async_pool_metrics
+from .models import TableClient, TableY, SingleClientTable, TableSelectedModel
+from .schemas import Client, Y, ModelNames, ClientShort, SelectedModel
+from .metrics import ThresholdMetrics, get_cached_metrics, build_threshold_metrics
+from .export import get_table_version
+from .services import get_user_selection, get_single_frame, get_client_prediction, get_threshold_scores, \
+    get_threshold_matrices
+from .user_state import get_client_token, get_user_state, update_user_state
+from .registry import model_registry, version_pattern
+from .observability import stage_timer
+
+router = APIRouter()
+
+
+async def get_async_session() -> AsyncIterator[AsyncSession]:
+    """Manages async connection sessions for working with the database, the connection checkout is timed"""
+    async with AsyncSessionLocal() as db:
+        started = time.perf_counter()
+        await db.connection()
+        async_pool_metrics.record_wait(time.perf_counter() - started)
+        yield db
+
+
+async def get_threshold_metrics_async(db: AsyncSession, model_type: str) -> ThresholdMetrics:
+    """
+    Returns the metrics engine of the model. The y table is read with the async driver when its version changes,
+    the frame is built and sorted in the threadpool
+    """
+    table = TableY.__table__
+    version = await db.run_sync(get_table_version, table)
+    metrics_engine = get_cached_metrics(model_type, version)
+    if metrics_engine is None:
+        result = await db.execute(select(table))
+        rows, columns = result.all(), [str(column) for column in result.keys()]
+        metrics_engine = await run_in_threadpool(
+            lambda: build_threshold_metrics(model_type, version, pd.DataFrame(rows, columns=columns)))
+    return metrics_engine
+
+
+@router.get("/get/clients", response_model=list[Client])
+async def get_clients_async(db: AsyncSession = Depends(get_async_session)):
+    """Get all clients in the database"""
+    return (await db.execute(select(TableClient))).scalars().all()
+
+
+@router.get("/get/targets", response_model=list[Y])
+async def get_target_async(db: AsyncSession = Depends(get_async_session)):
+    """Get all predictions in the database"""
+    return (await db.execute(select(TableY))).scalars().all()
+
+
+@router.get("/get/single_df", response_model=list[ClientShort])
+async def get_single_df_async(token: str | None = Depends(get_client_token),
+                              db: AsyncSession = Depends(get_async_session)):
+    """Get single client record of the user's session or in the database"""
+    if token is not None:
+        single_client = (await db.run_sync(get_user_state, token))['single_client']
+        return [single_client] if single_client else []
+    return (await db.execute(select(SingleClientTable))).scalars().all()
+
+
+@router.get("/get/selected", response_model=SelectedModel)
+async def get_selected_options_async(token: str | None = Depends(get_client_token),
+                                     db: AsyncSession = Depends(get_async_session)):
+    """Get user selected options"""
+    if token is not None:
+        return await db.run_sync(get_user_state, token)
+    return (await db.execute(select(TableSelectedModel))).scalars().first()
+
+
+@router.patch("/update/selected/model_name", response_model=SelectedModel)
+async def update_selected_by_model_type_async(model_name: ModelNames, token: str | None = Depends(get_client_token),
+                                              db: AsyncSession = Depends(get_async_session)):
+    """Updates information about the User's selected model"""
+    if token is not None:
+        return await db.run_sync(update_user_state, token, type_model=model_name.value)
+    updated_selected = (await db.execute(select(TableSelectedModel))).scalars().first()
+    if updated_selected and updated_selected.type_model != model_name:
+        updated_selected.type_model = model_name
+        db.add(updated_selected)
+        await db.commit()
+        await db.refresh(updated_selected)
+
+    return updated_selected
+
+
+@router.patch("/update/selected/threshold", response_model=SelectedModel)
+async def update_selected_by_threshold_async(threshold: float, token: str | None = Depends(get_client_token),
+                                             db: AsyncSession = Depends(get_async_session)):
+    """Updates information about the User's selected threshold"""
+    if token is not None:
+        return await db.run_sync(update_user_state, token, threshold=threshold)
+    updated_selected = (await db.execute(select(TableSelectedModel))).scalars().first()
+    if updated_selected and updated_selected.threshold != threshold:
+        updated_selected.threshold = threshold
+        db.add(updated_selected)
+        await db.commit()
+        await db.refresh(updated_selected)
+
+    return updated_selected
+
+
+@router.get("/get/user_params", response_model=dict)
+async def get_user_params_async(token: str | None = Depends(get_client_token),
+                                db: AsyncSession = Depends(get_async_session)):
+    """Get user selectioned params"""
+    model_type, threshold, best_thr = await db.run_sync(get_user_selection, token)
+
+    user_params_dict = {
+        'model_type': model_type,
+        'threshold': threshold,
+        'best_thr': best_thr
+    }
+
+    return user_params_dict
+
+
+@router.get("/get/predictions", response_model=dict)
+async def get_predict_async(token: str | None = Depends(get_client_token),
+                            db: AsyncSession = Depends(get_async_session)):
+    """Get single client record in the database"""
+    with stage_timer('fetch'):
+        single_df = await db.run_sync(get_single_frame, token)
+        if single_df.empty:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Single client record is not found')
+        model_type, threshold, best_thr = await db.run_sync(get_user_selection, token)
+
+    single_client = single_df.reset_index().to_dict(orient='records')[0]
+    return await run_in_threadpool(get_client_prediction, single_client, model_type, threshold, best_thr)
+
+
+@router.post("/predict", response_model=dict)
+async def predict_client_async(client: ClientShort, model_name: ModelNames | None = None,
+                               threshold: float | None = None,
+                               version: str | None = Query(None, pattern=version_pattern),
+                               token: str | None = Depends(get_client_token),
+                               db: AsyncSession = Depends(get_async_session)):
+    """Get prediction for the client passed in the request body without the temporary database"""
+    if model_name is None:
+        model_type, user_threshold, best_thr = await db.run_sync(get_user_selection, token)
+    else:
+        model_type, best_thr = model_name, model_registry.get_best_thr(model_name)
+        user_threshold = best_thr
+    if version is not None:
+        try:
+            best_thr = model_registry.get(model_type, version).best_thr
+        except KeyError as e:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.args[0])
+    threshold = user_threshold if threshold is None else threshold
+
+    return await run_in_threadpool(get_client_prediction, client.model_dump(), model_type, threshold, best_thr,
+                                   version)
+
+
+@router.get("/get/metrics_score", response_model=dict)
+async def get_metrics_async(ci: bool = False, n_resamples: int = Query(1000, gt=0, le=100_000),
+                            confidence: float = Query(0.95, gt=0, lt=1), seed: int | None = None,
+                            token: str | None = Depends(get_client_token),
+                            db: AsyncSession = Depends(get_async_session)):
+    """
+    Get metrics score for current user selection or db state.
+    ci=true adds the bootstrap confidence intervals of the metrics over n_resamples resamples of the y table
+    """
+    model_type, threshold, best_thr = await db.run_sync(get_user_selection, token)
+    metrics_engine = await get_threshold_metrics_async(db, model_type)
+    return await run_in_threadpool(get_threshold_scores, metrics_engine, threshold, best_thr, ci, n_resamples,
+                                   confidence, seed)
+
+
+@router.get("/get/confusion_matrix", response_model=dict)
+async def get_confusion_matrix_async(token: str | None = Depends(get_client_token),
+                                     db: AsyncSession = Depends(get_async_session)):
+    """Get confusion matrices for current user selection and the optimal threshold"""
+    model_type, threshold, best_thr = await db.run_sync(get_user_selection, token)
+    metrics_engine = await get_threshold_metrics_async(db, model_type)
+    return get_threshold_matrices(metrics_engine, threshold, best_thr)
+
+
+@router.get("/metrics/threshold", response_model=dict)
+async def get_threshold_metrics_score_async(model_name: ModelNames, threshold: float,
+                                            db: AsyncSession = Depends(get_async_session)):
+    """Get metrics score and confusion matrix of the model for any threshold"""
+    metrics_engine = await get_threshold_metrics_async(db, model_name.value)
+    threshold_dict = {
+        'metrics': metrics_engine.metrics(threshold),
+        'confusion_matrix': metrics_engine.confusion_matrix(threshold)
+    }
+    return threshold_dict
+
+
+@router.post("/write/single_df", response_model=ClientShort)
+async def write_single_df_to_db_async(single_df_dict: ClientShort, token: str | None = Depends(get_client_token),
+                                      db: AsyncSession = Depends(get_async_session)):
+    """Takes a single frame as a dictionary and writes it to the user's session or the temporary database"""
+    if token is not None:
+        state = await db.run_sync(update_user_state, token, single_client=single_df_dict.model_dump())
+        return state['single_client']
+    data_dict = SingleClientTable(**single_df_dict.model_dump())
+    db.add(data_dict)
+    await db.commit()
+    await db.refresh(data_dict)
+    return data_dict
+
+
+@router.delete("/delete/single_df", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_single_df_async(token: str | None = Depends(get_client_token),
+                                 db: AsyncSession = Depends(get_async_session)):
+    """Deletes a single frame from the user's session or temporary database after usage"""
+    if token is not None:
+        await db.run_sync(update_user_state, token, single_client=None)
+        return None
+    single_df = (await db.execute(select(SingleClientTable))).scalars().first()
+    if single_df:
+        await db.delete(single_df)
+        await db.commit()
+    return None
@@ -0,0 +1,259 @@
+"""
+This module contains the benchmark suite of the API: python -m backend.cli bench
+The app is started with uvicorn over a local SQLite stand-in of the database seeded from clinic_test.sql
+(or an already running server is requested), every scenario is requested by a number of concurrent clients
+and the throughput with the p50/p95/p99 latencies are written to a JSON file, so the results of commits can be compared
+"""
+
+from .imports import os, sys, time, json, socket, subprocess, requests, np, pd, StringIO, ThreadPoolExecutor
+from .imports import create_engine, make_url, path, client_features
+
+# root directory of the repository, the app is started from it
+repo_path = os.path.dirname(path)
+
+# database dump the stand-in database is seeded from
+dump_path = os.path.join(repo_path, 'clinic_test.sql')
+
+# scenarios of the benchmark: method, path and the kind of the request body
+benchmark_scenarios = {
+    'get_clients': ('GET', '/get/clients', None),
+    'get_targets': ('GET', '/get/targets', None),
+    'get_predictions': ('GET', '/get/predictions', None),
+    'get_metrics_score': ('GET', '/get/metrics_score', None),
+    'predict': ('POST', '/predict?model_name=tuned', 'client'),
+    'predict_batch': ('POST', '/predict/batch?model_name=tuned', 'batch'),
+    'predict_batch_ndjson': ('POST', '/predict/batch/ndjson?model_name=tuned', 'ndjson'),
+}
+
+# content types of the request bodies
+body_content_types = {'client': 'application/json', 'batch': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+# latency percentiles of the results
+latency_percentiles = (50, 95, 99)
+
+# settings of the backend recorded with the results, as they change the measured numbers
+recorded_settings = ('FAST_INFERENCE', 'DB_ASYNC', 'LAZY_MODELS', 'METRICS_ENABLED', 'PREDICTION_CACHE_SIZE',
+                     'DB_POOL_SIZE')
+
+
+def read_dump(dump_file: str = dump_path) -> dict[str, pd.DataFrame]:
+    """Reads the COPY blocks of the PostgreSQL dump into dataframes keyed by the qualified table names"""
+    with open(dump_file, encoding='utf-8') as file:
+        lines = iter(file.read().splitlines())
+    tables = {}
+    for line in lines:
+        if not line.startswith('COPY '):
+            continue
+        table_name, column_list = line[len('COPY '):].split(' ', 1)
+        column_list = column_list[column_list.index('(') + 1:column_list.index(')')]
+        columns = [column.strip().strip('"') for column in column_list.split(',')]
+        rows = []
+        for row in lines:
+            if row == '\\.':
+                break
+            rows.append(row)
+        tables[table_name] = pd.read_csv(StringIO('\n'.join(rows)), sep='\t', header=None, names=columns,
+                                         na_values='\\N', keep_default_na=False) if rows \
+            else pd.DataFrame(columns=columns)
+    return tables
+
+
+def seed_database(database_file: str, dump_tables: dict[str, pd.DataFrame]) -> dict[str, int]:
+    """
+    Creates a new SQLite database with the tables of the app and loads the rows of the dump into it.
+    The dump has no single client, so the first client is written as the single client of /get/predictions
+
+    :return: number of the loaded rows by the tables
+    """
+    from .db import attach_public_schema
+    from .models import Base, init_schema
+    from .ingest import write_chunk
+
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    url = make_url(f'sqlite:///{database_file}')
+    seed_engine = create_engine(url)
+    attach_public_schema(seed_engine, url)
+    init_schema(bind=seed_engine)
+    dump_tables = dict(dump_tables)
+    if dump_tables['public.single_client'].empty:
+        dump_tables['public.single_client'] = dump_tables['public.client'].head(1)[['ID'] + client_features]
+    with seed_engine.begin() as connection:
+        for table_name, table_df in dump_tables.items():
+            write_chunk(connection, Base.metadata.tables[table_name], table_df, False)
+    seed_engine.dispose()
+    return {table_name: len(table_df) for table_name, table_df in dump_tables.items()}
+
+
+def get_free_port() -> int:
+    """Returns a free local TCP port for the benchmarked server"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database_file: str, workers: int, timeout: float = 120.0) -> tuple[subprocess.Popen, str]:
+    """
+    Starts uvicorn with the app over the SQLite database and waits until it answers
+
+    :return: server process and its base url
+    """
+    port = get_free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'backend.main:app', '--host', '127.0.0.1',
+                               '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+                              cwd=repo_path, env={**os.environ, 'DATABASE_URL': f'sqlite:///{database_file}'})
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode}')
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return server, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    stop_server(server)
+    raise RuntimeError(f'Server did not start in {timeout} seconds')
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    """Stops the server process and its workers"""
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def get_request_bodies(clients_df: pd.DataFrame, batch_size: int) -> dict[str, bytes]:
+    """Serializes the request bodies once, so the client side serialization is not measured"""
+    clients = clients_df[['ID'] + client_features].head(batch_size).to_dict(orient='records')
+    return {
+        'client': json.dumps(clients[0]).encode(),
+        'batch': json.dumps(clients).encode(),
+        'ndjson': ''.join(json.dumps(client) + '\n' for client in clients).encode(),
+    }
+
+
+def run_scenario(base_url: str, method: str, url_path: str, body: bytes | None, content_type: str | None,
+                 concurrency: int, n_requests: int, timeout: float = 60.0) -> dict:
+    """
+    Sends the requests of the scenario from concurrent clients, each client sends its requests one after another
+
+    :return: throughput, error count and latency statistics in milliseconds
+    """
+    headers = {'Content-Type': content_type} if content_type else {}
+
+    def run_client(count: int) -> tuple[list[float], int]:
+        """Sends the requests of a single client over its own connection"""
+        latencies, errors = [], 0
+        with requests.Session() as session:
+            for _ in range(count):
+                started = time.perf_counter()
+                try:
+                    ok = session.request(method, base_url + url_path, data=body, headers=headers, timeout=timeout).ok
+                except requests.RequestException:
+                    ok = False
+                latencies.append(time.perf_counter() - started)
+                errors += not ok
+        return latencies, errors
+
+    counts = [n_requests // concurrency + (client < n_requests % concurrency) for client in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_client, counts))
+    elapsed = time.perf_counter() - started
+
+    latencies = 1000 * np.concatenate([np.asarray(client_latencies) for client_latencies, _ in results])
+    return {
+        'concurrency': concurrency,
+        'requests': n_requests,
+        'errors': sum(errors for _, errors in results),
+        'seconds': round(elapsed, 3),
+        'rps': round(n_requests / elapsed, 1),
+        'mean_ms': round(float(latencies.mean()), 2),
+        **{f'p{percentile}_ms': round(float(np.percentile(latencies, percentile)), 2)
+           for percentile in latency_percentiles},
+        'max_ms': round(float(latencies.max()), 2),
+    }
+
+
+def compare_results(results: dict, baseline: dict) -> dict:
+    """Returns the relative changes of the throughput and of the p95 latency against the baseline results"""
+    comparison = {}
+    for scenario, levels in results.items():
+        for concurrency, stats in levels.items():
+            base_stats = baseline.get('results', {}).get(scenario, {}).get(concurrency)
+            if base_stats:
+                comparison.setdefault(scenario, {})[concurrency] = {
+                    'rps_change': round(stats['rps'] / base_stats['rps'] - 1, 3),
+                    'p95_change': round(stats['p95_ms'] / base_stats['p95_ms'] - 1, 3),
+                }
+    return comparison
+
+
+def get_commit() -> str | None:
+    """Returns the commit of the working tree or None outside of a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(scenarios: list[str], concurrency_levels: list[int], n_requests: int, warmup: int = 10,
+                  batch_size: int = 100, workers: int = 1, base_url: str | None = None,
+                  database_file: str | None = None, baseline: dict | None = None) -> dict:
+    """
+    Runs the scenarios at every concurrency level against a server over the seeded stand-in database
+    or against an already running server
+
+    :param scenarios: names of the scenarios from benchmark_scenarios
+    :param concurrency_levels: numbers of the concurrent clients
+    :param n_requests: number of the measured requests of a scenario at every level
+    :param warmup: number of the requests sent before the measured ones of every scenario
+    :param batch_size: number of the clients in the batch requests
+    :param workers: number of the uvicorn workers of the started server
+    :param base_url: url of a running server, the local server is started when it is not passed
+    :param database_file: SQLite file of the stand-in database, recreated before the run
+    :param baseline: results of a previous run to compare with
+    :return: results with the settings of the run
+    """
+    dump_tables = read_dump()
+    bodies = get_request_bodies(dump_tables['public.client'], batch_size)
+    server = None
+    if base_url is None:
+        database_file = database_file or os.path.join(repo_path, 'benchmark_results', 'benchmark.db')
+        os.makedirs(os.path.dirname(os.path.abspath(database_file)), exist_ok=True)
+        seed_database(database_file, dump_tables)
+        server, base_url = start_server(database_file, workers)
+
+    results = {}
+    try:
+        for scenario in scenarios:
+            method, url_path, body_kind = benchmark_scenarios[scenario]
+            request_args = (base_url, method, url_path, bodies.get(body_kind), body_content_types.get(body_kind))
+            if warmup:
+                run_scenario(*request_args, 1, warmup)
+            for concurrency in concurrency_levels:
+                stats = run_scenario(*request_args, concurrency, n_requests)
+                results.setdefault(scenario, {})[str(concurrency)] = stats
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    report = {
+        'commit': get_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'server': 'sqlite stand-in' if server is not None else base_url,
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'settings': {'workers': workers if server is not None else None, 'requests': n_requests, 'warmup': warmup,
+                     'batch_size': batch_size, **{name: os.getenv(name) for name in recorded_settings}},
+        'results': results,
+    }
+    if baseline is not None:
+        report['baseline_commit'] = baseline.get('commit')
+        report['comparison'] = compare_results(results, baseline)
+    return report
@@ -0,0 +1,145 @@
+"""
+This module contains the command line interface of the backend: python -m backend.cli <command>
+init-db creates the database schema once before the workers start with DB_INIT_SCHEMA=off,
+compile-models writes the memory-mapped compiled models, so the workers do not compile them on their first request,
+score scores a CSV or Parquet file of clients offline, ingest loads a file into the client or y table,
+rescore refreshes the stored predictions of the y table, bench runs the benchmark suite of the API
+"""
+
+from .imports import os, argparse, json, models_schema, batch_chunk_size, ingest_chunk_size, rescore_chunk_size
+from .benchmark import benchmark_scenarios
+
+
+def init_db(args: argparse.Namespace) -> None:
+    """Creates the missing tables and indexes of the application"""
+    from .db import engine
+    from .models import init_schema
+    init_schema(bind=engine)
+    print('Database schema is created')
+
+
+def compile_models(args: argparse.Namespace) -> None:
+    """Compiles the active versions of the models into the memory-mapped arrays of the fast inference"""
+    from .registry import model_registry
+    for model_type in models_schema:
+        bundle = model_registry.get(model_type)
+        compiled_model = bundle.load_compiled()
+        print(f'{model_type} {bundle.version}: {compiled_model.n_features} features compiled')
+
+
+def score(args: argparse.Namespace) -> None:
+    """Scores the client file and prints the summary"""
+    from .file_scoring import score_file
+    try:
+        summary = score_file(args.input, args.output, args.model, args.version, args.threshold, args.chunk_size,
+                             args.workers)
+    except (ValueError, KeyError) as e:
+        raise SystemExit(f'error: {e}')
+    print(json.dumps(summary))
+
+
+def ingest(args: argparse.Namespace) -> None:
+    """Loads the file into the table and prints the summary"""
+    from .imports import IntegrityError
+    from .ingest import ingest_tables, ingest_file_formats, ingest_file
+    file_format = args.format or ingest_file_formats.get(os.path.splitext(args.file)[1].lower())
+    if file_format is None:
+        raise SystemExit(f'error: unknown format of {args.file}, pass --format')
+    try:
+        summary = ingest_file(args.file, file_format, ingest_tables[args.table], not args.insert, args.chunk_size)
+    except (ValueError, IntegrityError) as e:
+        raise SystemExit(f'error: {e}')
+    print(json.dumps(summary))
+
+
+def rescore(args: argparse.Namespace) -> None:
+    """Re-scores the stale rows of the client table and prints the summary"""
+    from .rescoring import rescore_predictions
+    versions = {model_type: version for model_type, version in (('regular', args.regular), ('tuned', args.tuned))
+                if version}
+    try:
+        summary = rescore_predictions(versions, args.full, args.chunk_size)
+    except KeyError as e:
+        raise SystemExit(f'error: {e.args[0]}')
+    print(json.dumps(summary))
+
+
+def bench(args: argparse.Namespace) -> None:
+    """Runs the benchmarks, prints the summary and writes the results to the JSON file"""
+    from .benchmark import run_benchmark, repo_path
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+    try:
+        report = run_benchmark(args.scenarios, args.concurrency, args.requests, args.warmup, args.batch_size,
+                               args.workers, args.url, args.database, baseline)
+    except RuntimeError as e:
+        raise SystemExit(f'error: {e}')
+
+    run_name = f'{report["created"][:19].replace(":", "")}_{report["commit"] or "local"}'
+    output = args.output or os.path.join(repo_path, 'benchmark_results', f'{run_name}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    for scenario, levels in report['results'].items():
+        for concurrency, stats in levels.items():
+            change = report.get('comparison', {}).get(scenario, {}).get(concurrency)
+            print(f'{scenario:<22} c={concurrency:<3} {stats["rps"]:>8} rps  p50 {stats["p50_ms"]:>8} ms  '
+                  f'p95 {stats["p95_ms"]:>8} ms  p99 {stats["p99_ms"]:>8} ms  errors {stats["errors"]}'
+                  + (f'  rps {change["rps_change"]:+.1%} p95 {change["p95_change"]:+.1%}' if change else ''))
+    print(f'Results are written to {output}')
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Parses the command line and runs the command"""
+    parser = argparse.ArgumentParser(prog='python -m backend.cli', description='BankClients backend commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('init-db', help='create the database schema').set_defaults(run=init_db)
+    commands.add_parser('compile-models', help='cache the compiled models of the fast inference').set_defaults(
+        run=compile_models)
+    score_parser = commands.add_parser('score', help='score a CSV or Parquet file of clients')
+    score_parser.add_argument('input', help='CSV or Parquet file with the ID and the client columns')
+    score_parser.add_argument('output', help='CSV or Parquet file of the predictions')
+    score_parser.add_argument('--model', choices=list(models_schema), default='tuned', help='model type')
+    score_parser.add_argument('--version', help='version of the model, the active one by default')
+    score_parser.add_argument('--threshold', type=float, help='threshold of the flag, the optimal one by default')
+    score_parser.add_argument('--chunk-size', type=int, default=10 * batch_chunk_size, help='rows scored at a time')
+    score_parser.add_argument('--workers', type=int, default=1, help='worker processes, 1 scores in this process')
+    score_parser.set_defaults(run=score)
+    ingest_parser = commands.add_parser('ingest', help='load a CSV, Parquet or NDJSON file into a table')
+    ingest_parser.add_argument('table', choices=['client', 'y'], help='table the rows are loaded into')
+    ingest_parser.add_argument('file', help='CSV, Parquet or NDJSON file with all columns of the table')
+    ingest_parser.add_argument('--format', choices=['csv', 'parquet', 'ndjson'], help='format, by the extension '
+                               'by default')
+    ingest_parser.add_argument('--insert', action='store_true', help='fail on existing IDs instead of updating them')
+    ingest_parser.add_argument('--chunk-size', type=int, default=ingest_chunk_size, help='rows written at a time')
+    ingest_parser.set_defaults(run=ingest)
+    rescore_parser = commands.add_parser('rescore', help='refresh the stored predictions of the y table')
+    rescore_parser.add_argument('--full', action='store_true', help='score all clients, not only the stale ones')
+    rescore_parser.add_argument('--regular', help='version of the regular model, the active one by default')
+    rescore_parser.add_argument('--tuned', help='version of the tuned model, the active one by default')
+    rescore_parser.add_argument('--chunk-size', type=int, default=rescore_chunk_size, help='rows scored at a time')
+    rescore_parser.set_defaults(run=rescore)
+    bench_parser = commands.add_parser('bench', help='measure the throughput and latency of the API')
+    bench_parser.add_argument('--scenarios', nargs='+', choices=list(benchmark_scenarios),
+                              default=list(benchmark_scenarios), help='requested endpoints, all by default')
+    bench_parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8], help='numbers of concurrent '
+                              'clients')
+    bench_parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario and level')
+    bench_parser.add_argument('--warmup', type=int, default=10, help='requests sent before the measured ones')
+    bench_parser.add_argument('--batch-size', type=int, default=100, help='clients in the batch requests')
+    bench_parser.add_argument('--workers', type=int, default=1, help='uvicorn workers of the started server')
+    bench_parser.add_argument('--url', help='url of a running server instead of the local SQLite stand-in')
+    bench_parser.add_argument('--database', help='SQLite file of the stand-in, benchmark_results/benchmark.db '
+                              'by default')
+    bench_parser.add_argument('--output', help='JSON file of the results, benchmark_results/<time>_<commit>.json '
+                              'by default')
+    bench_parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    bench_parser.set_defaults(run=bench)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
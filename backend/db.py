@@ -1,42 +1,143 @@
 """
 This is database connection module
-For some reason credentials for connection are stored in public
+Credentials and settings of the connection pools are read from the environment (or the .env file),
+for some reason default credentials of the demo database are stored in public
 """
 
-from .imports import sessionmaker, declarative_base, URL, create_engine
+from .imports import os, threading, sessionmaker, declarative_base, URL, create_engine, event, make_url, NullPool
+from .imports import AsyncSession, async_sessionmaker, create_async_engine, db_async
+from .imports import db_pool_size, db_max_overflow, db_pool_timeout, db_pool_recycle, db_pool_pre_ping, \
+    db_statement_timeout, db_statement_cache_size, db_pgbouncer
+from .observability import watch_queries
 
-# import os
-# from .imports import load_dotenv, AsyncSession, create_async_engine, DeclarativeBase
-# load_dotenv()
-
-connection_string = URL.create(
-    drivername='postgresql',
-    username="lethalmaks",
-    password="xrpAqm06UadH",
-    host="ep-sparkling-fog-87757951.eu-central-1.aws.neon.tech",
-    database="client"
+connection_string = make_url(os.environ['DATABASE_URL']) if os.getenv('DATABASE_URL') else URL.create(
+    drivername=os.getenv('DB_DRIVERNAME', 'postgresql'),
+    username=os.getenv('DB_USERNAME', 'lethalmaks'),
+    password=os.getenv('DB_PASSWORD', 'xrpAqm06UadH'),
+    host=os.getenv('DB_HOST', 'ep-sparkling-fog-87757951.eu-central-1.aws.neon.tech'),
+    database=os.getenv('DB_DATABASE', 'client')
 )
 
-engine = create_engine(connection_string)
 
-PGHOST = 'ep-sparkling-fog-87757951.eu-central-1.aws.neon.tech'
-PGDATABASE = 'client'
-PGUSER = 'lethalmaks'
-PGPASSWORD = 'xrpAqm06UadH'
+class PoolMetrics:
+    """Counters of the connection pool events and of the time requests wait for a connection"""
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
 
-Base = declarative_base()
+    def watch(self, pool_engine) -> None:
+        """Subscribes the counters to the pool events of the engine"""
+        @event.listens_for(pool_engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            with self.lock:
+                self.connects += 1
+
+        @event.listens_for(pool_engine, 'checkout')
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            with self.lock:
+                self.checkouts += 1
+
+        @event.listens_for(pool_engine, 'invalidate')
+        def on_invalidate(dbapi_connection, connection_record, exception):
+            with self.lock:
+                self.invalidations += 1
+
+    def record_wait(self, seconds: float) -> None:
+        """Records the time a request waited for its connection, including the setup of a new connection"""
+        with self.lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def report(self, pool_engine) -> dict:
+        """Returns the current state of the pool together with the collected counters"""
+        pool = pool_engine.pool
+        with self.lock:
+            return {
+                'pool': type(pool).__name__,
+                'size': pool.size() if hasattr(pool, 'size') else None,
+                'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+                'checked_in': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+                'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'invalidations': self.invalidations,
+                'wait_count': self.waits,
+                'wait_avg_ms': round(1000 * self.wait_total / self.waits, 3) if self.waits else 0.0,
+                'wait_max_ms': round(1000 * self.wait_max, 3),
+            }
+
+
+def get_engine_options(url: URL) -> dict:
+    """
+    Builds the pool and connection options of the engine for the url.
+    In PgBouncer mode the pooling is left to PgBouncer and server-side prepared statements are disabled,
+    because a transaction pooler does not keep them between transactions
+    """
+    options = {'pool_pre_ping': db_pool_pre_ping, 'query_cache_size': db_statement_cache_size}
+    if db_pgbouncer or url.get_driver_name() == 'aiosqlite':
+        # aiosqlite is pooled with NullPool by SQLAlchemy, which takes no pool size options
+        options['poolclass'] = NullPool
+    else:
+        options.update(pool_size=db_pool_size, max_overflow=db_max_overflow, pool_timeout=db_pool_timeout,
+                       pool_recycle=db_pool_recycle)
 
-# drivername = os.getenv("DRIVERNAME")
-# username = os.getenv("USERNAME")
-# password = os.getenv("PASSWORD")
-# host = os.getenv("HOST")
-# database = os.getenv("DATABASE")
+    if url.get_backend_name() != 'postgresql':
+        return options
+    connect_args = {}
+    if url.get_driver_name() == 'asyncpg':
+        connect_args['prepared_statement_cache_size'] = 0 if db_pgbouncer else db_statement_cache_size
+        if db_pgbouncer:
+            connect_args['statement_cache_size'] = 0
+        if db_statement_timeout and not db_pgbouncer:
+            connect_args['server_settings'] = {'statement_timeout': str(db_statement_timeout)}
+    elif db_statement_timeout and not db_pgbouncer:
+        # PgBouncer rejects the options startup parameter, so the timeout is set on its side in that mode
+        connect_args['options'] = f'-c statement_timeout={db_statement_timeout}'
+    options['connect_args'] = connect_args
+    return options
 
-# DATABASE_URL = f'postgresql+asyncpg://{PGUSER}:{PGPASSWORD}@{PGHOST}/{PGDATABASE}'
-# engine = create_async_engine(DATABASE_URL)
-# SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
-# class Base(DeclarativeBase):
-#     pass
+def attach_public_schema(sqlite_engine, url: URL) -> None:
+    """
+    SQLite has no schemas, so the database file is attached once more under the public schema name of the tables.
+    This lets the app run on a local SQLite stand-in of the database, e.g. for the benchmarks
+    """
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return
+
+    @event.listens_for(sqlite_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('ATTACH DATABASE ? AS public', (url.database,))
+        cursor.close()
+
+
+engine = create_engine(connection_string, **get_engine_options(connection_string))
+attach_public_schema(engine, connection_string)
+pool_metrics = PoolMetrics()
+pool_metrics.watch(engine)
+watch_queries(engine)
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+Base = declarative_base()
+
+# async engine is created only in async mode, so asyncpg is not required otherwise
+if db_async:
+    async_drivers = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+    async_connection_string = connection_string.set(drivername=async_drivers[connection_string.get_backend_name()]) \
+        if connection_string.get_backend_name() in async_drivers else connection_string
+    async_engine = create_async_engine(async_connection_string, **get_engine_options(async_connection_string))
+    attach_public_schema(async_engine.sync_engine, async_connection_string)
+    async_pool_metrics = PoolMetrics()
+    async_pool_metrics.watch(async_engine.sync_engine)
+    watch_queries(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False,
+                                           expire_on_commit=False)
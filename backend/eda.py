@@ -0,0 +1,80 @@
+"""
+This module contains server-side aggregates for Exploratory Data Analysis of the clients table
+Aggregates are computed in a vectorized pass over the cached clients frame and cached by the table version,
+so that the frontend receives small summary payloads instead of all client rows
+"""
+
+from .imports import pd, np, Session, numeric_columns
+from .models import TableClient
+from .export import get_table_version, read_table_frame
+
+# (table version, clients dataframe) of the last read of the clients table
+clients_frame_cache: dict[str, tuple[str, pd.DataFrame]] = {}
+
+# aggregate key -> (table version, aggregate payload)
+eda_cache: dict[str, tuple[str, dict]] = {}
+
+
+def get_clients_frame(db: Session) -> tuple[str, pd.DataFrame]:
+    """Returns the version of the clients table and the dataframe of it, the table is read once per version"""
+    table = TableClient.__table__
+    version = get_table_version(db, table)
+    cached = clients_frame_cache.get(table.name)
+    if cached and cached[0] == version:
+        return cached
+    clients_frame_cache[table.name] = (version, read_table_frame(db, table))
+    return clients_frame_cache[table.name]
+
+
+def to_python(value):
+    """Converts numpy scalars and missing values to json serializable python values"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def frame_to_dict(aggregate_df: pd.DataFrame) -> dict:
+    """Converts an aggregate dataframe to a {column: {row: value}} dictionary keeping the order of rows"""
+    return {str(column): {str(row): to_python(value) for row, value in values.items()}
+            for column, values in aggregate_df.to_dict().items()}
+
+
+def compute_aggregate(clients_df: pd.DataFrame, name: str, column: str | None = None) -> dict:
+    """Computes a single EDA aggregate of the clients dataframe"""
+    match name:
+        case 'value_counts':
+            counts = clients_df[column].value_counts()
+            return {'column': column, 'values': [to_python(value) for value in counts.index],
+                    'counts': [int(count) for count in counts.to_numpy()]}
+        case 'describe_numeric':
+            return frame_to_dict(clients_df.drop(columns=numeric_columns).describe())
+        case 'describe_categorical':
+            return frame_to_dict(clients_df.describe(include='object'))
+        case 'missing':
+            return {str(column): int(count) for column, count in clients_df.isna().sum().items()}
+        case 'corr':
+            return frame_to_dict(clients_df.select_dtypes('float64').corr())
+    raise ValueError(f'Unknown aggregate {name}')
+
+
+def get_aggregate(db: Session, name: str, column: str | None = None) -> dict:
+    """Returns the cached EDA aggregate, it is recomputed only when the clients table version changes"""
+    version, clients_df = get_clients_frame(db)
+    key = f'{name}:{column}'
+    cached = eda_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    aggregate = compute_aggregate(clients_df, name, column)
+    eda_cache[key] = (version, aggregate)
+    return aggregate
+
+
+def get_scatter_data(db: Session, columns: list[str], sample: int | None = None) -> dict:
+    """Returns the columns for the scatter chart as lists, optionally a reproducible random sample of rows"""
+    _, clients_df = get_clients_frame(db)
+    scatter_df = clients_df[columns]
+    if sample is not None and sample < len(scatter_df):
+        scatter_df = scatter_df.sample(n=sample, random_state=0)
+    return {column: scatter_df[column].tolist() for column in columns}
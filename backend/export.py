@@ -0,0 +1,96 @@
+"""
+This module contains bulk export of database tables in columnar formats
+Exports are built with Core select queries and cached by the version of the exported table
+"""
+
+from .imports import pd, pa, pq, gzip, hashlib, BytesIO, Iterator, Session, Table, select, func, pg_insert, \
+    sqlite_insert
+from .models import TableVersion
+
+export_media_types = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+    'json': 'application/json',
+}
+
+# size of the parts the cached export is streamed with
+export_stream_part = 64 * 1024
+
+# (table name, format) -> (etag, payload)
+exports_cache: dict[tuple[str, str], tuple[str, bytes]] = {}
+
+
+def bump_table_version(connection, table_name: str) -> None:
+    """
+    Marks the table as changed in the transaction of the write, so the cached exports and aggregates are rebuilt
+    by every worker and process reading the table
+    """
+    table = TableVersion.__table__
+    dialect_name = connection.dialect.name
+    if dialect_name in ('postgresql', 'sqlite'):
+        insert = (pg_insert if dialect_name == 'postgresql' else sqlite_insert)(table)
+        insert = insert.values(name=table_name, version=1)
+        connection.execute(insert.on_conflict_do_update(index_elements=['name'],
+                                                        set_={'version': table.c.version + 1}))
+    elif not connection.execute(table.update().where(table.c.name == table_name)
+                                .values(version=table.c.version + 1)).rowcount:
+        connection.execute(table.insert().values(name=table_name, version=1))
+
+
+def get_table_version(db: Session, table: Table) -> str:
+    """
+    Gets a cheap version signature of the table: number of rows, maximum ID and the write counter of the database
+    """
+    version_table = TableVersion.__table__
+    write_version = select(version_table.c.version).where(version_table.c.name == table.name).scalar_subquery()
+    rows_count, max_id, version = db.execute(select(func.count(), func.max(table.c.ID), write_version)).one()
+    return f'{table.name}:{rows_count}:{max_id}:{version or 0}'
+
+
+def get_table_etag(table_version: str, export_format: str) -> str:
+    """Builds the ETag of the table export in the given format"""
+    digest = hashlib.sha1(f'{table_version}:{export_format}'.encode()).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def read_table_frame(db: Session, table: Table) -> pd.DataFrame:
+    """Reads the whole table with a Core select into a dataframe, without ORM objects"""
+    result = db.execute(select(table))
+    return pd.DataFrame(result.all(), columns=[str(column) for column in result.keys()])
+
+
+def build_export(table_df: pd.DataFrame, export_format: str) -> bytes:
+    """Serializes the table dataframe to the zstd Arrow IPC stream, zstd Parquet or gzipped json records"""
+    match export_format:
+        case 'arrow':
+            arrow_table = pa.Table.from_pandas(table_df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            options = pa.ipc.IpcWriteOptions(compression='zstd')
+            with pa.ipc.new_stream(sink, arrow_table.schema, options=options) as writer:
+                writer.write_table(arrow_table)
+            return sink.getvalue().to_pybytes()
+        case 'parquet':
+            buffer = BytesIO()
+            pq.write_table(pa.Table.from_pandas(table_df, preserve_index=False), buffer, compression='zstd')
+            return buffer.getvalue()
+        case 'json':
+            records = table_df.to_json(orient='records', force_ascii=False, double_precision=15)
+            return gzip.compress(records.encode(), compresslevel=6)
+    raise ValueError(f'Unknown export format {export_format}')
+
+
+def get_table_export(db: Session, table: Table, export_format: str, etag: str) -> bytes:
+    """Returns the payload of the table export, the payload is rebuilt only when the ETag of the table changes"""
+    cached = exports_cache.get((table.name, export_format))
+    if cached and cached[0] == etag:
+        return cached[1]
+    payload = build_export(read_table_frame(db, table), export_format)
+    exports_cache[(table.name, export_format)] = (etag, payload)
+    return payload
+
+
+def iter_payload(payload: bytes) -> Iterator[bytes]:
+    """Splits the payload into parts for the streaming response"""
+    view = memoryview(payload)
+    for start in range(0, len(view), export_stream_part):
+        yield bytes(view[start:start + export_stream_part])
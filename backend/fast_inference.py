@@ -0,0 +1,212 @@
+"""
+This module contains the fast inference engine for the logistic regression models
+When a model version is loaded its fitted encoder, scaler and model are compiled into flat NumPy arrays,
+so that clients are scored with plain array operations without building dataframes.
+Compiled arrays may be saved as .npy files and loaded memory-mapped, so worker processes share a single copy
+"""
+
+from .imports import os, json, shutil, np, pd, expit, Iterable, client_features
+from .observability import stage_timer
+
+# arrays of the compiled model saved as separate .npy files
+array_names = ('mean', 'scale', 'linear', 'quadratic')
+
+
+class FastLogisticModel:
+    """
+    Compiled logistic regression with a quadratic form over standardized one-hot encoded features:
+    logit = intercept + z @ linear + z @ quadratic @ z, where z = (x - mean) / scale
+    """
+
+    def __init__(self, numeric_columns: dict[str, int], categorical_maps: dict[str, dict[str, int]], n_features: int,
+                 mean: np.ndarray, scale: np.ndarray, linear: np.ndarray, intercept: float,
+                 quadratic: np.ndarray | None = None, strict_categories: bool = False):
+        """
+        :param numeric_columns: positions of the numeric client columns in the encoded feature vector
+        :param categorical_maps: category to position maps of the one-hot encoded client columns
+        :param n_features: length of the encoded feature vector
+        :param mean: mean subtracted from every encoded feature
+        :param scale: scale dividing every encoded feature
+        :param linear: coefficients of the linear part of the logit
+        :param intercept: constant part of the logit
+        :param quadratic: upper triangular matrix of the pairwise feature coefficients or None
+        :param strict_categories: raise on unknown categories instead of encoding them with zeros
+        """
+        self.numeric_columns = numeric_columns
+        self.categorical_maps = categorical_maps
+        self.n_features = n_features
+        self.mean = mean
+        self.scale = scale
+        self.linear = linear
+        self.intercept = intercept
+        self.quadratic = quadratic
+        self.strict_categories = strict_categories
+
+    def encode(self, columns: dict[str, Iterable]) -> np.ndarray:
+        """Builds the standardized encoded feature matrix from the client columns"""
+        n_rows = len(columns[client_features[0]])
+        with stage_timer('encode'):
+            features = np.zeros((n_rows, self.n_features))
+            for column, position in self.numeric_columns.items():
+                features[:, position] = np.asarray(columns[column], dtype=float)
+            rows = np.arange(n_rows)
+            for column, category_map in self.categorical_maps.items():
+                positions = np.fromiter((category_map.get(value, -1) for value in columns[column]), dtype=np.intp,
+                                        count=n_rows)
+                known = positions >= 0
+                if self.strict_categories and not known.all():
+                    unknown = {value for value, position in zip(columns[column], positions) if position < 0}
+                    raise ValueError(f"Found unknown categories {sorted(unknown)} in column {column} during transform")
+                features[rows[known], positions[known]] = 1.0
+        with stage_timer('scale'):
+            return (features - self.mean) / self.scale
+
+    def predict_proba_columns(self, columns: dict[str, Iterable]) -> np.ndarray:
+        """Returns the probabilities of the positive class for the client columns"""
+        features = self.encode(columns)
+        with stage_timer('predict'):
+            logit = features @ self.linear + self.intercept
+            if self.quadratic is not None:
+                logit += np.einsum('ij,ij->i', features @ self.quadratic, features)
+            return expit(logit)
+
+    def predict_proba_records(self, clients: list[dict]) -> np.ndarray:
+        """Returns the probabilities of the positive class for a list of client dictionaries"""
+        columns = {column: [client[column] for client in clients] for column in client_features}
+        return self.predict_proba_columns(columns)
+
+    def predict_proba_frame(self, clients_df: pd.DataFrame) -> np.ndarray:
+        """Returns the probabilities of the positive class for the rows of a client dataframe"""
+        columns = {column: clients_df[column].to_numpy() for column in client_features}
+        return self.predict_proba_columns(columns)
+
+
+def compile_tuned_model(ohe_enc, scaler, model) -> FastLogisticModel:
+    """
+    Compiles the category_encoders one-hot encoder, the standard scaler and the logistic regression
+    of the tuned model into a FastLogisticModel
+    """
+    encoded_columns = list(scaler.feature_names_in_)
+    positions = {name: position for position, name in enumerate(encoded_columns)}
+    numeric_columns = {column: positions[column] for column in client_features if column in positions}
+
+    ordinal_mappings = {mapping['col']: mapping['mapping'] for mapping in ohe_enc.ordinal_encoder.mapping}
+    categorical_maps = {}
+    for mapping in ohe_enc.mapping:
+        column, one_hot = mapping['col'], mapping['mapping']
+        category_map = {}
+        for category, ordinal in ordinal_mappings[column].items():
+            if pd.isna(category) or ordinal not in one_hot.index:
+                continue
+            hot_columns = one_hot.columns[one_hot.loc[ordinal].to_numpy() == 1]
+            if len(hot_columns) == 1:
+                category_map[category] = positions[hot_columns[0]]
+        categorical_maps[column] = category_map
+
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(len(encoded_columns))
+    scale = scaler.scale_ if scaler.with_std else np.ones(len(encoded_columns))
+    return FastLogisticModel(numeric_columns, categorical_maps, len(encoded_columns), np.asarray(mean, dtype=float),
+                             np.asarray(scale, dtype=float), model.coef_[0].astype(float),
+                             float(model.intercept_[0]))
+
+
+def compile_regular_model(pipeline) -> FastLogisticModel:
+    """
+    Compiles the regular model pipeline (column transformer with a standard scaler and a one-hot encoder,
+    polynomial features and logistic regression) into a FastLogisticModel
+    """
+    encoder, features, model = (pipeline.named_steps[step] for step in ('encoder', 'features', 'model'))
+
+    numeric_columns, categorical_maps, mean, scale = {}, {}, [], []
+    for name, transformer, columns in encoder.transformers_:
+        if name == 'remainder' or transformer == 'drop':
+            continue
+        if name == 'standardscaler':
+            column_means = transformer.mean_ if transformer.with_mean else np.zeros(len(columns))
+            column_scales = transformer.scale_ if transformer.with_std else np.ones(len(columns))
+            for column, column_mean, column_scale in zip(columns, column_means, column_scales):
+                numeric_columns[column] = len(mean)
+                mean.append(column_mean)
+                scale.append(column_scale)
+        elif name == 'onehotencoder':
+            for column, categories in zip(columns, transformer.categories_):
+                categorical_maps[column] = {category: len(mean) + i for i, category in enumerate(categories)}
+                mean.extend([0.0] * len(categories))
+                scale.extend([1.0] * len(categories))
+        else:
+            raise ValueError(f'Transformer {name} of the regular model can not be compiled')
+    n_features = len(mean)
+
+    coef = model.coef_[0].astype(float)
+    intercept = float(model.intercept_[0])
+    linear = np.zeros(n_features)
+    quadratic = np.zeros((n_features, n_features))
+    for powers, weight in zip(features.powers_, coef):
+        indices = np.flatnonzero(powers)
+        match powers.sum():
+            case 0:
+                intercept += weight
+            case 1:
+                linear[indices[0]] += weight
+            case 2:
+                quadratic[indices[0], indices[-1]] += weight
+            case _:
+                raise ValueError('Only polynomial features up to the second degree can be compiled')
+
+    return FastLogisticModel(numeric_columns, categorical_maps, n_features, np.asarray(mean, dtype=float),
+                             np.asarray(scale, dtype=float), linear, intercept, quadratic, strict_categories=True)
+
+
+def save_fast_model(fast_model: FastLogisticModel, directory: str, source: str) -> None:
+    """
+    Saves the compiled model as .npy arrays and a json description. The files are written to a temporary directory
+    renamed into place, when several workers compile the same model the first rename wins
+
+    :param source: signature of the artifacts the model was compiled from
+    """
+    tmp_directory = f'{directory}.tmp{os.getpid()}'
+    os.makedirs(tmp_directory, exist_ok=True)
+    for name in array_names:
+        array = getattr(fast_model, name)
+        if array is not None:
+            np.save(os.path.join(tmp_directory, f'{name}.npy'), array)
+    meta = {
+        'source': source,
+        'numeric_columns': fast_model.numeric_columns,
+        # json keys are always strings, so categories are kept as pairs with their original type
+        'categorical_maps': {column: list(category_map.items())
+                             for column, category_map in fast_model.categorical_maps.items()},
+        'n_features': fast_model.n_features,
+        'intercept': fast_model.intercept,
+        'strict_categories': fast_model.strict_categories,
+    }
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.replace(tmp_directory, directory)
+    except OSError:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def load_fast_model(directory: str, source: str) -> FastLogisticModel | None:
+    """
+    Loads the compiled model with the arrays memory-mapped read-only
+
+    :param source: signature of the current artifacts, a model compiled from other artifacts is not loaded
+    :return: compiled model or None if it is missing or stale
+    """
+    try:
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['source'] != source:
+            return None
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                  if os.path.exists(os.path.join(directory, f'{name}.npy')) else None for name in array_names}
+    except (OSError, ValueError, KeyError):
+        # the directory is missing, being replaced by another worker or written by an older version
+        return None
+    return FastLogisticModel(meta['numeric_columns'],
+                             {column: dict(pairs) for column, pairs in meta['categorical_maps'].items()},
+                             meta['n_features'], arrays['mean'], arrays['scale'], arrays['linear'], meta['intercept'],
+                             arrays['quadratic'], meta['strict_categories'])
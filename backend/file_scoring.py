@@ -0,0 +1,133 @@
+"""
+This module contains the offline scoring of the client files without the HTTP layer
+CSV and Parquet files are read in chunks, the chunks are scored in a pool of worker processes and written
+to the output file in the input order. Only a few chunks are held in memory at a time, so files larger than RAM
+are scored with bounded memory
+"""
+
+from .imports import os, mp, deque, pd, np, pa, pq, Iterator, ProcessPoolExecutor, client_features
+from .registry import model_registry
+
+# file formats of the scored files by their extensions
+file_formats = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet'}
+
+# columns of the input file: the client ID and the model features
+input_columns = ['ID'] + client_features
+
+
+def get_file_format(file_path: str) -> str:
+    """Returns the format of the file by its extension"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in file_formats:
+        raise ValueError(f'Unsupported file {file_path}, expected one of {", ".join(file_formats)}')
+    return file_formats[extension]
+
+
+def iter_file_chunks(file_path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Reads the ID and the feature columns of the CSV or Parquet file chunk by chunk"""
+    if get_file_format(file_path) == 'parquet':
+        parquet_file = pq.ParquetFile(file_path)
+        missing_columns = set(input_columns) - set(parquet_file.schema_arrow.names)
+        if missing_columns:
+            raise ValueError(f'Missing client columns: {", ".join(sorted(missing_columns))}')
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=input_columns):
+            if batch.num_rows:
+                yield batch.to_pandas()
+        return
+
+    for chunk_df in pd.read_csv(file_path, chunksize=chunk_size):
+        missing_columns = set(input_columns) - set(chunk_df.columns)
+        if missing_columns:
+            raise ValueError(f'Missing client columns: {", ".join(sorted(missing_columns))}')
+        if len(chunk_df):
+            yield chunk_df[input_columns]
+
+
+def init_scoring_worker(model_type: str, version: str) -> None:
+    """Makes the scored version resident in the worker process"""
+    model_registry.preload(model_type, version)
+
+
+def score_chunk(chunk_df: pd.DataFrame, model_type: str, version: str, threshold: float,
+                best_thr: float) -> pd.DataFrame:
+    """Scores a chunk of clients and returns the probabilities and the recommendation flags with the client IDs"""
+    preds = model_registry.get(model_type, version).predict_proba_frame(chunk_df[client_features])
+    return pd.DataFrame({
+        'ID': chunk_df['ID'].to_numpy(),
+        'pred': preds,
+        'is_recommend_thr': (preds >= threshold).astype(np.int8),
+        'is_recommend_best_thr': (preds >= best_thr).astype(np.int8),
+    })
+
+
+class ScoredFileWriter:
+    """Appends the scored chunks to a CSV or Parquet file"""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.file_format = get_file_format(file_path)
+        self.parquet_writer = None
+        self.rows = 0
+
+    def write(self, scored_df: pd.DataFrame) -> None:
+        """Appends the chunk, the first chunk creates the file"""
+        if self.file_format == 'parquet':
+            table = pa.Table.from_pandas(scored_df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.file_path, table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            scored_df.to_csv(self.file_path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        self.rows += len(scored_df)
+
+    def close(self) -> None:
+        """Finishes the file, an empty input gives a file with the header only"""
+        if self.rows == 0:
+            self.write(pd.DataFrame({'ID': np.array([], dtype=np.int64), 'pred': np.array([], dtype=float),
+                                     'is_recommend_thr': np.array([], dtype=np.int8),
+                                     'is_recommend_best_thr': np.array([], dtype=np.int8)}))
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def score_file(input_path: str, output_path: str, model_type: str, version: str | None = None,
+               threshold: float | None = None, chunk_size: int = 50_000, workers: int = 1) -> dict:
+    """
+    Scores the client file with the model version and writes the predictions in the order of the input rows
+
+    :param input_path: CSV or Parquet file with the ID and the ClientShort columns
+    :param output_path: CSV or Parquet file of the predictions
+    :param model_type: name of the model from models_schema
+    :param version: version of the model, the active one by default
+    :param threshold: user threshold for the recommendation flag, the optimal threshold of the version by default
+    :param chunk_size: number of rows read and scored at a time
+    :param workers: number of worker processes, 1 scores the chunks in the current process
+    :return: summary of the scoring
+    """
+    bundle = model_registry.preload(model_type, version or model_registry.get_active_versions()[model_type])
+    best_thr = bundle.best_thr
+    threshold = best_thr if threshold is None else threshold
+    score_args = (model_type, bundle.version, threshold, best_thr)
+    writer = ScoredFileWriter(output_path)
+    try:
+        if workers <= 1:
+            for chunk_df in iter_file_chunks(input_path, chunk_size):
+                writer.write(score_chunk(chunk_df, *score_args))
+        else:
+            # two chunks per worker are in flight: one scored and one waiting, so the pool is never idle
+            # while the memory stays bounded by the number of chunks and not by the file size
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+                                     initializer=init_scoring_worker,
+                                     initargs=(model_type, bundle.version)) as executor:
+                pending = deque()
+                for chunk_df in iter_file_chunks(input_path, chunk_size):
+                    pending.append(executor.submit(score_chunk, chunk_df, *score_args))
+                    if len(pending) >= 2 * workers:
+                        writer.write(pending.popleft().result())
+                while pending:
+                    writer.write(pending.popleft().result())
+    finally:
+        writer.close()
+
+    return {'model_type': model_type, 'version': bundle.version, 'threshold': threshold, 'best_thr': best_thr,
+            'rows': writer.rows, 'output': output_path}
@@ -4,40 +4,157 @@ This module contains imports, models, constants values and dictionaries
 # imports of main modules
 import pickle
 import os
+import sys
+import re
+import time
+import threading
+import uuid
+import multiprocessing as mp
 import json
-import requests
+import gzip
+import hashlib
+import shutil
+import logging
+import argparse
+import numbers
+import socket
+import subprocess
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 
 # imports for FastApi usage
-from io import StringIO
-from typing import Any
-from pydantic import BaseModel
+from io import StringIO, BytesIO
+from tempfile import SpooledTemporaryFile, TemporaryDirectory, gettempdir
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterable, Iterator
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pydantic import BaseModel, ValidationError
 from enum import Enum
 
 # imports for database usage
-from sqlalchemy.orm import sessionmaker, declarative_base, Mapped, mapped_column
-from sqlalchemy import URL, create_engine
+from sqlalchemy.orm import sessionmaker, declarative_base, Mapped, mapped_column, Session
+from sqlalchemy import URL, Table, Column, MetaData, Index, BigInteger, create_engine, select, delete, func, event, \
+    make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import NullPool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 # imports for ML model usage
-from sklearn.metrics import precision_score, recall_score, f1_score, accuracy_score
+from scipy.special import expit
+from scipy.stats import loguniform
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.linear_model import SGDClassifier, LogisticRegression
+from sklearn.model_selection import StratifiedKFold, ParameterSampler
+from sklearn.metrics import roc_auc_score
 
-# from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-# from dotenv import load_dotenv
+from dotenv import load_dotenv
 
+# optional settings of the backend are read from the environment or the .env file
+load_dotenv()
 
 path = os.path.dirname(__file__)
 
-with open(path + '/fitted_models/ohe.pickle', 'rb') as f:
-    ohe_enc = pickle.load(f)
+# feature columns of a client in the order expected by the fitted encoders and models
+client_features = [
+    'AGE',
+    'GENDER',
+    'EDUCATION',
+    'MARITAL_STATUS',
+    'CHILD_TOTAL',
+    'DEPENDANTS',
+    'SOCSTATUS_WORK_FL',
+    'SOCSTATUS_PENS_FL',
+    'FACT_ADDRESS_PROVINCE',
+    'FL_PRESENCE_FL',
+    'OWN_AUTO',
+    'CREDIT',
+    'TERM',
+    'FST_PAYMENT',
+    'GEN_INDUSTRY',
+    'GEN_TITLE',
+    'JOB_DIR',
+    'WORK_TIME',
+    'FAMILY_INCOME',
+    'PERSONAL_INCOME',
+]
+
+# score clients with the compiled NumPy models of fast_inference module instead of sklearn transforms
+fast_inference = os.getenv('FAST_INFERENCE', 'false').lower() == 'true'
+
+# keep the pickled artifacts on the disk until the first prediction of the model and read the compiled arrays
+# of the fast inference models memory-mapped, so worker processes share them through the page cache
+lazy_models = os.getenv('LAZY_MODELS', 'false').lower() == 'true'
+
+# seconds between the checks of the versions activated by other workers and processes
+active_refresh_seconds = float(os.getenv('ACTIVE_REFRESH_SECONDS', 1))
+
+# creation of the database schema: 'import' of the app module, 'startup' hook of every worker
+# or 'off' when the schema is created once with `python -m backend.cli init-db`
+db_init_schema = os.getenv('DB_INIT_SCHEMA', 'import').lower()
+
+# page size limits of the clients query with keyset pagination
+clients_page_size = 100
+clients_max_page_size = 1_000
+
+# serve the interactive database endpoints with async endpoints over the asyncpg engine
+db_async = os.getenv('DB_ASYNC', 'false').lower() == 'true'
+
+# connection pool and latency settings of the database engines
+db_pool_size = int(os.getenv('DB_POOL_SIZE', 5))
+db_max_overflow = int(os.getenv('DB_MAX_OVERFLOW', 10))
+db_pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', 30))
+db_pool_recycle = int(os.getenv('DB_POOL_RECYCLE', 300))
+db_pool_pre_ping = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+db_statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+db_statement_cache_size = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 500))
+db_pgbouncer = os.getenv('DB_PGBOUNCER', 'false').lower() == 'true'
+
+# session-scoped state of the users keyed by the client token: 'memory' or 'db' store and its time to live
+user_state_store = os.getenv('USER_STATE_STORE', 'memory').lower()
+user_state_ttl = int(os.getenv('USER_STATE_TTL', 3600))
+user_state_max_entries = 10_000
+
+# worker processes of the background training jobs and the number of finished jobs kept for the status endpoints
+fit_workers = int(os.getenv('FIT_WORKERS', 1))
+jobs_history_size = 100
+
+# number of client rows read and fitted at a time by the incremental training from the client table
+fit_chunk_size = 2_000
+
+# worker processes fitting the folds and candidates of a hyperparameter search job in parallel
+tune_workers = int(os.getenv('TUNE_WORKERS', os.cpu_count() or 1))
+
+# cache of the single client predictions: limits in entries (0 disables the cache) and in bytes, time to live
+prediction_cache_size = int(os.getenv('PREDICTION_CACHE_SIZE', 10_000))
+prediction_cache_bytes = int(os.getenv('PREDICTION_CACHE_BYTES', 16 * 1024 * 1024))
+prediction_cache_ttl = int(os.getenv('PREDICTION_CACHE_TTL', 3600))
+
+# number of rows validated and written at a time by the bulk ingestion and the size of the uploaded body
+# kept in memory, larger uploads are spooled to a temporary file
+ingest_chunk_size = 50_000
+ingest_spool_size = 64 * 1024 * 1024
+
+# number of client rows scored and written at a time by the re-scoring of the stored predictions
+rescore_chunk_size = 10_000
 
-with open(path + '/fitted_models/scaler.pickle', 'rb') as f:
-    scaler = pickle.load(f)
+# micro-batching of the concurrent single client predictions: the longest time a prediction waits for others
+# in milliseconds (0 disables the batching) and the largest number of clients scored together
+micro_batch_wait_ms = float(os.getenv('MICRO_BATCH_WAIT_MS', 2))
+micro_batch_size = int(os.getenv('MICRO_BATCH_SIZE', 64))
 
-with open(path + '/fitted_models/model_regular.pickle', 'rb') as f:
-    model_regular = pickle.load(f)
+# Prometheus-style metrics of the requests, prediction stages and database queries served on /metrics
+metrics_enabled = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
 
-with open(path + '/fitted_models/model_tuned.pickle', 'rb') as f:
-    model_tuned = pickle.load(f)
+# default number of clients scored with a single vectorized call in batch predictions
+batch_chunk_size = 5_000
 
 models_schema = {
     'regular': {
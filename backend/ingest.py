@@ -0,0 +1,172 @@
+"""
+This module contains bulk ingestion of CSV, Parquet and NDJSON files into the client and y tables
+Files are read in chunks, every chunk is validated column by column with pandas instead of a Pydantic object per row.
+PostgreSQL over psycopg2 loads the chunks with COPY into a temporary staging table and upserts them from it,
+other databases get batched executemany inserts. The whole file is loaded in a single transaction
+"""
+
+from .imports import time, np, pd, pq, Table, Column, MetaData, select, Iterator, BinaryIO, StringIO
+from .imports import pg_insert, sqlite_insert, ingest_chunk_size
+from .db import engine
+from .models import TableClient, TableY
+from .export import bump_table_version
+
+# tables accepting the bulk ingestion by their names
+ingest_tables = {'client': TableClient.__table__, 'y': TableY.__table__}
+
+# file formats of the ingested files by their extensions
+ingest_file_formats = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+# number of invalid rows listed in the error message of a column
+error_rows_shown = 5
+
+
+class IngestError(ValueError):
+    """Invalid file or rows of the ingested file"""
+
+
+def iter_ingest_chunks(file: BinaryIO | str, file_format: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Reads the CSV, Parquet or NDJSON file chunk by chunk"""
+    match file_format:
+        case 'csv':
+            yield from pd.read_csv(file, chunksize=chunk_size)
+        case 'ndjson':
+            yield from pd.read_json(file, lines=True, chunksize=chunk_size)
+        case 'parquet':
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+        case _:
+            raise IngestError(f'Unknown file format {file_format}')
+
+
+def validate_chunk(chunk_df: pd.DataFrame, table: Table, first_row: int) -> pd.DataFrame:
+    """
+    Checks and converts the columns of the chunk to the types of the table columns with vectorized operations.
+    Rows with a repeated ID keep the last occurrence, as the later row is the newer one
+
+    :param first_row: number of the file rows before the chunk, rows are numbered from 1 in the error messages
+    :return: chunk with the table columns in the table order
+    """
+    missing_columns = [column.name for column in table.columns if column.name not in chunk_df]
+    if missing_columns:
+        raise IngestError(f'Missing {table.name} columns: {", ".join(missing_columns)}')
+
+    errors, columns = [], {}
+    for column in table.columns:
+        values = chunk_df[column.name]
+        if column.type.python_type is str:
+            invalid = values.isna().to_numpy()
+            columns[column.name] = values.astype(str)
+        else:
+            numbers = pd.to_numeric(values, errors='coerce')
+            invalid = numbers.isna().to_numpy()
+            if column.type.python_type is int:
+                invalid |= ~invalid & (numbers.fillna(0) % 1 != 0).to_numpy()
+                numbers = numbers.fillna(0).astype(np.int64)
+            columns[column.name] = numbers
+        if invalid.any():
+            rows = ', '.join(str(first_row + row + 1) for row in np.flatnonzero(invalid)[:error_rows_shown])
+            errors.append(f'{column.name} has {invalid.sum()} invalid values in rows {rows}')
+    if errors:
+        raise IngestError('; '.join(errors))
+    return pd.DataFrame(columns).drop_duplicates('ID', keep='last')
+
+
+def on_conflict_update(insert, table: Table):
+    """Turns the dialect insert into the upsert updating all columns of the rows with existing IDs"""
+    return insert.on_conflict_do_update(index_elements=['ID'], set_={
+        column.name: insert.excluded[column.name] for column in table.columns if column.name != 'ID'})
+
+
+def get_insert(connection, table: Table, upsert: bool):
+    """Builds the insert statement of the executemany path for the dialect of the connection"""
+    dialect_name = connection.dialect.name
+    if dialect_name not in ('postgresql', 'sqlite'):
+        if upsert:
+            raise IngestError(f'Upsert is not supported by {dialect_name}')
+        return table.insert()
+    insert = (pg_insert if dialect_name == 'postgresql' else sqlite_insert)(table)
+    return on_conflict_update(insert, table) if upsert else insert
+
+
+def copy_chunk(connection, table: Table, staging_table: Table, chunk_df: pd.DataFrame, upsert: bool) -> None:
+    """Loads the chunk into the staging table with COPY and moves it into the table with a single statement"""
+    buffer = StringIO()
+    chunk_df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    quote = connection.dialect.identifier_preparer.quote
+    column_names = list(chunk_df.columns)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {quote(staging_table.name)} ({", ".join(map(quote, column_names))}) '
+                           f'FROM STDIN WITH (FORMAT csv)', buffer)
+    insert = pg_insert(table).from_select(column_names, select(*(staging_table.c[name] for name in column_names)))
+    connection.execute(on_conflict_update(insert, table) if upsert else insert)
+    connection.execute(staging_table.delete())
+
+
+def create_staging_table(connection, table: Table) -> Table | None:
+    """
+    Creates the temporary staging table of the COPY path on PostgreSQL over psycopg2.
+    The table lives in the session of the connection and is dropped with the transaction
+
+    :return: staging table or None if the connection does not support COPY
+    """
+    if connection.dialect.name != 'postgresql' or connection.dialect.driver != 'psycopg2':
+        return None
+    staging_table = Table(f'{table.name}_ingest', MetaData(),
+                          *(Column(column.name, column.type) for column in table.columns),
+                          prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+    staging_table.create(connection)
+    return staging_table
+
+
+def write_chunk(connection, table: Table, chunk_df: pd.DataFrame, upsert: bool,
+                staging_table: Table | None = None) -> None:
+    """
+    Writes the validated chunk with COPY through the staging table or with batched executemany inserts.
+    The version of the table is bumped in the same transaction
+    """
+    if not len(chunk_df):
+        return
+    if staging_table is not None:
+        copy_chunk(connection, table, staging_table, chunk_df, upsert)
+    else:
+        # object columns hold Python numbers, which every driver can bind
+        connection.execute(get_insert(connection, table, upsert), chunk_df.astype(object).to_dict('records'))
+    bump_table_version(connection, table.name)
+
+
+def ingest_file(file: BinaryIO | str, file_format: str, table: Table, upsert: bool = True,
+                chunk_size: int = ingest_chunk_size) -> dict:
+    """
+    Loads the file into the table in a single transaction, nothing is written if any chunk is invalid
+
+    :param file: path or binary file object of the CSV, Parquet or NDJSON file
+    :param file_format: csv, parquet or ndjson
+    :param table: client or y table
+    :param upsert: update the rows with existing IDs instead of failing on them
+    :param chunk_size: number of rows validated and written at a time
+    :return: summary of the ingestion
+    """
+    started = time.perf_counter()
+    rows_read, rows, chunks = 0, 0, 0
+    with engine.begin() as connection:
+        staging_table = create_staging_table(connection, table)
+        for chunk_df in iter_ingest_chunks(file, file_format, chunk_size):
+            rows_read += len(chunk_df)
+            chunk_df = validate_chunk(chunk_df, table, rows_read - len(chunk_df))
+            write_chunk(connection, table, chunk_df, upsert, staging_table)
+            rows += len(chunk_df)
+            chunks += 1
+
+    elapsed = time.perf_counter() - started
+    return {
+        'table': table.name,
+        'rows_read': rows_read,
+        'rows': rows,
+        'chunks': chunks,
+        'method': 'executemany' if staging_table is None else 'copy',
+        'upsert': upsert,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+    }
@@ -0,0 +1,222 @@
+"""
+This module contains background training jobs
+Models are fitted in a pool of worker processes, so training never competes with scoring for the GIL of the app.
+Workers report the progress through a queue, finished artifacts are saved and registered as a new model version
+"""
+
+from .imports import mp, time, uuid, threading, pd, Callable, ProcessPoolExecutor, BrokenProcessPool, Future
+from .imports import fit_workers, jobs_history_size, LogisticRegression
+from .registry import ModelBundle, model_registry, fit_model_artifacts
+
+# progress queue of the current worker process, it is set by the pool initializer
+worker_progress_queue = None
+
+
+def init_worker(progress_queue) -> None:
+    """Keeps the progress queue in the worker process"""
+    global worker_progress_queue
+    worker_progress_queue = progress_queue
+
+
+def get_job_reporter(job_id: str) -> Callable[..., None]:
+    """Returns the callback sending the progress of the job from the worker process to the app"""
+    def report(progress: float, stage: str, **stats) -> None:
+        worker_progress_queue.put((job_id, progress, stage, stats))
+
+    return report
+
+
+def run_fit_job(job_id: str, model_type: str, base_artifacts: dict, fit_df: pd.DataFrame) -> dict:
+    """Fits the artifacts of a new version on the passed clients in the worker process"""
+    return fit_model_artifacts(model_type, fit_df, base_artifacts, get_job_reporter(job_id))
+
+
+def run_table_fit_job(job_id: str, model_type: str, base_artifacts: dict, chunk_size: int, epochs: int,
+                      alpha: float) -> dict:
+    """Fits the artifacts of a new version incrementally on the client table in the worker process"""
+    from .training import fit_model_artifacts_streaming
+    return fit_model_artifacts_streaming(model_type, base_artifacts, chunk_size, epochs, alpha,
+                                         get_job_reporter(job_id))
+
+
+def run_tune_job(job_id: str, model_type: str, base_artifacts: dict, n_candidates: int, cv: int, factor: int,
+                 workers: int) -> dict:
+    """Searches the parameters of the model and fits the best candidate as a new version in the worker process"""
+    from .tuning import tune_model_artifacts
+    return tune_model_artifacts(base_artifacts, n_candidates, cv, factor, workers, report=get_job_reporter(job_id))
+
+
+def run_rescore_job(job_id: str, versions: dict[str, str], full: bool, chunk_size: int) -> dict:
+    """Re-scores the stale rows of the client table into the y table in the worker process"""
+    from .rescoring import rescore_predictions
+    return rescore_predictions(versions, full, chunk_size, get_job_reporter(job_id))
+
+
+class JobManager:
+    """Submits fits to the process pool and keeps the state of the recent jobs"""
+
+    def __init__(self, max_workers: int, history_size: int):
+        self.max_workers = max_workers
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        # job id -> state of the job, the oldest jobs come first
+        self.jobs: dict[str, dict] = {}
+        self.executor = None
+        self.progress_queue = None
+
+    def start(self) -> None:
+        """Starts the worker processes and the progress listener on the first job"""
+        # workers are spawned, so they do not inherit the threads and connections of the app
+        self.progress_queue = mp.get_context('spawn').Queue()
+        self.start_executor()
+        threading.Thread(target=self.listen_progress, daemon=True).start()
+
+    def start_executor(self) -> None:
+        """Starts a new pool of the worker processes"""
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp.get_context('spawn'),
+                                            initializer=init_worker, initargs=(self.progress_queue,))
+
+    def listen_progress(self) -> None:
+        """Applies the progress reports of the workers to the jobs"""
+        while (message := self.progress_queue.get()) is not None:
+            job_id, progress, stage, stats = message
+            self.update(job_id, status='running', progress=progress, stage=stage, **stats)
+
+    def update(self, job_id: str, **changes) -> None:
+        """Changes the state of the job, finished jobs are not changed by late progress reports"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job['status'] not in ('finished', 'failed'):
+                job.update(changes)
+                if changes.get('status') == 'running' and job['started'] is None:
+                    job['started'] = time.time()
+
+    def submit_fit(self, model_type: str, fit_df: pd.DataFrame, activate: bool = False) -> dict:
+        """Submits the fit of a new version on the passed clients and returns the state of the job"""
+        return self.submit('fit', model_type, activate, run_fit_job, fit_df, rows=len(fit_df))
+
+    def submit_table_fit(self, model_type: str, chunk_size: int, epochs: int, alpha: float,
+                         activate: bool = False) -> dict:
+        """Submits the incremental fit of a new version on the client table and returns the state of the job"""
+        return self.submit('fit_table', model_type, activate, run_table_fit_job, chunk_size, epochs, alpha,
+                           chunk_size=chunk_size, epochs=epochs, rows_processed=0, rows_per_sec=None)
+
+    def submit_tune(self, n_candidates: int, cv: int, factor: int, workers: int, activate: bool = False) -> dict:
+        """
+        Submits the hyperparameter search of a new version of the tuned model and returns the state of the job.
+        The search starts from the active version or from the shipped one if the active model is not
+        a logistic regression, e.g. a SGD model fitted from the table
+        """
+        base = model_registry.get('tuned')
+        if not isinstance(base.model, LogisticRegression):
+            base = model_registry.load_base('tuned')
+        return self.submit('tune', 'tuned', activate, run_tune_job, n_candidates, cv, factor, workers, base=base,
+                           n_candidates=n_candidates, cv=cv, factor=factor, workers=workers, fits_done=0,
+                           fits_total=None)
+
+    def submit(self, kind: str, model_type: str, activate: bool, worker: Callable[..., dict], *args,
+               base: ModelBundle | None = None, **job_fields) -> dict:
+        """
+        Submits the worker function fitting a new version based on the active one (or the passed base bundle)
+        and returns the state of the job.
+        The worker is called with the job id, model type, artifacts of the base version and the passed arguments
+        """
+        base = base or model_registry.get(model_type)
+        version = model_registry.reserve_version(model_type)
+        job = self.add_job(kind, model_type=model_type, base_version=base.version, version=version, activate=activate,
+                           **job_fields)
+        try:
+            future = self.submit_worker(worker, job['job_id'], model_type, base.to_artifacts(), *args)
+        except Exception as e:
+            model_registry.release_version(model_type, version)
+            self.update(job['job_id'], status='failed', error=f'{type(e).__name__}: {e}', finished=time.time())
+            raise
+        future.add_done_callback(lambda done: self.finish_fit(job['job_id'], model_type, version, activate, done))
+        return job
+
+    def submit_rescore(self, full: bool, chunk_size: int) -> dict:
+        """Submits the re-scoring of the client table with the active versions and returns the state of the job"""
+        versions = dict(model_registry.get_active_versions())
+        job = self.add_job('rescore', versions=versions, full=full, chunk_size=chunk_size, rows_scanned=0,
+                           rows_scored=0, rows_per_sec=None)
+        future = self.submit_worker(run_rescore_job, job['job_id'], versions, full, chunk_size)
+        future.add_done_callback(lambda done: self.finish_rescore(job['job_id'], done))
+        return job
+
+    def add_job(self, kind: str, **job_fields) -> dict:
+        """Adds the queued job to the history and returns a copy of its state"""
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'kind': kind,
+            'status': 'queued',
+            'progress': 0.0,
+            'stage': None,
+            'error': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            **job_fields,
+        }
+        with self.lock:
+            self.jobs[job['job_id']] = job
+            while len(self.jobs) > self.history_size:
+                del self.jobs[next(iter(self.jobs))]
+            return dict(job)
+
+    def submit_worker(self, worker: Callable[..., dict], *args) -> Future:
+        """Submits the function to the worker processes, the pool is started on the first job"""
+        with self.lock:
+            if self.executor is None:
+                self.start()
+        try:
+            return self.executor.submit(worker, *args)
+        except BrokenProcessPool:
+            # a crashed worker breaks the whole pool, so it is replaced with a new one
+            with self.lock:
+                self.executor.shutdown(wait=False)
+                self.start_executor()
+            return self.executor.submit(worker, *args)
+
+    def finish_fit(self, job_id: str, model_type: str, version: str, activate: bool, future: Future) -> None:
+        """Saves and registers the fitted version, runs in a thread of the app process"""
+        try:
+            bundle = ModelBundle(model_type, version, **future.result())
+            model_registry.save(bundle)
+            model_registry.register(bundle)
+            if activate:
+                model_registry.activate(model_type, version)
+        except Exception as e:
+            self.update(job_id, status='failed', error=f'{type(e).__name__}: {e}', finished=time.time())
+        else:
+            self.update(job_id, status='finished', progress=1.0, stage='registered', finished=time.time())
+        finally:
+            model_registry.release_version(model_type, version)
+
+    def finish_rescore(self, job_id: str, future: Future) -> None:
+        """Updates the state of the finished re-scoring, runs in a thread of the app process"""
+        try:
+            summary = future.result()
+        except Exception as e:
+            self.update(job_id, status='failed', error=f'{type(e).__name__}: {e}', finished=time.time())
+        else:
+            self.update(job_id, status='finished', progress=1.0, stage='scored', finished=time.time(), **summary)
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns a copy of the state of the job"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def describe(self) -> list[dict]:
+        """Returns the states of the recent jobs, the latest first"""
+        with self.lock:
+            return [dict(job) for job in reversed(self.jobs.values())]
+
+    def shutdown(self) -> None:
+        """Stops the worker processes and the progress listener"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.progress_queue.put(None)
+
+
+job_manager = JobManager(fit_workers, jobs_history_size)
@@ -0,0 +1,110 @@
+"""
+This module contains the ranking of the leads for the call center
+The clients are scored (or their stored predictions are read) in keyset pages, every page is merged into the running
+candidates and only the best of them are kept with np.argpartition, so the memory is bounded by K and the page size
+and the probabilities are never fully sorted. Only the selected leads are sorted for the output
+"""
+
+from .imports import np, pd, json, select, Session, Iterator, client_features
+from .models import TableClient, TableY
+from .registry import model_registry
+
+# client columns the leads may be filtered and segmented by
+segment_columns = {'province': 'FACT_ADDRESS_PROVINCE', 'industry': 'GEN_INDUSTRY'}
+
+# number of the leads serialized into a single part of the streamed response
+leads_stream_size = 1_000
+
+
+def get_top_positions(preds: np.ndarray, k: int) -> np.ndarray:
+    """Returns the positions of the k largest probabilities in no particular order"""
+    if len(preds) <= k:
+        return np.arange(len(preds))
+    return np.argpartition(preds, len(preds) - k)[len(preds) - k:]
+
+
+def select_candidates(candidates_df: pd.DataFrame, k: int, quota: int | None, segment: str | None) -> pd.DataFrame:
+    """Keeps the k best candidates, or the quota best candidates of every segment when the leads are segmented"""
+    preds = candidates_df['pred'].to_numpy()
+    if segment is None:
+        return candidates_df.iloc[get_top_positions(preds, k)]
+    codes = pd.factorize(candidates_df[segment], use_na_sentinel=False)[0]
+    positions = []
+    for code in range(codes.max() + 1 if len(codes) else 0):
+        segment_positions = np.flatnonzero(codes == code)
+        positions.append(segment_positions[get_top_positions(preds[segment_positions], quota)])
+    return candidates_df.iloc[np.concatenate(positions)] if positions else candidates_df
+
+
+def iter_lead_pages(db: Session, model_type: str, version: str | None, stored: bool, provinces: list[str] | None,
+                    industries: list[str] | None, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Yields the pages of the filtered clients with their probabilities: the stored predictions of the y table
+    or the probabilities of the model version scored page by page
+    """
+    client_table, y_table = TableClient.__table__, TableY.__table__
+    segment_selects = [client_table.c[column].label(name) for name, column in segment_columns.items()]
+    if stored:
+        id_column = y_table.c.ID
+        query = select(id_column, *segment_selects, y_table.c[f'prediction_{model_type}'].label('pred')) \
+            .join(client_table, client_table.c.ID == id_column)
+    else:
+        bundle = model_registry.get(model_type, version)
+        id_column = client_table.c.ID
+        query = select(*segment_selects, *(client_table.c[column] for column in ['ID'] + client_features))
+    if provinces:
+        query = query.where(client_table.c.FACT_ADDRESS_PROVINCE.in_(provinces))
+    if industries:
+        query = query.where(client_table.c.GEN_INDUSTRY.in_(industries))
+    query = query.order_by(id_column).limit(chunk_size)
+
+    after_id = None
+    while True:
+        result = db.execute(query if after_id is None else query.where(id_column > after_id))
+        page_df = pd.DataFrame(result.all(), columns=[str(column) for column in result.keys()])
+        if page_df.empty:
+            return
+        after_id = int(page_df['ID'].iloc[-1])
+        if not stored:
+            preds = bundle.predict_proba_frame(page_df[client_features])
+            page_df = page_df[['ID', *segment_columns]].assign(pred=preds)
+        yield page_df
+
+
+def get_top_leads(db: Session, model_type: str, k: int, version: str | None = None, stored: bool = False,
+                  provinces: list[str] | None = None, industries: list[str] | None = None,
+                  segment_by: str | None = None, quota: int | None = None, chunk_size: int = 10_000) -> pd.DataFrame:
+    """
+    Selects the K clients with the highest probabilities of the model
+
+    :param model_type: name of the model from models_schema
+    :param k: number of the leads, the capacity of the call center
+    :param version: version of the scoring model, the active one by default
+    :param stored: rank by the predictions stored in the y table instead of scoring the clients
+    :param provinces: provinces of the ranked clients, all by default
+    :param industries: industries of the ranked clients, all by default
+    :param segment_by: province or industry, the segment the quota is applied to
+    :param quota: largest number of the leads of a single segment
+    :param chunk_size: number of clients read and scored at a time
+    :return: leads with their rank, ID, probability, province and industry from the best one
+    """
+    segment_quota = min(quota, k) if segment_by is not None else None
+    candidates_df = None
+    for page_df in iter_lead_pages(db, model_type, version, stored, provinces, industries, chunk_size):
+        if candidates_df is not None:
+            page_df = pd.concat([candidates_df, page_df], ignore_index=True)
+        candidates_df = select_candidates(page_df, k, segment_quota, segment_by)
+    if candidates_df is None:
+        return pd.DataFrame(columns=['rank', 'ID', 'pred', *segment_columns])
+
+    # the segments keep up to the quota each, the best k of them are the leads
+    leads_df = select_candidates(candidates_df, k, None, None)
+    leads_df = leads_df.iloc[np.argsort(-leads_df['pred'].to_numpy(), kind='stable')]
+    return leads_df.assign(rank=np.arange(1, len(leads_df) + 1))[['rank', 'ID', 'pred', *segment_columns]]
+
+
+def iter_leads_ndjson(leads_df: pd.DataFrame) -> Iterator[str]:
+    """Streams the leads as NDJSON lines in parts of leads_stream_size leads"""
+    for start in range(0, len(leads_df), leads_stream_size):
+        records = leads_df.iloc[start:start + leads_stream_size].to_dict(orient='records')
+        yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
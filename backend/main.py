@@ -3,28 +3,83 @@ This is Fast API app for BankClients application: https://banks-clients.streamli
 Contains app endpoints
 """
 
-from fastapi import FastAPI, Depends, status
+from fastapi import FastAPI, Depends, HTTPException, Path, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from sqlalchemy.orm import Session
 
-from .models import Base, TableClient, TableY, SingleClientTable, TableSelectedModel
-from .schemas import Client, Y, ModelNames, ClientShort, SelectedModel
-from .db import SessionLocal, engine
-from .imports import models_schema, pd, ohe_enc, scaler, model_regular, model_tuned
-from .scripts import transform_df_regular_to_tuned, get_single_prediction, get_single_frame, \
-    get_metrics_score_thr, get_user_selection
-
-Base.metadata.create_all(bind=engine)
+from .models import TableClient, TableY, SingleClientTable, TableSelectedModel, init_schema
+from .schemas import Client, Y, ModelNames, ClientShort, SelectedModel, ExportFormats, IngestTables, IngestFormats, \
+    LeadSegments
+from .db import SessionLocal, engine, pool_metrics
+from .imports import models_schema, pd, json, time, ValidationError, batch_chunk_size, fit_chunk_size, \
+    clients_page_size, clients_max_page_size, db_async, db_init_schema, lazy_models, ingest_chunk_size, \
+    ingest_spool_size, SpooledTemporaryFile, IntegrityError, rescore_chunk_size, metrics_enabled, tune_workers, \
+    AsyncIterator
+from .scripts import get_batch_predictions_chunked, get_chunk_predictions, find_unscorable_client, micro_batcher
+from .export import export_media_types, get_table_version, get_table_etag, get_table_export, iter_payload
+from .eda import get_aggregate, get_scatter_data
+from .metrics import get_threshold_metrics
+from .services import get_user_selection, get_single_frame, get_metrics_score_thr, get_client_prediction, \
+    get_clients_page, get_confusion_matrices, get_threshold_profits
+from .user_state import get_client_token, get_user_state, update_user_state
+from .registry import ModelBundle, model_registry, version_pattern
+from .jobs import job_manager
+from .prediction_cache import prediction_cache
+from .ingest import ingest_tables, ingest_file
+from .leads import get_top_leads, iter_leads_ndjson
+from .startup import startup_stats, record_stage, get_memory_usage, log_startup_stats
+from .observability import stage_timer, render_metrics, RequestMetricsMiddleware
+
+# in the startup mode the import of the app does not touch the database, the schema is created by every worker
+# before it serves requests, in the off mode it is created once with `python -m backend.cli init-db`
+if db_init_schema == 'import':
+    schema_started = time.perf_counter()
+    init_schema(bind=engine)
+    record_stage('schema', schema_started)
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+def startup_worker() -> None:
+    """Creates the database schema in the startup mode and reports the startup statistics of the worker"""
+    if db_init_schema == 'startup':
+        schema_started = time.perf_counter()
+        init_schema(bind=engine)
+        record_stage('schema', schema_started)
+    record_stage('startup')
+    log_startup_stats()
+
+
+if metrics_enabled:
+    app.add_middleware(RequestMetricsMiddleware)
+
+
+@app.on_event("shutdown")
+def shutdown_jobs() -> None:
+    """Stops the worker processes of the background jobs"""
+    job_manager.shutdown()
+
+
+# async endpoints are registered first, so they serve the interactive database routes in async mode
+if db_async:
+    from .async_api import router as async_router
+    app.include_router(async_router)
+
 api_url = "http://127.0.0.1:8000/"
 
 
 def get_session() -> None:
-    """Manages connection sessions for working with the database"""
+    """Manages connection sessions for working with the database, the connection checkout is timed for pool metrics"""
     db = SessionLocal()
     try:
+        started = time.perf_counter()
+        db.connection()
+        pool_metrics.record_wait(time.perf_counter() - started)
         yield db
     finally:
         db.close()
@@ -36,6 +91,33 @@ def root():
     return {"message": "This is API for BankClients application: https://banks-clients.streamlit.app/"}
 
 
+@app.get("/pool/metrics", response_model=dict)
+def get_pool_metrics():
+    """Get the state of the database connection pools and the time requests wait for a connection"""
+    pool_metrics_dict = {'sync': pool_metrics.report(engine)}
+    if db_async:
+        from .db import async_engine, async_pool_metrics
+        pool_metrics_dict['async'] = async_pool_metrics.report(async_engine.sync_engine)
+    return pool_metrics_dict
+
+
+@app.get("/startup/stats", response_model=dict)
+def get_startup_stats():
+    """Get the startup time, memory usage and state of the active models of the worker serving the request"""
+    return {
+        **startup_stats,
+        **get_memory_usage(),
+        'lazy_models': lazy_models,
+        'models': {model_type: model_registry.get(model_type).describe() for model_type in models_schema},
+    }
+
+
+@app.get("/metrics")
+def get_prometheus_metrics():
+    """Get the request, prediction stage and database query metrics of the worker in the Prometheus text format"""
+    return Response(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
 @app.get("/get/clients", response_model=list[Client])
 def get_clients(db: Session = Depends(get_session)):
     """Get all clients in the database"""
@@ -48,21 +130,171 @@ def get_target(db: Session = Depends(get_session)):
     return db.query(TableY).all()
 
 
+def get_model_bundle(model_type: str, version: str | None) -> ModelBundle:
+    """Returns the resident version of the model or the active one, raises 404 error if the version is not loaded"""
+    try:
+        return model_registry.get(model_type, version)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.args[0])
+
+
+def get_unscorable_client_error(error: ValueError, chunk: list[dict], offset: int, model_type: str,
+                                version: str | None) -> Exception:
+    """
+    Returns the 422 error naming the client of the failed chunk the model can not score by its position in the body,
+    or the original error if every client of the chunk is scored alone
+    """
+    unscorable = find_unscorable_client(chunk, model_type, version)
+    if unscorable is None:
+        return error
+    index, message = unscorable
+    return RequestValidationError([{'type': 'value_error', 'loc': ('body', offset + index), 'msg': message,
+                                    'input': chunk[index]}])
+
+
+def check_client_columns(columns: list[str]) -> None:
+    """Raises 422 error if some of the columns are not in the client table"""
+    unknown_columns = set(columns) - set(TableClient.__table__.columns.keys())
+    if unknown_columns:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'Unknown client fields: {", ".join(sorted(unknown_columns))}')
+
+
+@app.get("/query/clients", response_model=dict)
+def query_clients(after_id: int | None = None, limit: int = Query(clients_page_size, gt=0, le=clients_max_page_size),
+                  province: list[str] | None = Query(None), industry: list[str] | None = Query(None),
+                  age_min: int | None = None, age_max: int | None = None, target: int | None = None,
+                  fields: str | None = None, db: Session = Depends(get_session)):
+    """
+    Get a page of clients filtered by province, industry, age range and target.
+    Pass next_cursor of the response as after_id to get the next page, fields limits the returned columns
+    """
+    if fields is None:
+        fields_list = TableClient.__table__.columns.keys()
+    else:
+        fields_list = [field.strip() for field in fields.split(',') if field.strip()]
+        check_client_columns(fields_list)
+
+    return get_clients_page(db, fields_list, after_id, limit, province, industry, age_min, age_max, target)
+
+
+@app.get("/eda/value_counts/{column}", response_model=dict)
+def get_eda_value_counts(column: str, db: Session = Depends(get_session)):
+    """Get counts of the clients for every value of the column"""
+    check_client_columns([column])
+    return get_aggregate(db, 'value_counts', column)
+
+
+@app.get("/eda/describe/numeric", response_model=dict)
+def get_eda_describe_numeric(db: Session = Depends(get_session)):
+    """Get distribution characteristics of the numeric columns"""
+    return get_aggregate(db, 'describe_numeric')
+
+
+@app.get("/eda/describe/categorical", response_model=dict)
+def get_eda_describe_categorical(db: Session = Depends(get_session)):
+    """Get distribution characteristics of the categorical columns"""
+    return get_aggregate(db, 'describe_categorical')
+
+
+@app.get("/eda/missing", response_model=dict)
+def get_eda_missing(db: Session = Depends(get_session)):
+    """Get number of missing values in every column"""
+    return get_aggregate(db, 'missing')
+
+
+@app.get("/eda/corr", response_model=dict)
+def get_eda_corr(db: Session = Depends(get_session)):
+    """Get Pearson correlation of the float columns"""
+    return get_aggregate(db, 'corr')
+
+
+@app.get("/eda/scatter", response_model=dict)
+def get_eda_scatter(x: str, y: str, color: str | None = None, sample: int | None = Query(None, gt=0),
+                    db: Session = Depends(get_session)):
+    """Get only the columns required for the scatter chart, optionally a random sample of the clients"""
+    columns = [x, y] if color is None else [x, y, color]
+    check_client_columns(columns)
+    return get_scatter_data(db, list(dict.fromkeys(columns)), sample)
+
+
+def export_table(request: Request, db: Session, table, export_format: ExportFormats) -> Response:
+    """
+    Streams the cached export of the table. Answers 304 without the payload if the client has the current version
+    """
+    etag = get_table_etag(get_table_version(db, table), export_format.value)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    payload = get_table_export(db, table, export_format.value, etag)
+    if export_format == ExportFormats.JSON:
+        headers['Content-Encoding'] = 'gzip'
+    headers['Content-Length'] = str(len(payload))
+    return StreamingResponse(iter_payload(payload), media_type=export_media_types[export_format.value],
+                             headers=headers)
+
+
+@app.get("/export/clients")
+def export_clients(request: Request, export_format: ExportFormats = Query(ExportFormats.ARROW, alias='format'),
+                   db: Session = Depends(get_session)):
+    """Get all clients in the database as a columnar export"""
+    return export_table(request, db, TableClient.__table__, export_format)
+
+
+@app.get("/export/targets")
+def export_targets(request: Request, export_format: ExportFormats = Query(ExportFormats.ARROW, alias='format'),
+                   db: Session = Depends(get_session)):
+    """Get all predictions in the database as a columnar export"""
+    return export_table(request, db, TableY.__table__, export_format)
+
+
+@app.post("/ingest/{table_name}", response_model=dict)
+async def ingest_table(request: Request, table_name: IngestTables,
+                       ingest_format: IngestFormats = Query(IngestFormats.CSV, alias='format'), upsert: bool = True,
+                       chunk_size: int = Query(ingest_chunk_size, gt=0)):
+    """
+    Loads a CSV, Parquet or NDJSON body into the client or y table in a single transaction.
+    Rows are validated column by column, with upsert the rows with existing IDs are updated, otherwise they fail
+    """
+    with SpooledTemporaryFile(max_size=ingest_spool_size) as body_file:
+        async for body_part in request.stream():
+            # the file rolls over to the disk above the spool size, so the writes do not block the event loop
+            await run_in_threadpool(body_file.write, body_part)
+        await run_in_threadpool(body_file.seek, 0)
+        try:
+            return await run_in_threadpool(ingest_file, body_file, ingest_format.value,
+                                           ingest_tables[table_name.value], upsert, chunk_size)
+        except IntegrityError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e.orig))
+        except ValueError as e:
+            # IngestError of the validation and the parsing errors of pandas and pyarrow
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+
 @app.get("/get/single_df", response_model=list[ClientShort])
-def get_single_df(db: Session = Depends(get_session)):
-    """Get single client record in the database"""
+def get_single_df(token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
+    """Get single client record of the user's session or in the database"""
+    if token is not None:
+        single_client = get_user_state(db, token)['single_client']
+        return [single_client] if single_client else []
     return db.query(SingleClientTable).all()
 
 
 @app.get("/get/selected", response_model=SelectedModel)
-def get_selected_options(db: Session = Depends(get_session)):
+def get_selected_options(token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
     """Get user selected options"""
+    if token is not None:
+        return get_user_state(db, token)
     return db.query(TableSelectedModel).first()
 
 
 @app.patch("/update/selected/model_name", response_model=SelectedModel)
-def update_selected_by_model_type(model_name: ModelNames, db: Session = Depends(get_session)):
+def update_selected_by_model_type(model_name: ModelNames, token: str | None = Depends(get_client_token),
+                                  db: Session = Depends(get_session)):
     """Updates information about the User's selected model"""
+    if token is not None:
+        return update_user_state(db, token, type_model=model_name.value)
     updated_selected = db.query(TableSelectedModel).first()
     if updated_selected and updated_selected.type_model != model_name:
         updated_selected.type_model = model_name
@@ -74,8 +306,11 @@ def update_selected_by_model_type(model_name: ModelNames, db: Session = Depends(
 
 
 @app.patch("/update/selected/threshold", response_model=SelectedModel)
-def update_selected_by_threshold(threshold: float, db: Session = Depends(get_session)):
+def update_selected_by_threshold(threshold: float, token: str | None = Depends(get_client_token),
+                                 db: Session = Depends(get_session)):
     """Updates information about the User's selected threshold"""
+    if token is not None:
+        return update_user_state(db, token, threshold=threshold)
     updated_selected = db.query(TableSelectedModel).first()
     if updated_selected and updated_selected.threshold != threshold:
         updated_selected.threshold = threshold
@@ -87,9 +322,9 @@ def update_selected_by_threshold(threshold: float, db: Session = Depends(get_ses
 
 
 @app.get("/get/user_params", response_model=dict)
-def get_user_params():
+def get_user_params(token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
     """Get user selectioned params"""
-    model_type, threshold, best_thr = get_user_selection()
+    model_type, threshold, best_thr = get_user_selection(db, token)
 
     user_params_dict = {
         'model_type': model_type,
@@ -101,45 +336,260 @@ def get_user_params():
 
 
 @app.get("/get/predictions", response_model=dict)
-def get_predict():
+def get_predict(token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
     """Get single client record in the database"""
-    single_df = get_single_frame()
-    single_df = single_df.reset_index(drop=True).set_index('ID')
-    single_df_regular = single_df.iloc[0].to_frame().T
-
-    model_type, threshold, best_thr = get_user_selection()
-
-    match model_type:
-        case 'regular':
-            single_pred, is_recommend_thr, is_recommend_best_thr = get_single_prediction(single_df_regular, threshold,
-                                                                                         best_thr, model_type)
-        case 'tuned':
-            single_df_tuned = transform_df_regular_to_tuned(single_df_regular=single_df_regular)
-            single_pred, is_recommend_thr, is_recommend_best_thr = get_single_prediction(single_df_tuned, threshold,
-                                                                                         best_thr, model_type)
-    answers_dict = {
-        'single_pred': single_pred,
-        'is_recommend_thr': int(is_recommend_thr),
-        'is_recommend_best_thr': int(is_recommend_best_thr)
-    }
+    with stage_timer('fetch'):
+        single_df = get_single_frame(db, token)
+        if single_df.empty:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Single client record is not found')
+        model_type, threshold, best_thr = get_user_selection(db, token)
+
+    single_client = single_df.reset_index().to_dict(orient='records')[0]
+    answers_dict = get_client_prediction(single_client, model_type, threshold, best_thr)
 
     return answers_dict
 
 
+@app.post("/predict", response_model=dict)
+def predict_client(client: ClientShort, model_name: ModelNames | None = None, threshold: float | None = None,
+                   version: str | None = Query(None, pattern=version_pattern),
+                   token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
+    """
+    Get prediction for the client passed in the request body without the temporary database.
+    The model and threshold are taken from the user selection if they are not passed,
+    the database is not touched when the model and threshold are both passed.
+    A resident version of the model may be passed for A/B scoring, the active version is used by default
+    """
+    if model_name is None:
+        model_type, user_threshold, best_thr = get_user_selection(db, token)
+    else:
+        model_type, best_thr = model_name, model_registry.get_best_thr(model_name)
+        user_threshold = best_thr
+    if version is not None:
+        best_thr = get_model_bundle(model_type, version).best_thr
+    threshold = user_threshold if threshold is None else threshold
+
+    answers_dict = get_client_prediction(client.model_dump(), model_type, threshold, best_thr, version)
+
+    return answers_dict
+
+
+@app.get("/predict/cache", response_model=dict)
+def get_prediction_cache():
+    """Get the size and the hit, miss and eviction counters of the single client prediction cache"""
+    return prediction_cache.report()
+
+
+@app.delete("/predict/cache", status_code=status.HTTP_204_NO_CONTENT)
+def clear_prediction_cache():
+    """Drops all cached single client predictions"""
+    prediction_cache.clear()
+    return None
+
+
+@app.get("/predict/batching", response_model=dict)
+def get_prediction_batching():
+    """Get the settings, the queued predictions and the batch counters of the single client micro-batching"""
+    return micro_batcher.report()
+
+
+@app.post("/predict/batch", response_model=dict)
+def get_batch_predict(clients: list[ClientShort], model_name: ModelNames, threshold: float | None = None,
+                      chunk_size: int = Query(batch_chunk_size, gt=0),
+                      version: str | None = Query(None, pattern=version_pattern)):
+    """
+    Scores a list of clients with the selected model in vectorized chunks.
+    If the threshold is not passed, the optimal threshold of the model is used.
+    The whole batch is scored with one version even if the active version is switched meanwhile.
+    A client the model can not score, e.g. with a category unknown to the encoder, is answered with 422 error
+    """
+    bundle = get_model_bundle(model_name, version)
+    best_thr = bundle.best_thr
+    threshold = best_thr if threshold is None else threshold
+    predictions = []
+    try:
+        for chunk_preds in get_batch_predictions_chunked((client.model_dump() for client in clients), model_name,
+                                                         threshold, best_thr, chunk_size, bundle.version):
+            predictions.extend(chunk_preds)
+    except ValueError as e:
+        # the chunks before the failed one are scored, so it starts after their predictions
+        failed_chunk = [client.model_dump() for client in clients[len(predictions):len(predictions) + chunk_size]]
+        raise get_unscorable_client_error(e, failed_chunk, len(predictions), model_name, bundle.version)
+
+    batch_dict = {
+        'model_type': model_name,
+        'version': bundle.version,
+        'threshold': threshold,
+        'best_thr': best_thr,
+        'predictions': predictions
+    }
+
+    return batch_dict
+
+
+class BodyStreamingResponse(StreamingResponse):
+    """
+    Streaming response produced while the request body is still being read. The starlette response listens
+    for the disconnect on the receive channel, which would consume the body messages, so it only sends the parts
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+@app.post("/predict/batch/ndjson")
+async def get_batch_predict_ndjson(request: Request, model_name: ModelNames, threshold: float | None = None,
+                                   chunk_size: int = Query(batch_chunk_size, gt=0),
+                                   version: str | None = Query(None, pattern=version_pattern)):
+    """
+    Scores a NDJSON stream of clients (one ClientShort json per line) and streams NDJSON predictions.
+    The body is scored while it is being read and every chunk is sent as soon as it is scored, so only one chunk
+    of clients is kept in memory at a time. The first chunk is scored before the response is started, so an invalid
+    line in it is answered with 422; an invalid line after it ends the stream with a {"detail": [...]} line.
+    A client the model can not score, e.g. with a category unknown to the encoder, is reported the same way
+    by its position among the clients
+    """
+    bundle = get_model_bundle(model_name, version)
+    best_thr = bundle.best_thr
+    threshold = best_thr if threshold is None else threshold
+
+    def parse_client(line: bytes) -> dict:
+        """Validates a single NDJSON line as a ClientShort record"""
+        try:
+            return ClientShort.model_validate_json(line).model_dump()
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+
+    async def iter_chunks() -> AsyncIterator[list[dict]]:
+        """Yields the validated clients of the body in chunks of chunk_size clients"""
+        chunk, tail = [], b''
+        async for body_part in request.stream():
+            *lines, tail = (tail + body_part).split(b'\n')
+            for line in lines:
+                if line.strip():
+                    chunk.append(parse_client(line))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if tail.strip():
+            chunk.append(parse_client(tail))
+        if chunk:
+            yield chunk
+
+    scored_clients = 0
+
+    async def score_chunk(chunk: list[dict]) -> str:
+        """Scores the chunk in the threadpool and serializes the results"""
+        nonlocal scored_clients
+        try:
+            chunk_preds = await run_in_threadpool(get_chunk_predictions, chunk, model_name, threshold, best_thr,
+                                                  bundle.version)
+        except ValueError as e:
+            raise await run_in_threadpool(get_unscorable_client_error, e, chunk, scored_clients, model_name,
+                                          bundle.version)
+        scored_clients += len(chunk)
+        with stage_timer('serialize'):
+            return ''.join(json.dumps(pred) + '\n' for pred in chunk_preds)
+
+    chunks = iter_chunks()
+    first_chunk = await anext(chunks, None)
+    first_part = await score_chunk(first_chunk) if first_chunk else ''
+
+    async def iter_predictions() -> AsyncIterator[str]:
+        """Sends the scored first chunk and scores the rest of the body chunk by chunk"""
+        yield first_part
+        try:
+            async for chunk in chunks:
+                yield await score_chunk(chunk)
+        except RequestValidationError as e:
+            # the status is already sent, so the error is the last line of the stream
+            yield json.dumps({'detail': jsonable_encoder(e.errors())}, ensure_ascii=False) + '\n'
+
+    return BodyStreamingResponse(iter_predictions(), media_type='application/x-ndjson')
+
+
+@app.get("/leads/top")
+def get_leads_top(model_name: ModelNames, k: int = Query(100, gt=0), stored: bool = False,
+                  version: str | None = Query(None, pattern=version_pattern),
+                  province: list[str] | None = Query(None), industry: list[str] | None = Query(None),
+                  segment_by: LeadSegments | None = None, quota: int | None = Query(None, gt=0),
+                  chunk_size: int = Query(rescore_chunk_size, gt=0), db: Session = Depends(get_session)):
+    """
+    Streams the call list: the K clients with the highest probabilities of the model as NDJSON from the best one.
+    The clients are scored with the version (the active one by default), stored=true ranks them by the predictions
+    of the y table instead. segment_by with quota limits the number of the leads of a single province or industry
+    """
+    if (segment_by is None) != (quota is None):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='segment_by and quota are passed together')
+    if stored and version is not None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='Stored predictions are made by the active versions, version is not accepted')
+    bundle = get_model_bundle(model_name, version)
+    leads_df = get_top_leads(db, model_name.value, k, bundle.version, stored, province, industry,
+                             segment_by.value if segment_by else None, quota, chunk_size)
+    headers = {'X-Model-Version': 'stored' if stored else bundle.version, 'X-Leads-Count': str(len(leads_df))}
+    return StreamingResponse(iter_leads_ndjson(leads_df), media_type='application/x-ndjson', headers=headers)
+
+
 @app.get("/get/metrics_score", response_model=dict)
-def get_metrics():
-    """Get metrics score for current user selection or db state"""
-    metrics = get_metrics_score_thr()
+def get_metrics(ci: bool = False, n_resamples: int = Query(1000, gt=0, le=100_000),
+                confidence: float = Query(0.95, gt=0, lt=1), seed: int | None = None,
+                token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
+    """
+    Get metrics score for current user selection or db state.
+    ci=true adds the bootstrap confidence intervals of the metrics over n_resamples resamples of the y table
+    """
+    metrics = get_metrics_score_thr(db, token, ci, n_resamples, confidence, seed)
     return metrics
 
 
+@app.post("/thresholds/optimize", response_model=dict)
+def optimize_thresholds(call_cost: float = Query(..., ge=0), conversion_value: float = Query(..., gt=0),
+                        model_name: ModelNames | None = None, persist: bool = False, curve: bool = True,
+                        db: Session = Depends(get_session)):
+    """
+    Finds the threshold of the largest expected profit over the stored predictions of every model
+    (or of the passed one): every converted client brings conversion_value, every call costs call_cost.
+    persist=true sets the found thresholds as the optimal thresholds of the active versions
+    """
+    model_types = [model_name.value] if model_name else list(models_schema)
+    return get_threshold_profits(db, model_types, call_cost, conversion_value, persist, curve)
+
+
+@app.get("/get/confusion_matrix", response_model=dict)
+def get_confusion_matrix(token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
+    """Get confusion matrices for current user selection and the optimal threshold"""
+    matrices = get_confusion_matrices(db, token)
+    return matrices
+
+
+@app.get("/metrics/threshold", response_model=dict)
+def get_threshold_metrics_score(model_name: ModelNames, threshold: float, db: Session = Depends(get_session)):
+    """Get metrics score and confusion matrix of the model for any threshold"""
+    metrics_engine = get_threshold_metrics(db, model_name)
+    threshold_dict = {
+        'metrics': metrics_engine.metrics(threshold),
+        'confusion_matrix': metrics_engine.confusion_matrix(threshold)
+    }
+    return threshold_dict
+
+
+@app.get("/metrics/curve", response_model=dict)
+def get_metrics_curve(model_name: ModelNames, db: Session = Depends(get_session)):
+    """Get metrics, ROC and PR curves of the model for the whole sweep of thresholds"""
+    return get_threshold_metrics(db, model_name).curve()
+
+
 @app.get("/{model_name}/params", response_model=dict)
 def get_model_params(model_name: ModelNames):
     """Get model params"""
     model_name_rus = models_schema[model_name]['russian_name']
     model_type = models_schema[model_name]['type']
     params = models_schema[model_name]['params']
-    best_thr = models_schema[model_name]['best_thr']
+    bundle = model_registry.get(model_name)
 
     model_params_dict = {
         model_name_rus:
@@ -147,32 +597,131 @@ def get_model_params(model_name: ModelNames):
                 'type': model_name,
                 'params': params,
                 'name': model_type,
-                'best_thr': best_thr
+                'best_thr': bundle.best_thr,
+                'version': bundle.version
             }
     }
 
     return model_params_dict
 
 
-@app.post("/{model_name}/fit")
-def fit_models(model_name: str, fit_data: list[Client]) -> str:
-    """Fit models"""
-    fit_df = pd.DataFrame([i.fit_data.model_dump() for i in fit_data])
-    X = fit_df.drop(columns=['TARGET', 'AGREEMENT_RK']).reset_index(drop=True).set_index('ID')
-    y = fit_df.TARGET
-    X = pd.DataFrame(ohe_enc.transform(X), index=X.index)
-    X = pd.DataFrame(scaler.fit_transform(X), columns=X.columns, index=X.index)
-    match model_name:
-        case 'regular':
-            model_regular.fit(X, y)
-        case 'tuned':
-            model_tuned.fit(X, y)
-    return 'Success'
+@app.post("/{model_name}/fit", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def fit_models(model_name: ModelNames, fit_data: list[Client], activate: bool = False):
+    """
+    Starts a background job fitting a new version of the model on the passed clients and returns the job state.
+    The artifacts in use are never changed in place, the new version is registered when the job is finished
+    and activated only on request
+    """
+    fit_df = pd.DataFrame([client.model_dump() for client in fit_data])
+    return job_manager.submit_fit(model_name.value, fit_df, activate)
+
+
+@app.post("/{model_name}/fit/table", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def fit_models_from_table(model_name: ModelNames, chunk_size: int = Query(fit_chunk_size, gt=0),
+                          epochs: int = Query(5, gt=0, le=100), alpha: float = Query(1e-2, gt=0),
+                          activate: bool = False):
+    """
+    Starts a background job fitting a new version of the model as a SGD logistic regression straight from
+    the client table. The table is read with a server-side cursor in chunks and the model is fitted with partial_fit,
+    so the memory stays flat as the table grows. The job reports the throughput in rows per second
+    """
+    return job_manager.submit_table_fit(model_name.value, chunk_size, epochs, alpha, activate)
+
+
+@app.post("/tuned/tune", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def tune_model(n_candidates: int = Query(16, ge=2, le=500), cv: int = Query(5, ge=2, le=20),
+               factor: int = Query(3, ge=2, le=10), workers: int = Query(tune_workers, gt=0), activate: bool = False):
+    """
+    Starts a background job searching the parameters of the tuned model with successive halving over stratified folds
+    of the client table. The best candidate is fitted on the whole table and registered as a new version
+    with the threshold maximizing f1 on its out-of-fold predictions
+    """
+    return job_manager.submit_tune(n_candidates, cv, factor, workers, activate)
+
+
+@app.post("/predictions/rescore", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def rescore_client_predictions(full: bool = False, chunk_size: int = Query(rescore_chunk_size, gt=0)):
+    """
+    Starts a background job storing the predictions of the active versions in the y table.
+    Only clients with changed features or scored with another version are scored unless full is passed
+    """
+    return job_manager.submit_rescore(full, chunk_size)
+
+
+@app.get("/jobs", response_model=list[dict])
+def get_jobs():
+    """Get the states of the recent background jobs"""
+    return job_manager.describe()
+
+
+@app.get("/jobs/{job_id}", response_model=dict)
+def get_job(job_id: str):
+    """Get the state of the background job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job is not found')
+    return job
+
+
+@app.get("/jobs/{job_id}/progress", response_model=dict)
+def get_job_progress(job_id: str):
+    """Get the status, progress share and current stage of the background job"""
+    job = get_job(job_id)
+    return {key: job[key] for key in ('job_id', 'status', 'progress', 'stage')}
+
+
+@app.get("/models", response_model=dict)
+def get_model_versions():
+    """Get the active, resident and saved versions of every model"""
+    return model_registry.describe()
+
+
+@app.post("/models/{model_name}/{version}/preload", response_model=dict)
+def preload_model_version(model_name: ModelNames, version: str = Path(pattern=version_pattern)):
+    """Loads the saved version of the model into memory without activating it"""
+    try:
+        bundle = model_registry.preload(model_name.value, version)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.args[0])
+    return {'model_type': model_name, 'active': model_registry.get_active_versions()[model_name], **bundle.describe()}
+
+
+@app.post("/models/{model_name}/{version}/activate", response_model=dict)
+def activate_model_version(model_name: ModelNames, version: str = Path(pattern=version_pattern),
+                           rescore: bool = False):
+    """
+    Switches the model to the version, the predictions in progress finish with the previous version.
+    The active versions are kept in fitted_models/versions/active.json, so the other workers switch to the version
+    within ACTIVE_REFRESH_SECONDS and a restarted app starts with it.
+    With rescore the stored predictions of the clients are refreshed with the version by a background job
+    """
+    try:
+        bundle = model_registry.activate(model_name.value, version)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.args[0])
+    activated_dict = {'model_type': model_name, 'active': model_registry.get_active_versions()[model_name],
+                      **bundle.describe()}
+    if rescore:
+        activated_dict['rescore_job'] = job_manager.submit_rescore(full=False, chunk_size=rescore_chunk_size)
+    return activated_dict
+
+
+@app.delete("/models/{model_name}/{version}", status_code=status.HTTP_204_NO_CONTENT)
+def unload_model_version(model_name: ModelNames, version: str = Path(pattern=version_pattern)):
+    """Removes the inactive version of the model from memory, the saved artifacts stay on the disk"""
+    try:
+        model_registry.unload(model_name.value, version)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e.args[0])
+    return None
 
 
 @app.post("/write/single_df", response_model=ClientShort)
-def write_single_df_to_db(single_df_dict: ClientShort, db: Session = Depends(get_session)):
-    """Takes a single frame as a dictionary and writes it to the temporary database"""
+def write_single_df_to_db(single_df_dict: ClientShort, token: str | None = Depends(get_client_token),
+                          db: Session = Depends(get_session)):
+    """Takes a single frame as a dictionary and writes it to the user's session or the temporary database"""
+    if token is not None:
+        return update_user_state(db, token, single_client=single_df_dict.model_dump())['single_client']
     data_dict = SingleClientTable(**single_df_dict.model_dump())
     db.add(data_dict)
     db.commit()
@@ -181,8 +730,11 @@ def write_single_df_to_db(single_df_dict: ClientShort, db: Session = Depends(get
 
 
 @app.delete("/delete/single_df", status_code=status.HTTP_204_NO_CONTENT)
-def delete_single_df(db: Session = Depends(get_session)):
-    """Deletes a single frame from temporary database after usage"""
+def delete_single_df(token: str | None = Depends(get_client_token), db: Session = Depends(get_session)):
+    """Deletes a single frame from the user's session or temporary database after usage"""
+    if token is not None:
+        update_user_state(db, token, single_client=None)
+        return None
     single_df = db.query(SingleClientTable).first()
     if single_df:
         db.delete(single_df)
@@ -190,5 +742,8 @@ def delete_single_df(db: Session = Depends(get_session)):
     return None
 
 
+# process age of the worker when all modules of the app are imported
+record_stage('import')
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,179 @@
+"""
+This module contains the threshold metrics engine for the predictions stored in the y table
+Predictions of a model are sorted once, after that the confusion matrix and quality metrics
+for any threshold are answered with a binary search over the cumulative counts
+"""
+
+from .imports import np, pd, Session
+from .models import TableY
+from .export import get_table_version, read_table_frame
+
+# model type -> (y table version, engine)
+metrics_cache: dict[str, tuple[str, 'ThresholdMetrics']] = {}
+
+
+def safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Divides arrays returning 0 where the denominator is 0, as sklearn metrics do"""
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+def get_scores(tn: np.ndarray, fp: np.ndarray, fn: np.ndarray, tp: np.ndarray) -> dict:
+    """Computes accuracy, precision, recall and f1 from the confusion counts"""
+    return {
+        'accuracy': safe_divide(tp + tn, tp + tn + fp + fn),
+        'precision': safe_divide(tp, tp + fp),
+        'recall': safe_divide(tp, tp + fn),
+        'f1': safe_divide(2 * tp, 2 * tp + fp + fn),
+    }
+
+
+class ThresholdMetrics:
+    """
+    Cumulative confusion counts over the sorted predictions of a model.
+    A client is predicted positive when its probability is strictly greater than the threshold
+    """
+
+    def __init__(self, y_true: np.ndarray, y_score: np.ndarray):
+        order = np.argsort(y_score, kind='mergesort')
+        self.scores = np.asarray(y_score, dtype=float)[order]
+        positives = np.asarray(y_true)[order] == 1
+        # counts of positive and negative clients among the first i sorted scores
+        self.cum_pos = np.concatenate([[0], np.cumsum(positives)])
+        self.cum_neg = np.concatenate([[0], np.cumsum(~positives)])
+        self.n_pos = int(self.cum_pos[-1])
+        self.n_neg = int(self.cum_neg[-1])
+
+    def confusion(self, thresholds: np.ndarray | float) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Returns tn, fp, fn, tp counts for the thresholds"""
+        below = np.searchsorted(self.scores, thresholds, side='right')
+        fn = self.cum_pos[below]
+        tn = self.cum_neg[below]
+        return tn, self.n_neg - tn, fn, self.n_pos - fn
+
+    def confusion_matrix(self, threshold: float) -> list[list[int]]:
+        """Returns the confusion matrix for the threshold in the sklearn layout: [[tn, fp], [fn, tp]]"""
+        tn, fp, fn, tp = (int(count) for count in self.confusion(threshold))
+        return [[tn, fp], [fn, tp]]
+
+    def scores_at(self, thresholds: np.ndarray | float) -> dict:
+        """Computes accuracy, precision, recall and f1 for the thresholds"""
+        return get_scores(*self.confusion(thresholds))
+
+    def metrics(self, threshold: float) -> dict:
+        """Returns the quality metrics for the threshold rounded as in the metrics endpoints"""
+        return {name: round(float(value), 4) for name, value in self.scores_at(threshold).items()}
+
+    def curve(self) -> dict:
+        """
+        Returns the whole threshold sweep: metrics, ROC and PR curves for every distinct prediction
+        and a threshold below all of them, together with the areas under ROC and PR curves
+        """
+        distinct_scores = np.unique(self.scores)
+        thresholds = np.concatenate([[np.nextafter(distinct_scores[0], -np.inf)], distinct_scores])
+        tn, fp, fn, tp = self.confusion(thresholds)
+        scores = self.scores_at(thresholds)
+        fpr = safe_divide(fp, fp + tn)
+        tpr = scores['recall']
+        # the curves go from the lowest threshold (everybody is positive) to the highest one
+        roc_auc = float(np.sum(-np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+        average_precision = float(np.sum(-np.diff(tpr) * scores['precision'][:-1]))
+        sweep = {
+            'thresholds': thresholds.tolist(),
+            'tp': tp.tolist(),
+            'fp': fp.tolist(),
+            'tn': tn.tolist(),
+            'fn': fn.tolist(),
+            'fpr': fpr.tolist(),
+            'tpr': tpr.tolist(),
+            'roc_auc': roc_auc,
+            'average_precision': average_precision,
+        }
+        sweep.update({name: values.tolist() for name, values in scores.items()})
+        return sweep
+
+    def bootstrap(self, thresholds: list[float], n_resamples: int = 1000, confidence: float = 0.95,
+                  seed: int | None = None) -> list[dict]:
+        """
+        Returns the percentile bootstrap confidence intervals of the metrics for every threshold.
+        A resample of the clients with replacement only changes how many positive and negative clients fall
+        between the neighbouring thresholds, so the resamples are drawn as multinomial counts of these cells
+        instead of index matrices, and their cost does not depend on the number of clients.
+        All thresholds are measured on the same resamples
+        """
+        edges = np.unique(thresholds)
+        below = np.searchsorted(self.scores, edges, side='right')
+        # positive and negative clients in the cells (-inf, t1], (t1, t2], ..., (tn, inf) of the sorted thresholds
+        pos_cells = np.diff(np.concatenate([[0], self.cum_pos[below], [self.n_pos]]))
+        neg_cells = np.diff(np.concatenate([[0], self.cum_neg[below], [self.n_neg]]))
+        n_clients = self.n_pos + self.n_neg
+        cells = np.concatenate([pos_cells, neg_cells])
+        counts = np.random.default_rng(seed).multinomial(n_clients, cells / n_clients, size=n_resamples)
+        cum_pos = np.cumsum(counts[:, :len(pos_cells)], axis=1)
+        cum_neg = np.cumsum(counts[:, len(pos_cells):], axis=1)
+
+        tail = (1 - confidence) / 2
+        intervals = []
+        for threshold in thresholds:
+            cell = np.searchsorted(edges, threshold)
+            fn, tn = cum_pos[:, cell], cum_neg[:, cell]
+            scores = get_scores(tn, cum_neg[:, -1] - tn, fn, cum_pos[:, -1] - fn)
+            intervals.append({name: [round(float(bound), 4) for bound in np.quantile(values, [tail, 1 - tail])]
+                              for name, values in scores.items()})
+        return intervals
+
+    def profit_curve(self, call_cost: float, conversion_value: float) -> dict:
+        """
+        Returns the expected profit of calling the clients above every cut of the sorted predictions:
+        the value of every converted client minus the cost of every call. The thresholds lie halfway between
+        the neighbouring distinct predictions, so the same clients are called whether a probability is compared
+        with the threshold by > or by >=. The optimal threshold is the highest one of the largest profit
+        """
+        distinct_scores = np.unique(self.scores)
+        thresholds = np.concatenate([[np.nextafter(distinct_scores[0], -np.inf)],
+                                     (distinct_scores[1:] + distinct_scores[:-1]) / 2,
+                                     [np.nextafter(distinct_scores[-1], np.inf)]])
+        tn, fp, fn, tp = self.confusion(thresholds)
+        calls = tp + fp
+        profit = conversion_value * tp - call_cost * calls
+        best = len(profit) - 1 - int(np.argmax(profit[::-1]))
+        return {
+            'best_thr': float(thresholds[best]),
+            'profit': float(profit[best]),
+            'calls': int(calls[best]),
+            'conversions': int(tp[best]),
+            'curve': {
+                'thresholds': thresholds.tolist(),
+                'profit': profit.tolist(),
+                'calls': calls.tolist(),
+                'conversions': tp.tolist(),
+            },
+        }
+
+    def profit_at(self, threshold: float, call_cost: float, conversion_value: float) -> float:
+        """Returns the expected profit of calling the clients above the threshold"""
+        tn, fp, fn, tp = self.confusion(threshold)
+        return float(conversion_value * tp - call_cost * (tp + fp))
+
+
+def get_cached_metrics(model_type: str, version: str) -> ThresholdMetrics | None:
+    """Returns the cached metrics engine of the model if it was built for the version of the y table"""
+    cached = metrics_cache.get(model_type)
+    return cached[1] if cached and cached[0] == version else None
+
+
+def build_threshold_metrics(model_type: str, version: str, y_df: pd.DataFrame) -> ThresholdMetrics:
+    """Builds the metrics engine of the model from the y table frame and caches it with the version of the table"""
+    prediction_column = 'prediction_regular' if model_type == 'regular' else 'prediction_tuned'
+    engine = ThresholdMetrics(y_df['TARGET'].to_numpy(), y_df[prediction_column].to_numpy())
+    metrics_cache[model_type] = (version, engine)
+    return engine
+
+
+def get_threshold_metrics(db: Session, model_type: str) -> ThresholdMetrics:
+    """Returns the metrics engine of the model, it is rebuilt only when the version of the y table changes"""
+    table = TableY.__table__
+    version = get_table_version(db, table)
+    return get_cached_metrics(model_type, version) or build_threshold_metrics(model_type, version,
+                                                                              read_table_frame(db, table))
@@ -0,0 +1,126 @@
+"""
+This module contains the micro-batching of the concurrent single client predictions
+A single row is dominated by the overhead of the encoder, scaler and model calls, so predictions arriving together
+are queued per model version for a few milliseconds and scored with one vectorized call. The scoring thread
+dispatches a batch when it is full or its first prediction has waited long enough, every caller gets its own result
+"""
+
+from .imports import time, threading, np, Callable, Future, metrics_enabled
+from .observability import micro_batch_rows, micro_batch_queue_depth, micro_batch_wait_seconds
+
+
+class MicroBatcher:
+    """Scheduler collecting the single client predictions into batches per model type and version"""
+
+    def __init__(self, score: Callable[[list[dict], str, str], np.ndarray], max_wait_ms: float, max_batch_size: int):
+        """
+        :param score: function scoring a list of client dictionaries with the model type and version
+        :param max_wait_ms: longest time the first prediction of a batch waits for others
+        :param max_batch_size: number of the predictions dispatching the batch at once
+        """
+        self.score = score
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max(max_batch_size, 1)
+        self.condition = threading.Condition()
+        # (model type, version) -> (queued at, client, future) of the waiting predictions in the arrival order
+        self.queues: dict[tuple[str, str], list[tuple[float, dict, Future]]] = {}
+        self.thread = None
+        self.batches = 0
+        self.rows = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Batching is off when the predictions may not wait"""
+        return self.max_wait > 0 and self.max_batch_size > 1
+
+    def predict(self, client: dict, model_type: str, version: str) -> float:
+        """Queues the client and waits for its probability"""
+        return self.submit(client, model_type, version).result()
+
+    def submit(self, client: dict, model_type: str, version: str) -> Future:
+        """Queues the client for the next batch of the model version and returns the future of its probability"""
+        future = Future()
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+                self.thread.start()
+            queue_depth = sum(map(len, self.queues.values()))
+            self.queues.setdefault((model_type, version), []).append((time.perf_counter(), client, future))
+            self.condition.notify()
+        if metrics_enabled:
+            micro_batch_queue_depth.observe((), queue_depth)
+        return future
+
+    def take_ready(self) -> list[tuple[tuple[str, str], list]]:
+        """
+        Waits until a batch is full or its first prediction has waited the longest time and takes it from the queues.
+        Must be called with the condition held
+        """
+        while True:
+            now, deadline = time.perf_counter(), None
+            ready = []
+            for key, queue in self.queues.items():
+                if len(queue) >= self.max_batch_size or now - queue[0][0] >= self.max_wait:
+                    ready.append(key)
+                else:
+                    queue_deadline = queue[0][0] + self.max_wait
+                    deadline = queue_deadline if deadline is None else min(deadline, queue_deadline)
+            if ready:
+                batches = []
+                for key in ready:
+                    queue = self.queues[key]
+                    batches.append((key, queue[:self.max_batch_size]))
+                    del queue[:self.max_batch_size]
+                    if not queue:
+                        del self.queues[key]
+                return batches
+            self.condition.wait(None if deadline is None else deadline - now)
+
+    def run(self) -> None:
+        """Scores the ready batches one after another for the lifetime of the process"""
+        while True:
+            with self.condition:
+                batches = self.take_ready()
+            for (model_type, version), batch in batches:
+                if metrics_enabled:
+                    dispatched = time.perf_counter()
+                    micro_batch_rows.observe((), len(batch))
+                    for queued_at, _, _ in batch:
+                        micro_batch_wait_seconds.observe((), dispatched - queued_at)
+                self.score_batch(model_type, version, batch)
+
+    def score_batch(self, model_type: str, version: str, batch: list[tuple[float, dict, Future]]) -> None:
+        """
+        Scores the batch with one call and resolves the futures of the callers. If the batch fails,
+        its clients are scored one by one, so an invalid client fails only its own prediction
+        """
+        try:
+            preds = self.score([client for _, client, _ in batch], model_type, version)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            self.fallbacks += 1
+            for single in batch:
+                self.score_batch(model_type, version, [single])
+            return
+        self.batches += 1
+        self.rows += len(batch)
+        for (_, _, future), pred in zip(batch, preds):
+            future.set_result(float(pred))
+
+    def report(self) -> dict:
+        """Returns the settings, the queued predictions and the counters of the batches"""
+        with self.condition:
+            queued = sum(map(len, self.queues.values()))
+        return {
+            'enabled': self.enabled,
+            'max_wait_ms': 1000 * self.max_wait,
+            'max_batch_size': self.max_batch_size,
+            'queued': queued,
+            'batches': self.batches,
+            'rows': self.rows,
+            'avg_batch_size': round(self.rows / self.batches, 2) if self.batches else 0.0,
+            'fallbacks': self.fallbacks,
+        }
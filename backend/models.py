@@ -3,13 +3,20 @@ This module contains Models for database tables
 """
 
 from .db import Base
-from .imports import Mapped, mapped_column
+from .imports import Mapped, mapped_column, Index, BigInteger
 
 
 class TableClient(Base):
     """Model for Bank's clients table"""
     __tablename__ = "client"
-    __table_args__ = {"schema": "public"}
+    __table_args__ = (
+        # keyset pagination indexes: filtered column first, then the ID cursor
+        Index('ix_client_province_id', 'FACT_ADDRESS_PROVINCE', 'ID'),
+        Index('ix_client_industry_id', 'GEN_INDUSTRY', 'ID'),
+        Index('ix_client_target_id', 'TARGET', 'ID'),
+        Index('ix_client_age_id', 'AGE', 'ID'),
+        {"schema": "public"},
+    )
 
     ID: Mapped[int] = mapped_column(primary_key=True, name="ID")
     AGE: Mapped[int] = mapped_column(nullable=False, name='AGE')
@@ -47,6 +54,18 @@ class TableY(Base):
     prediction_tuned: Mapped[float] = mapped_column(nullable=False)
 
 
+class TableScoringState(Base):
+    """Model for the state of the materialized predictions: hash of the scored features and the scoring versions"""
+    __tablename__ = "y_scoring_state"
+    __table_args__ = {"schema": "public"}
+
+    ID: Mapped[int] = mapped_column(primary_key=True, name="ID")
+    features_hash: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    version_regular: Mapped[str] = mapped_column(nullable=False)
+    version_tuned: Mapped[str] = mapped_column(nullable=False)
+    scored_at: Mapped[float] = mapped_column(nullable=False)
+
+
 class SingleClientTable(Base):
     """Model for Bank's clients single table"""
     __tablename__ = "single_client"
@@ -82,3 +101,37 @@ class TableSelectedModel(Base):
 
     type_model: Mapped[str] = mapped_column(primary_key=True, name='model_type')
     threshold: Mapped[float] = mapped_column(nullable=False)
+
+
+class TableUserState(Base):
+    """Model for session-scoped state of the users keyed by the client token"""
+    __tablename__ = "user_state"
+    __table_args__ = {"schema": "public"}
+
+    token: Mapped[str] = mapped_column(primary_key=True)
+    type_model: Mapped[str] = mapped_column(nullable=False, name='model_type')
+    threshold: Mapped[float] = mapped_column(nullable=False)
+    single_client: Mapped[str | None] = mapped_column(nullable=True)
+    updated_at: Mapped[float] = mapped_column(nullable=False, index=True)
+
+
+class TableVersion(Base):
+    """Model for the write counters of the tables, a counter is bumped in the transaction of every bulk write"""
+    __tablename__ = "table_version"
+    __table_args__ = {"schema": "public"}
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+
+def create_indexes(bind) -> None:
+    """Creates the missing indexes of already existing tables, which Base.metadata.create_all skips"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+def init_schema(bind) -> None:
+    """Creates the missing tables and indexes of the application"""
+    Base.metadata.create_all(bind=bind)
+    create_indexes(bind=bind)
@@ -0,0 +1,200 @@
+"""
+This module contains Prometheus-style metrics of the backend: request counts and latencies per route,
+latencies of the prediction stages and of the database queries, sizes of the micro-batches of the predictions
+Metrics are kept in process and rendered in the Prometheus text format on the /metrics endpoint,
+every worker process exposes its own values
+"""
+
+from .imports import time, threading, event, contextmanager, Iterator, metrics_enabled
+
+# buckets of the request latencies in seconds
+request_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# buckets of the prediction stages and of the database queries, which take from microseconds to seconds
+stage_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# buckets of the sizes of the micro-batches and of the queue of the waiting predictions
+size_buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# first keywords of the statements used as the operation label of the query metrics
+query_operations = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'COPY', 'CREATE', 'TRUNCATE'}
+
+
+def format_labels(label_names: tuple[str, ...], label_values: tuple, extra: str = '') -> str:
+    """Formats the labels of a sample like {method="GET",route="/"}"""
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label(value) -> str:
+    """Escapes the backslashes, quotes and line breaks of the label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, label_values: tuple = (), amount: float = 1.0) -> None:
+        """Increases the counter of the labels"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        """Returns the lines of the counter in the text format"""
+        with self.lock:
+            values = dict(self.values)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{format_labels(self.label_names, labels)} {value}' for labels, value in values.items()]
+        return lines
+
+
+class Histogram:
+    """Histogram with cumulative buckets, sum and count per labels"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = request_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [counts of the buckets and of +Inf, sum of the observed values]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, label_values: tuple, value: float) -> None:
+        """Adds the observed value to the first bucket it fits and to the sum"""
+        position = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][position] += 1
+            counts[1] += value
+
+    def render(self) -> list[str]:
+        """Returns the lines of the histogram in the text format, bucket counts are cumulative"""
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names, labels, 'le="' + str(bound) + '"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+http_requests = Counter('http_requests_total', 'Number of the handled requests', ('method', 'route', 'status'))
+http_request_seconds = Histogram('http_request_duration_seconds', 'Latency of the requests',
+                                 ('method', 'route'), request_buckets)
+prediction_stage_seconds = Histogram('prediction_stage_duration_seconds',
+                                     'Latency of the prediction stages: fetch, encode, scale, predict, serialize',
+                                     ('stage',), stage_buckets)
+db_query_seconds = Histogram('db_query_duration_seconds', 'Latency of the database statements', ('operation',),
+                             stage_buckets)
+db_query_errors = Counter('db_query_errors_total', 'Number of the failed database statements', ('operation',))
+micro_batch_rows = Histogram('micro_batch_size', 'Number of the single client predictions scored together',
+                             (), size_buckets)
+micro_batch_queue_depth = Histogram('micro_batch_queue_depth', 'Number of the waiting single client predictions '
+                                    'when a prediction is queued', (), size_buckets)
+micro_batch_wait_seconds = Histogram('micro_batch_wait_seconds',
+                                     'Time a single client prediction waits for its batch', (), stage_buckets)
+
+metrics = [http_requests, http_request_seconds, prediction_stage_seconds, db_query_seconds, db_query_errors,
+           micro_batch_rows, micro_batch_queue_depth, micro_batch_wait_seconds]
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """Observes the duration of the block as the prediction stage"""
+    if not metrics_enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        prediction_stage_seconds.observe((stage,), time.perf_counter() - started)
+
+
+def get_query_operation(statement: str) -> str:
+    """Returns the first keyword of the statement or OTHER"""
+    keyword = statement.lstrip(' \n(').split(None, 1)[0].upper() if statement.strip() else ''
+    return keyword if keyword in query_operations else 'OTHER'
+
+
+def watch_queries(query_engine) -> None:
+    """Subscribes the query metrics to the statement events of the engine"""
+    if not metrics_enabled:
+        return
+
+    @event.listens_for(query_engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(query_engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info['query_started'].pop()
+        db_query_seconds.observe((get_query_operation(statement),), time.perf_counter() - started)
+
+    @event.listens_for(query_engine, 'handle_error')
+    def handle_error(exception_context):
+        started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+        if started:
+            started.pop()
+        db_query_errors.inc((get_query_operation(exception_context.statement or ''),))
+
+
+def observe_request(method: str, route: str, status_code: int, seconds: float) -> None:
+    """Counts the handled request and observes its latency"""
+    http_requests.inc((method, route, status_code))
+    http_request_seconds.observe((method, route), seconds)
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware counting the requests and observing their latency by the route template, so the labels stay
+    bounded. Unlike the http middleware of starlette it passes the receive channel through untouched,
+    so the streaming endpoints may read the request body while their response is being sent
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router keeps the matched route in the scope
+            route = scope.get('route')
+            observe_request(scope['method'], route.path if route is not None else 'unmatched', status_code,
+                            time.perf_counter() - started)
+
+
+def render_metrics() -> str:
+    """Renders all metrics in the Prometheus text format"""
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
@@ -0,0 +1,115 @@
+"""
+This module contains the cache of the single client predictions
+The frontend re-submits the same questionnaire on every rerun, so the probability is cached by a stable hash
+of the client features together with the model type and version. Entries of a model are dropped when a version
+of it is registered, activated or unloaded, so a refit or a swap never serves stale probabilities
+"""
+
+from .imports import sys, time, json, hashlib, threading, numbers, OrderedDict, client_features
+from .imports import prediction_cache_size, prediction_cache_bytes, prediction_cache_ttl
+from .registry import model_registry
+
+
+def get_client_hash(client: dict) -> str:
+    """
+    Returns the stable hash of the client features. Numbers are compared as floats, so 28 and 28.0
+    or NumPy integers read from the database give the same hash. The ID does not affect the prediction
+    and is not hashed
+    """
+    values = [float(value) if isinstance(value, numbers.Number) and not isinstance(value, bool) else value
+              for value in (client[column] for column in client_features)]
+    canonical = json.dumps(values, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class PredictionCache:
+    """LRU cache of the probabilities with a time to live and limits in entries and in estimated bytes"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (model type, version, client hash) -> (stored at, probability), the least recently used entries come first
+        self.entries: OrderedDict[tuple[str, str, str], tuple[float, float]] = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def get_entry_size(key: tuple[str, str, str]) -> int:
+        """Estimates the memory taken by the entry: its key, the stored pair and the dictionary slot"""
+        return sys.getsizeof(key) + sum(map(sys.getsizeof, key)) + 2 * sys.getsizeof(0.0) + 64
+
+    def get(self, key: tuple[str, str, str]) -> float | None:
+        """Returns the cached probability or None if it is missing or expired"""
+        if not self.max_entries:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time() - self.ttl:
+                self.remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple[str, str, str], probability: float) -> None:
+        """Stores the probability and evicts the least recently used entries above the limits"""
+        if not self.max_entries:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.time(), probability)
+            self.size_bytes += self.get_entry_size(key)
+            while self.entries and (len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key: tuple[str, str, str]) -> None:
+        """Removes the entry, the lock must be held by the caller"""
+        del self.entries[key]
+        self.size_bytes -= self.get_entry_size(key)
+
+    def invalidate(self, model_type: str) -> None:
+        """Drops the entries of the model type"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == model_type]:
+                self.remove(key)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        """Drops all entries, the counters are kept"""
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def report(self) -> dict:
+        """Returns the counters and the size of the cache"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / requests, 4) if requests else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+prediction_cache = PredictionCache(prediction_cache_size, prediction_cache_bytes, prediction_cache_ttl)
+model_registry.add_listener(prediction_cache.invalidate)
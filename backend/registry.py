@@ -0,0 +1,440 @@
+"""
+This module contains the registry of the versioned model artifacts
+A bundle keeps the encoder, the scaler and the model of a version together. The active version of every model type
+is swapped atomically behind a reference, so in-flight predictions finish with the bundle they have started with,
+and several versions may stay resident in memory for A/B scoring
+"""
+
+from .imports import os, re, time, json, pickle, threading, pd, np, clone, Pipeline, Callable, path, models_schema
+from .imports import client_features, fast_inference, lazy_models, active_refresh_seconds
+from .fast_inference import FastLogisticModel, compile_regular_model, compile_tuned_model, save_fast_model, \
+    load_fast_model
+from .observability import stage_timer
+
+# directory of the saved artifact bundles: fitted_models/<model type>/<version>.pickle
+versions_path = os.path.join(path, 'fitted_models', 'versions')
+
+# optimal thresholds set after the versions were fitted, e.g. by the profit optimization, keyed by "type/version"
+thresholds_path = os.path.join(versions_path, 'thresholds.json')
+
+# active versions of the model types, so every worker and a restarted app use the versions activated by any of them
+active_path = os.path.join(versions_path, 'active.json')
+
+# directory of the compiled models memory-mapped by the workers: fitted_models/compiled/<model type>/<version>
+compiled_path = os.path.join(path, 'fitted_models', 'compiled')
+
+# version of the artifacts the application was shipped with
+base_version = 'v1'
+
+# versions are named v1, v2, ... and are used in the file names of the saved bundles
+version_pattern = r'^v\d+$'
+
+
+class ModelBundle:
+    """Fitted artifacts of a single version of the model"""
+
+    def __init__(self, model_type: str, version: str, model=None, ohe_enc=None, scaler=None, best_thr: float = 0.5,
+                 params: str = '', created: float | None = None, loader: Callable[[], dict] | None = None,
+                 source_files: list[str] | None = None):
+        """
+        :param model_type: name of the model from models_schema
+        :param version: version of the artifacts unique for the model type
+        :param model: fitted model, the regular model is a pipeline with its own encoder
+        :param ohe_enc: fitted one-hot encoder of the tuned model
+        :param scaler: fitted scaler of the tuned model
+        :param best_thr: optimal threshold of the version
+        :param params: description of the model parameters
+        :param created: creation time of the version
+        :param loader: function returning the model, ohe_enc and scaler on their first use instead of the passed ones
+        :param source_files: files of the artifacts, the compiled model is cached on the disk while they are unchanged
+        """
+        self.model_type = model_type
+        self.version = version
+        self.best_thr = best_thr
+        self.params = params
+        self.created = time.time() if created is None else created
+        self.loader = loader
+        self.artifacts = None if loader else {'model': model, 'ohe_enc': ohe_enc, 'scaler': scaler}
+        self.source_files = source_files or []
+        self.compiled_model = None
+        # reentrant, because the compilation loads the artifacts of a lazy bundle under the same lock
+        self.lock = threading.RLock()
+
+    def get_artifacts(self) -> dict:
+        """Returns the model, ohe_enc and scaler artifacts, lazy bundles load them on the first call"""
+        if self.artifacts is None:
+            with self.lock:
+                if self.artifacts is None:
+                    self.artifacts = self.loader()
+        return self.artifacts
+
+    @property
+    def model(self):
+        return self.get_artifacts()['model']
+
+    @property
+    def ohe_enc(self):
+        return self.get_artifacts()['ohe_enc']
+
+    @property
+    def scaler(self):
+        return self.get_artifacts()['scaler']
+
+    @property
+    def fast_model(self) -> FastLogisticModel | None:
+        """Compiled model of the version or None if fast inference is off"""
+        if not fast_inference:
+            return None
+        if self.compiled_model is None:
+            with self.lock:
+                if self.compiled_model is None:
+                    self.compiled_model = self.load_compiled()
+        return self.compiled_model
+
+    def compile(self) -> FastLogisticModel:
+        """Compiles the artifacts of the version into the fast inference model"""
+        if self.model_type == 'regular':
+            return compile_regular_model(self.model)
+        return compile_tuned_model(self.ohe_enc, self.scaler, self.model)
+
+    def get_source(self) -> str:
+        """Returns the signature of the artifact files, it changes when any of them is replaced"""
+        return ';'.join(f'{os.path.basename(file_path)}:{os.stat(file_path).st_mtime_ns}:{os.stat(file_path).st_size}'
+                        for file_path in self.source_files)
+
+    def load_compiled(self) -> FastLogisticModel:
+        """
+        Loads the memory-mapped compiled model of the artifact files or compiles and caches it.
+        Versions fitted in memory have no artifact files and are compiled without caching
+        """
+        if not self.source_files:
+            return self.compile()
+        directory, source = os.path.join(compiled_path, self.model_type, self.version), self.get_source()
+        compiled_model = load_fast_model(directory, source)
+        if compiled_model is None:
+            save_fast_model(self.compile(), directory, source)
+            # the saved copy is loaded back, so the arrays are shared with the other workers through the page cache
+            compiled_model = load_fast_model(directory, source) or self.compile()
+        return compiled_model
+
+    def warm_up(self) -> None:
+        """Loads the artifacts and the compiled model ahead of the first prediction"""
+        self.get_artifacts()
+        _ = self.fast_model
+
+    def transform(self, clients_df: pd.DataFrame) -> pd.DataFrame:
+        """Transforms the client frame with the encoder and the scaler of the tuned model"""
+        with stage_timer('encode'):
+            clients_df_tuned = pd.DataFrame(self.ohe_enc.transform(clients_df))
+        with stage_timer('scale'):
+            return pd.DataFrame(self.scaler.transform(clients_df_tuned), columns=clients_df_tuned.columns,
+                                index=clients_df_tuned.index)
+
+    def predict_proba_frame(self, clients_df: pd.DataFrame) -> np.ndarray:
+        """Returns the probabilities of the positive class for the rows of a client dataframe"""
+        if self.fast_model is not None:
+            return self.fast_model.predict_proba_frame(clients_df)
+        if self.model_type == 'regular':
+            # the column transformer of the pipeline scales and encodes the columns in a single step
+            with stage_timer('encode'):
+                features = self.model[:-1].transform(clients_df)
+            with stage_timer('predict'):
+                return self.model[-1].predict_proba(features)[:, 1]
+        features = self.transform(clients_df)
+        with stage_timer('predict'):
+            return self.model.predict_proba(features)[:, 1]
+
+    def predict_proba_records(self, clients: list[dict]) -> np.ndarray | None:
+        """Returns the probabilities for a list of client dictionaries or None if the version is not compiled"""
+        if self.fast_model is None:
+            return None
+        return self.fast_model.predict_proba_records(clients)
+
+    def to_artifacts(self) -> dict:
+        """Returns the artifacts of the version to be pickled"""
+        return {'model': self.model, 'ohe_enc': self.ohe_enc, 'scaler': self.scaler, 'best_thr': self.best_thr,
+                'params': self.params, 'created': self.created}
+
+    def describe(self) -> dict:
+        """Returns the description of the version for the registry endpoints"""
+        return {'version': self.version, 'best_thr': self.best_thr, 'params': self.params, 'created': self.created,
+                'loaded': self.artifacts is not None, 'compiled': self.compiled_model is not None}
+
+
+def version_number(version: str) -> int:
+    """Returns the number of the version named like v12"""
+    number = version.lstrip('v')
+    return int(number) if number.isdigit() else 0
+
+
+def read_thresholds() -> dict[str, float]:
+    """Returns the optimal thresholds set after the fits of the versions"""
+    if not os.path.exists(thresholds_path):
+        return {}
+    with open(thresholds_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_active_versions() -> dict[str, str]:
+    """Returns the active versions kept on the disk"""
+    if not os.path.exists(active_path):
+        return {}
+    with open(active_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_file_signature(file_path: str) -> tuple[int, int] | None:
+    """Returns the modification time and the size of the file or None if it does not exist"""
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def load_pickle(file_name: str):
+    """Loads a pickled artifact from the fitted_models directory"""
+    with open(os.path.join(path, 'fitted_models', file_name), 'rb') as f:
+        return pickle.load(f)
+
+
+class ModelRegistry:
+    """Resident model bundles and the references to the active version of every model type"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (model type, version) -> bundle, the dictionary is replaced as a whole on every change
+        self.bundles: dict[tuple[str, str], ModelBundle] = {}
+        # model type -> active version, the dictionary is replaced as a whole on every change
+        self.active: dict[str, str] = {}
+        # versions given to the fits in progress
+        self.reserved: set[tuple[str, str]] = set()
+        # callbacks called with the model type after its versions are changed, e.g. to drop cached predictions
+        self.listeners: list[Callable[[str], None]] = []
+        # signature of the file of the active versions when it was read and the time of the last check
+        self.active_signature = None
+        self.active_checked = 0.0
+        self.sync_lock = threading.Lock()
+
+    def get(self, model_type: str, version: str | None = None) -> ModelBundle:
+        """Returns the resident bundle of the version or of the active version, the read does not take the lock"""
+        version = version or self.get_active_versions()[model_type]
+        bundle = self.bundles.get((model_type, version))
+        if bundle is None:
+            raise KeyError(f'Version {version} of the {model_type} model is not loaded')
+        return bundle
+
+    def get_active_versions(self) -> dict[str, str]:
+        """Returns the active versions after switching to the versions activated by the other processes"""
+        self.sync_active()
+        return self.active
+
+    def sync_active(self, force: bool = False) -> None:
+        """
+        Switches the model types to the versions of the active versions file when the file is changed.
+        The file is checked at most every active_refresh_seconds, a missing version is skipped
+        """
+        now = time.monotonic()
+        if not force and now - self.active_checked < active_refresh_seconds:
+            return
+        if not self.sync_lock.acquire(blocking=force):
+            return
+        try:
+            self.active_checked = now
+            signature = get_file_signature(active_path)
+            if signature == self.active_signature:
+                return
+            self.active_signature = signature
+            for model_type, version in read_active_versions().items():
+                if model_type in models_schema and self.active.get(model_type) != version:
+                    try:
+                        self.activate(model_type, version, persist=False)
+                    except KeyError:
+                        continue
+        finally:
+            self.sync_lock.release()
+
+    def get_best_thr(self, model_type: str) -> float:
+        """Returns the optimal threshold of the active version of the model"""
+        return self.get(model_type).best_thr
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """Subscribes the callback to the changes of the versions"""
+        self.listeners.append(listener)
+
+    def notify(self, model_type: str) -> None:
+        """Calls the listeners after the versions of the model type are changed"""
+        for listener in self.listeners:
+            listener(model_type)
+
+    def register(self, bundle: ModelBundle, activate: bool = False) -> None:
+        """Makes the bundle resident and optionally switches the model type to it"""
+        if not lazy_models:
+            bundle.warm_up()
+        with self.lock:
+            self.bundles = {**self.bundles, (bundle.model_type, bundle.version): bundle}
+            if activate:
+                self.active = {**self.active, bundle.model_type: bundle.version}
+        self.notify(bundle.model_type)
+
+    def load_base(self, model_type: str) -> ModelBundle:
+        """Prepares the bundle of the artifacts the application was shipped with, the pickles are loaded on first use"""
+        best_thr = read_thresholds().get(f'{model_type}/{base_version}', models_schema[model_type]['best_thr'])
+        params = models_schema[model_type]['params']
+        file_names = ['model_regular.pickle'] if model_type == 'regular' else \
+            ['model_tuned.pickle', 'ohe.pickle', 'scaler.pickle']
+
+        def load_artifacts() -> dict:
+            if model_type == 'regular':
+                return {'model': load_pickle('model_regular.pickle'), 'ohe_enc': None, 'scaler': None}
+            return {'model': load_pickle('model_tuned.pickle'), 'ohe_enc': load_pickle('ohe.pickle'),
+                    'scaler': load_pickle('scaler.pickle')}
+
+        return ModelBundle(model_type, base_version, best_thr=best_thr, params=params, created=0.0,
+                           loader=load_artifacts,
+                           source_files=[os.path.join(path, 'fitted_models', file_name) for file_name in file_names])
+
+    def load(self, model_type: str, version: str) -> ModelBundle:
+        """Loads the bundle of the version from the disk"""
+        if not re.match(version_pattern, version):
+            raise KeyError(f'Version {version} of the {model_type} model is not found')
+        if version == base_version:
+            return self.load_base(model_type)
+        file_path = os.path.join(versions_path, model_type, f'{version}.pickle')
+        if not os.path.exists(file_path):
+            raise KeyError(f'Version {version} of the {model_type} model is not found')
+        with open(file_path, 'rb') as f:
+            artifacts = pickle.load(f)
+        artifacts['best_thr'] = read_thresholds().get(f'{model_type}/{version}', artifacts['best_thr'])
+        return ModelBundle(model_type, version, **artifacts, source_files=[file_path])
+
+    def preload(self, model_type: str, version: str) -> ModelBundle:
+        """Makes the version resident and loaded without activating it, the loading is done outside the lock"""
+        bundle = self.bundles.get((model_type, version))
+        if bundle is None:
+            bundle = self.load(model_type, version)
+            self.register(bundle)
+        bundle.warm_up()
+        return bundle
+
+    def activate(self, model_type: str, version: str, persist: bool = True) -> ModelBundle:
+        """
+        Preloads the version if needed and atomically switches the model type to it.
+        The active versions are kept on the disk, so the other workers switch to the version on their next check
+        """
+        bundle = self.preload(model_type, version)
+        with self.lock:
+            self.active = {**self.active, model_type: version}
+            if persist:
+                active_versions = {**read_active_versions(), model_type: version}
+                os.makedirs(versions_path, exist_ok=True)
+                with open(active_path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(active_versions, f, indent=2)
+                os.replace(active_path + '.tmp', active_path)
+                self.active_signature = get_file_signature(active_path)
+        self.notify(model_type)
+        return bundle
+
+    def unload(self, model_type: str, version: str) -> None:
+        """Removes a resident inactive version from memory"""
+        with self.lock:
+            if self.active.get(model_type) == version:
+                raise ValueError(f'Version {version} of the {model_type} model is active')
+            self.bundles = {key: bundle for key, bundle in self.bundles.items() if key != (model_type, version)}
+        self.notify(model_type)
+
+    def set_best_thr(self, model_type: str, version: str, best_thr: float) -> None:
+        """
+        Sets the optimal threshold of a resident version and keeps it on the disk, so the version is loaded with it.
+        The pickles are not rewritten, the thresholds are kept in a separate file
+        """
+        bundle = self.get(model_type, version)
+        with self.lock:
+            thresholds = {**read_thresholds(), f'{model_type}/{version}': best_thr}
+            os.makedirs(versions_path, exist_ok=True)
+            with open(thresholds_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(thresholds, f, indent=2)
+            os.replace(thresholds_path + '.tmp', thresholds_path)
+            bundle.best_thr = best_thr
+
+    def saved_versions(self, model_type: str) -> list[str]:
+        """Returns the versions of the model available on the disk ordered by their number"""
+        model_path = os.path.join(versions_path, model_type)
+        versions = [file_name[:-len('.pickle')] for file_name in os.listdir(model_path)
+                    if file_name.endswith('.pickle')] if os.path.isdir(model_path) else []
+        return sorted({base_version, *versions}, key=version_number)
+
+    def reserve_version(self, model_type: str) -> str:
+        """Reserves the next free version number of the model for a new fit"""
+        with self.lock:
+            versions = self.saved_versions(model_type) + [version for (name, version) in {*self.bundles, *self.reserved}
+                                                          if name == model_type]
+            version = f'v{max(version_number(version) for version in versions) + 1}'
+            self.reserved.add((model_type, version))
+        return version
+
+    def release_version(self, model_type: str, version: str) -> None:
+        """Releases the reserved version after the fit is registered or failed"""
+        with self.lock:
+            self.reserved.discard((model_type, version))
+
+    def save(self, bundle: ModelBundle) -> None:
+        """Saves the artifacts of the bundle to the disk, the file is renamed into place when it is fully written"""
+        model_path = os.path.join(versions_path, bundle.model_type)
+        os.makedirs(model_path, exist_ok=True)
+        file_path = os.path.join(model_path, f'{bundle.version}.pickle')
+        with open(file_path + '.tmp', 'wb') as f:
+            pickle.dump(bundle.to_artifacts(), f)
+        os.replace(file_path + '.tmp', file_path)
+        bundle.source_files = [file_path]
+
+    def describe(self) -> dict:
+        """Returns the active, resident and saved versions of every model type"""
+        bundles, active = self.bundles, self.get_active_versions()
+        return {
+            model_type: {
+                'active': active.get(model_type),
+                'resident': [bundle.describe() for (name, _), bundle in bundles.items() if name == model_type],
+                'saved': self.saved_versions(model_type),
+            }
+            for model_type in models_schema
+        }
+
+
+def fit_model_artifacts(model_type: str, fit_df: pd.DataFrame, base_artifacts: dict,
+                        report: Callable[[float, str], None] | None = None) -> dict:
+    """
+    Fits unfitted copies of the base version artifacts on the clients dataframe with the TARGET column.
+    The regular pipeline keeps the fitted column encoder and polynomial features of the base version and refits
+    its final estimator, the tuned model reuses the fitted encoder of the base version and fits its own scaler
+
+    :param base_artifacts: artifacts of the version the new one is based on
+    :param report: callback receiving the progress share and the name of the stage
+    :return: artifacts of the new version
+    """
+    report = report or (lambda progress, stage: None)
+    X, y = fit_df[client_features], fit_df['TARGET']
+    artifacts = {**base_artifacts, 'created': None}
+    if model_type == 'regular':
+        report(0.1, 'encoding')
+        X_encoded = base_artifacts['model'][:-1].transform(X)
+        report(0.3, 'fitting model')
+        *encoder_steps, (model_name, model) = base_artifacts['model'].steps
+        artifacts['model'] = Pipeline([*encoder_steps, (model_name, clone(model).fit(X_encoded, y))])
+    else:
+        report(0.1, 'encoding')
+        X_encoded = pd.DataFrame(base_artifacts['ohe_enc'].transform(X))
+        report(0.3, 'fitting scaler')
+        artifacts['scaler'] = clone(base_artifacts['scaler']).fit(X_encoded)
+        X_scaled = pd.DataFrame(artifacts['scaler'].transform(X_encoded), columns=X_encoded.columns,
+                                index=X_encoded.index)
+        report(0.4, 'fitting model')
+        artifacts['model'] = clone(base_artifacts['model']).fit(X_scaled, y)
+    report(1.0, 'fitted')
+    return artifacts
+
+
+model_registry = ModelRegistry()
+for registry_model_type in models_schema:
+    model_registry.register(model_registry.load_base(registry_model_type), activate=True)
+model_registry.sync_active(force=True)
@@ -0,0 +1,107 @@
+"""
+This module contains the re-scoring of the client table into the materialized predictions of the y table
+The client table is scanned in keyset pages, a row is scored again only if its features or TARGET changed
+or the active version of a model differs from the version it was scored with. The hashes of the scored rows
+and the versions are kept in the y_scoring_state table, so refreshes after a refit or an ingestion are incremental
+"""
+
+from .imports import time, np, pd, Callable, select, client_features
+from .db import engine
+from .models import TableClient, TableY, TableScoringState
+from .registry import model_registry
+from .ingest import create_staging_table, write_chunk
+from .training import count_clients
+
+
+def get_features_hash(clients_df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns the 64-bit hashes of the feature rows as signed integers, which fit the BIGINT column.
+    TARGET is hashed together with the features, as it is copied into the y table with the predictions
+    """
+    return pd.util.hash_pandas_object(clients_df[client_features + ['TARGET']], index=False).to_numpy() \
+        .view(np.int64)
+
+
+def read_clients_page(connection, after_id: int | None, limit: int) -> pd.DataFrame:
+    """Reads the next page of the client table ordered by ID with keyset pagination"""
+    table = TableClient.__table__
+    query = select(*(table.c[column] for column in ['ID', 'TARGET'] + client_features)).order_by(table.c.ID)
+    if after_id is not None:
+        query = query.where(table.c.ID > after_id)
+    result = connection.execute(query.limit(limit))
+    return pd.DataFrame(result.all(), columns=[str(column) for column in result.keys()])
+
+
+def read_scoring_state(connection, first_id: int, last_id: int) -> pd.DataFrame:
+    """Reads the scoring state of the IDs range of the chunk, the rows are looked up by the primary key"""
+    table = TableScoringState.__table__
+    result = connection.execute(select(table).where(table.c.ID.between(first_id, last_id)))
+    return pd.DataFrame(result.all(), columns=[str(column) for column in result.keys()]).set_index('ID')
+
+
+def get_stale_rows(chunk_df: pd.DataFrame, state_df: pd.DataFrame, features_hash: np.ndarray,
+                   versions: dict[str, str]) -> np.ndarray:
+    """Returns the mask of the rows never scored, with changed features or TARGET or scored with another version"""
+    ids = chunk_df['ID'].to_numpy()
+    # known rows are selected without reindexing, which would turn the hashes into floats losing their precision
+    known = np.isin(ids, state_df.index.to_numpy())
+    known_df = state_df.loc[ids[known]]
+    stale = ~known
+    stale_known = known_df['features_hash'].to_numpy() != features_hash[known]
+    for model_type, version in versions.items():
+        stale_known |= known_df[f'version_{model_type}'].to_numpy() != version
+    stale[known] = stale_known
+    return stale
+
+
+def rescore_predictions(versions: dict[str, str] | None = None, full: bool = False, chunk_size: int = 10_000,
+                        report: Callable[..., None] | None = None) -> dict:
+    """
+    Scores the stale rows of the client table with the model versions and upserts the predictions into the y table.
+    Every chunk is written in its own transaction, so an interrupted run keeps the scored chunks
+
+    :param versions: model type -> version, the active versions are used for the missing model types
+    :param full: score all rows regardless of the scoring state
+    :param chunk_size: number of client rows read and scored at a time
+    :param report: callback receiving the progress share, the name of the stage and the statistics
+    :return: summary of the run
+    """
+    report = report or (lambda progress, stage, **stats: None)
+    # the active versions are read from the disk, so a CLI run uses the versions activated through the app
+    model_registry.sync_active(force=True)
+    versions = {**model_registry.active, **(versions or {})}
+    bundles = {model_type: model_registry.preload(model_type, version) for model_type, version in versions.items()}
+    total_rows = count_clients()
+    rows_scanned, rows_scored, started = 0, 0, time.perf_counter()
+
+    after_id = None
+    while True:
+        # the page is read in the transaction writing its predictions, a cursor kept open over the whole table
+        # would hold the table between the transactions of the chunks
+        with engine.begin() as connection:
+            chunk_df = read_clients_page(connection, after_id, chunk_size)
+            if chunk_df.empty:
+                break
+            after_id = int(chunk_df['ID'].iloc[-1])
+            rows_scanned += len(chunk_df)
+            features_hash = get_features_hash(chunk_df)
+            if not full:
+                state_df = read_scoring_state(connection, int(chunk_df['ID'].iloc[0]), after_id)
+                stale = get_stale_rows(chunk_df, state_df, features_hash, versions)
+                chunk_df, features_hash = chunk_df[stale], features_hash[stale]
+            if len(chunk_df):
+                y_df = pd.DataFrame({'ID': chunk_df['ID'].to_numpy(), 'TARGET': chunk_df['TARGET'].to_numpy()})
+                for model_type, bundle in bundles.items():
+                    y_df[f'prediction_{model_type}'] = bundle.predict_proba_frame(chunk_df[client_features])
+                version_columns = {f'version_{model_type}': version for model_type, version in versions.items()}
+                state_df = pd.DataFrame({'ID': y_df['ID'], 'features_hash': features_hash, **version_columns,
+                                         'scored_at': time.time()})
+                for table, table_df in ((TableY.__table__, y_df), (TableScoringState.__table__, state_df)):
+                    write_chunk(connection, table, table_df, True, create_staging_table(connection, table))
+        rows_scored += len(chunk_df)
+        elapsed = time.perf_counter() - started
+        report(rows_scanned / max(total_rows, 1), 'scoring', rows_scanned=rows_scanned, rows_scored=rows_scored,
+               rows_per_sec=round(rows_scanned / elapsed, 1) if elapsed else None)
+
+    return {'versions': versions, 'full': full, 'rows_scanned': rows_scanned, 'rows_scored': rows_scored,
+            'seconds': round(time.perf_counter() - started, 3)}
@@ -11,6 +11,32 @@ class ModelNames(str, Enum):
     TUNED = "tuned"
 
 
+class ExportFormats(str, Enum):
+    """"Enum Class, contains the available formats of the bulk tables export"""
+    ARROW = 'arrow'
+    PARQUET = 'parquet'
+    JSON = 'json'
+
+
+class IngestTables(str, Enum):
+    """"Enum Class, contains the tables accepting the bulk ingestion"""
+    CLIENT = 'client'
+    Y = 'y'
+
+
+class IngestFormats(str, Enum):
+    """"Enum Class, contains the available formats of the bulk ingestion files"""
+    CSV = 'csv'
+    PARQUET = 'parquet'
+    NDJSON = 'ndjson'
+
+
+class LeadSegments(str, Enum):
+    """"Enum Class, contains the client columns the leads quota is applied to"""
+    PROVINCE = 'province'
+    INDUSTRY = 'industry'
+
+
 class Client(BaseModel):
     """Client table data schema for Pydantic model"""
     ID: int
@@ -2,115 +2,108 @@
 This module contains functions for working with FastApi endpoints
 """
 
-from .imports import pd, json, requests, StringIO, Any
-from .imports import accuracy_score, precision_score, recall_score, f1_score
-from .imports import ohe_enc, scaler, model_regular, model_tuned
+from .imports import pd, np, Iterable, Iterator, client_features, micro_batch_wait_ms, micro_batch_size
+from .registry import model_registry
+from .prediction_cache import prediction_cache, get_client_hash
+from .observability import stage_timer
+from .micro_batching import MicroBatcher
 
-api_url = "https://bank-clients.onrender.com/"
 
-
-def get_df_from_handlers_response(handler: str) -> pd.DataFrame:
-    """Converts json received from API to dataframe"""
-    handler_url = f"{api_url}get/{handler}"
-    response = requests.get(handler_url).json()
-    json_dump = json.dumps(response)
-    df = pd.read_json(StringIO(json_dump))
-    return df
-
-
-def get_targets_df() -> tuple[Any, pd.DataFrame, pd.DataFrame]:
-    """Converts different targets json received from API to different dataframes"""
-    all_df = get_df_from_handlers_response(handler="targets")
-    y_test = all_df['TARGET']
-    prediction_regular = pd.DataFrame({'predictions': all_df['prediction_regular'].tolist()}, index=all_df.ID)
-    prediction_tuned = pd.DataFrame({'predictions': all_df['prediction_tuned'].tolist()}, index=all_df.ID)
-    return y_test, prediction_regular, prediction_tuned
-
-
-def get_single_frame() -> pd.DataFrame:
-    """Gets a record of the selected dataframe from the temporary database"""
-    df = get_df_from_handlers_response(handler="single_df")
-    return df
-
-
-def get_user_choise() -> dict:
-    """Gets a record of the current user's selections from the database"""
-    handler_url = f"{api_url}get/selected"
-    response = requests.get(handler_url).json()
-    return response
-
-
-def get_user_selection():
-    """Gets a advanced version of the current user's selections from the database"""
-    user_selections = get_user_choise()
-    model_type = user_selections['type_model']
-    threshold = user_selections['threshold']
-
-    model_params = get_single_model_params_dict(model_type)
-    best_thr = list(model_params.values())[0]['best_thr']
-    return model_type, threshold, best_thr
-
-
-def get_metrics_score(y_test, y_pred) -> dict:
+def get_single_prediction(single_client: dict, threshhold: float, best_thr: float, model_type,
+                          version: str | None = None) -> tuple[float, bool, bool]:
     """
-    Computes quality metrics for the passed true class values and their predictions, and stores them in a dictionary
-
-    :param y_test: pandas.series containing test values of targets
-    :param y_pred: pandas.series containing predictions  of targets
-    :return: a dictionary of quality metrics
+    Applies trained classification models to a single user's data, organized as a dictionary, and returns a
+    prediction. Depending on the model type, different preprocessing of the dataset is performed.
+    The probability is cached by the client features and the model version, so repeated questionnaires are not scored.
+    Concurrent misses are scored together by the micro-batcher
     """
+    bundle = model_registry.get(model_type, version)
+    cache_key = (model_type, bundle.version, get_client_hash(single_client))
+    single_pred_positive = prediction_cache.get(cache_key)
+    if single_pred_positive is None:
+        if micro_batcher.enabled:
+            single_pred_positive = micro_batcher.predict(single_client, model_type, bundle.version)
+        else:
+            single_pred_positive = float(get_records_prediction([single_client], model_type, bundle.version)[0])
+        prediction_cache.put(cache_key, single_pred_positive)
+    is_recommend_thr = single_pred_positive >= threshhold
+    is_recommend_best_thr = single_pred_positive >= best_thr
 
-    accuracy = round(accuracy_score(y_test, y_pred), 4)
-    precision = round(precision_score(y_test, y_pred), 4)
-    recall = round(recall_score(y_test, y_pred), 4)
-    f1 = round(f1_score(y_test, y_pred), 4)
-    return {'accuracy': accuracy, 'precision': precision, 'recall': recall, 'f1': f1}
+    return single_pred_positive, is_recommend_thr, is_recommend_best_thr
 
 
-def get_metrics_score_thr() -> dict:
+def get_batch_prediction(clients_df: pd.DataFrame, model_type: str, version: str | None = None) -> np.ndarray:
     """
-    Computes a set of metrics for the optimal and user thresholds, returns dictionaries of the computed metrics
+    Applies the ohe_enc -> scaler -> model chain of the model version (the active one by default) once
+    to the whole batch of clients and returns the probabilities of the positive class in the order of the rows
     """
-    model_type, threshold, best_thr = get_user_selection()
-    y_test, prediction_regular, prediction_tuned = get_targets_df()
-    pred_probability = prediction_regular if model_type == 'regular' else prediction_tuned
-    y_thr = pred_probability > threshold
-    y_best_thr = pred_probability > best_thr
-    metrics = {'user': get_metrics_score(y_test, y_thr), 'best': get_metrics_score(y_test, y_best_thr)}
-    return metrics
+    return model_registry.get(model_type, version).predict_proba_frame(clients_df)
 
 
-def transform_df_regular_to_tuned(single_df_regular: pd.DataFrame) -> pd.DataFrame:
+def get_records_prediction(clients: list[dict], model_type: str, version: str | None = None) -> np.ndarray:
     """
-    Transform the frame to the required format for the piplane of the customized logistic regression model
+    Returns the probabilities of the positive class for a list of client dictionaries.
+    The compiled model scores the dictionaries directly, otherwise they are collected into a dataframe
     """
-    single_df_tuned = pd.DataFrame(ohe_enc.transform(single_df_regular))
-    single_df_tuned = pd.DataFrame(scaler.transform(single_df_tuned), columns=single_df_tuned.columns,
-                                   index=single_df_tuned.index)
-    return single_df_tuned
+    bundle = model_registry.get(model_type, version)
+    preds = bundle.predict_proba_records(clients)
+    if preds is None:
+        preds = bundle.predict_proba_frame(pd.DataFrame.from_records(clients, columns=client_features))
+    return preds
 
 
-def get_single_prediction(single_df: pd.DataFrame, threshhold: float, best_thr: float, model_type) -> \
-        tuple[float, bool, bool]:
+def get_batch_predictions_chunked(clients: Iterable[dict], model_type: str, threshold: float, best_thr: float,
+                                  chunk_size: int, version: str | None = None) -> Iterator[list[dict]]:
     """
-    Applies trained classification models to a single user's data, organized as a dataframe, and returns a
-    prediction. Depending on the model type, different preprocessing of the dataset is performed.
+    Scores an iterable of client dictionaries chunk by chunk, so that only one chunk is held as a dataframe at a time.
+    Yields lists of prediction records for every scored chunk.
+
+    :param clients: iterable of dictionaries with the ClientShort fields
+    :param model_type: name of the model from models_schema
+    :param threshold: user threshold for the recommendation flag
+    :param best_thr: optimal threshold of the model for the recommendation flag
+    :param chunk_size: maximum number of clients scored with a single vectorized call
+    :param version: version of the model, the active one by default
     """
+    chunk = []
+    for client in clients:
+        chunk.append(client)
+        if len(chunk) == chunk_size:
+            yield get_chunk_predictions(chunk, model_type, threshold, best_thr, version)
+            chunk = []
+    if chunk:
+        yield get_chunk_predictions(chunk, model_type, threshold, best_thr, version)
+
+
+def get_chunk_predictions(chunk: list[dict], model_type: str, threshold: float, best_thr: float,
+                          version: str | None = None) -> list[dict]:
+    """Scores a single chunk of client dictionaries and builds prediction records for it"""
+    preds = get_records_prediction(chunk, model_type, version)
+    with stage_timer('serialize'):
+        return [
+            {
+                'ID': int(client_id),
+                'pred': float(pred),
+                'is_recommend_thr': int(pred >= threshold),
+                'is_recommend_best_thr': int(pred >= best_thr),
+            }
+            for client_id, pred in zip((client['ID'] for client in chunk), preds)
+        ]
+
+
+def find_unscorable_client(chunk: list[dict], model_type: str, version: str | None = None) -> tuple[int, str] | None:
+    """
+    Scores the clients of a failed chunk one by one to find the client the model can not score,
+    e.g. with a category unknown to the encoder
 
-    if model_type == 'regular':
-        predict_model = model_regular
-        single_pred_positive = predict_model.predict_proba(single_df)[:, 1][0]
-    else:
-        predict_model = model_tuned
-        single_pred_positive = predict_model.predict_proba(single_df)[:, 1][0]
-    is_recommend_thr = single_pred_positive >= threshhold
-    is_recommend_best_thr = single_pred_positive >= best_thr
-
-    return single_pred_positive, is_recommend_thr, is_recommend_best_thr
+    :return: position of the first such client in the chunk and the error message or None if all of them are scored
+    """
+    for index, client in enumerate(chunk):
+        try:
+            get_records_prediction([client], model_type, version)
+        except ValueError as e:
+            return index, str(e)
+    return None
 
 
-def get_single_model_params_dict(model_name: str) -> dict:
-    """Fetches the parameters of a specific model from the database"""
-    handler_url = f"{api_url}{model_name}/params"
-    model_params_dict = requests.get(handler_url).json()
-    return model_params_dict
+micro_batcher = MicroBatcher(get_records_prediction, micro_batch_wait_ms, micro_batch_size)
@@ -0,0 +1,150 @@
+"""
+This module contains in-process services for FastApi endpoints
+Services read the application state directly through the database session instead of calling the API over HTTP
+"""
+
+from .imports import pd, Session, select, client_features
+from .models import TableClient, SingleClientTable, TableSelectedModel
+from .scripts import get_single_prediction
+from .registry import model_registry
+from .metrics import ThresholdMetrics, get_threshold_metrics
+from .user_state import get_user_state
+from .observability import stage_timer
+
+
+def get_user_selection(db: Session, token: str | None = None) -> tuple[str, float, float]:
+    """
+    Gets the current user's selected model, threshold and the optimal threshold of the selected model.
+    The selection of the token's session is used when the token is passed, otherwise the shared one
+    """
+    if token is not None:
+        user_state = get_user_state(db, token)
+        model_type, threshold = user_state['type_model'], user_state['threshold']
+    else:
+        user_selections = db.query(TableSelectedModel).first()
+        model_type, threshold = user_selections.type_model, user_selections.threshold
+    best_thr = model_registry.get_best_thr(model_type)
+    return model_type, threshold, best_thr
+
+
+def get_single_frame(db: Session, token: str | None = None) -> pd.DataFrame:
+    """Gets the single client of the token's session or the shared single client table as a dataframe indexed by ID"""
+    columns = ['ID'] + client_features
+    if token is not None:
+        single_client = get_user_state(db, token)['single_client']
+        single_df = pd.DataFrame([single_client] if single_client else [], columns=columns)
+    else:
+        query = select(*(SingleClientTable.__table__.c[column] for column in columns))
+        single_df = pd.DataFrame(db.execute(query).all(), columns=columns)
+    return single_df.set_index('ID')
+
+
+def get_metrics_score_thr(db: Session, token: str | None = None, ci: bool = False, n_resamples: int = 1000,
+                          confidence: float = 0.95, seed: int | None = None) -> dict:
+    """
+    Computes a set of metrics for the optimal and user thresholds, returns dictionaries of the computed metrics.
+    With ci the bootstrap confidence intervals of the metrics are returned under the ci key
+    """
+    model_type, threshold, best_thr = get_user_selection(db, token)
+    return get_threshold_scores(get_threshold_metrics(db, model_type), threshold, best_thr, ci, n_resamples,
+                                confidence, seed)
+
+
+def get_threshold_scores(metrics_engine: ThresholdMetrics, threshold: float, best_thr: float, ci: bool = False,
+                         n_resamples: int = 1000, confidence: float = 0.95, seed: int | None = None) -> dict:
+    """Computes the metrics of the user and optimal thresholds and optionally their bootstrap confidence intervals"""
+    metrics = {'user': metrics_engine.metrics(threshold), 'best': metrics_engine.metrics(best_thr)}
+    if ci:
+        user_ci, best_ci = metrics_engine.bootstrap([threshold, best_thr], n_resamples, confidence, seed)
+        metrics['ci'] = {'user': user_ci, 'best': best_ci, 'confidence': confidence, 'n_resamples': n_resamples}
+    return metrics
+
+
+def get_confusion_matrices(db: Session, token: str | None = None) -> dict:
+    """Computes confusion matrices for the optimal and user thresholds of the selected model"""
+    model_type, threshold, best_thr = get_user_selection(db, token)
+    return get_threshold_matrices(get_threshold_metrics(db, model_type), threshold, best_thr)
+
+
+def get_threshold_matrices(metrics_engine: ThresholdMetrics, threshold: float, best_thr: float) -> dict:
+    """Returns the confusion matrices of the user and optimal thresholds"""
+    return {'user': metrics_engine.confusion_matrix(threshold), 'best': metrics_engine.confusion_matrix(best_thr)}
+
+
+def get_threshold_profits(db: Session, model_types: list[str], call_cost: float, conversion_value: float,
+                          persist: bool = False, with_curve: bool = True) -> dict:
+    """
+    Finds the thresholds of the largest expected profit over the stored predictions of the models
+    and compares them with the current optimal thresholds
+
+    :param model_types: names of the models from models_schema
+    :param call_cost: cost of a single call of the call center
+    :param conversion_value: value of a converted client
+    :param persist: set the found thresholds as the optimal thresholds of the active versions
+    :param with_curve: return the profit at every threshold
+    :return: model type -> optimal threshold, its profit, calls and conversions, and the profit curve
+    """
+    profits = {}
+    for model_type in model_types:
+        metrics_engine = get_threshold_metrics(db, model_type)
+        bundle = model_registry.get(model_type)
+        profit = metrics_engine.profit_curve(call_cost, conversion_value)
+        profit['version'] = bundle.version
+        profit['current_thr'] = bundle.best_thr
+        profit['current_profit'] = metrics_engine.profit_at(bundle.best_thr, call_cost, conversion_value)
+        if persist:
+            model_registry.set_best_thr(model_type, bundle.version, profit['best_thr'])
+        profit['persisted'] = persist
+        if not with_curve:
+            del profit['curve']
+        profits[model_type] = profit
+    return profits
+
+
+def get_client_prediction(single_client: dict, model_type: str, threshold: float, best_thr: float,
+                          version: str | None = None) -> dict:
+    """Scores a single client dictionary and builds the answer dictionary for the prediction endpoints"""
+    single_pred, is_recommend_thr, is_recommend_best_thr = get_single_prediction(single_client, threshold,
+                                                                                 best_thr, model_type, version)
+    with stage_timer('serialize'):
+        answers_dict = {
+            'single_pred': float(single_pred),
+            'is_recommend_thr': int(is_recommend_thr),
+            'is_recommend_best_thr': int(is_recommend_best_thr)
+        }
+    return answers_dict
+
+
+def get_clients_page(db: Session, fields: list[str], after_id: int | None, limit: int, provinces: list[str] | None,
+                     industries: list[str] | None, age_min: int | None, age_max: int | None,
+                     target: int | None) -> dict:
+    """
+    Gets a page of clients ordered by ID with keyset pagination: the page starts after the passed ID cursor.
+    Filters and the projection are applied by the database, so the cost depends on the page size only
+
+    :param fields: columns of the client table to return, ID is always returned
+    :param after_id: ID of the last client of the previous page
+    :param limit: maximum number of clients on the page
+    :return: dictionary with the page items and the cursor of the next page (None for the last page)
+    """
+    table = TableClient.__table__
+    columns = ['ID'] + [field for field in fields if field != 'ID']
+    query = select(*(table.c[column] for column in columns))
+    if after_id is not None:
+        query = query.where(table.c.ID > after_id)
+    if provinces:
+        query = query.where(table.c.FACT_ADDRESS_PROVINCE.in_(provinces))
+    if industries:
+        query = query.where(table.c.GEN_INDUSTRY.in_(industries))
+    if age_min is not None:
+        query = query.where(table.c.AGE >= age_min)
+    if age_max is not None:
+        query = query.where(table.c.AGE <= age_max)
+    if target is not None:
+        query = query.where(table.c.TARGET == target)
+
+    # one extra row tells whether the next page exists
+    rows = db.execute(query.order_by(table.c.ID).limit(limit + 1)).all()
+    items = [dict(zip(columns, row)) for row in rows[:limit]]
+    next_cursor = items[-1]['ID'] if len(rows) > limit else None
+    return {'items': items, 'next_cursor': next_cursor}
@@ -0,0 +1,49 @@
+"""
+This module contains the startup statistics of the worker process: time since the process start and memory usage
+Values are read from /proc, so they are None on systems without it
+"""
+
+from .imports import os, time, logging
+
+# process id of the worker and its age when the app module was imported and when the startup hook finished
+startup_stats = {'pid': os.getpid(), 'import_seconds': None, 'startup_seconds': None, 'schema_seconds': None}
+
+
+def get_process_age() -> float | None:
+    """Returns the seconds since the start of the current process"""
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name in brackets may contain spaces, the start time is the 22nd field
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 3)
+
+
+def get_memory_usage() -> dict:
+    """Returns the current and the peak resident set size of the current process in megabytes"""
+    usage = {'rss_mb': None, 'peak_rss_mb': None}
+    try:
+        with open('/proc/self/status') as f:
+            lines = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return usage
+    for key, field in (('rss_mb', 'VmRSS'), ('peak_rss_mb', 'VmHWM')):
+        if field in lines:
+            usage[key] = round(int(lines[field].split()[0]) / 1024, 1)
+    return usage
+
+
+def record_stage(stage: str, started: float | None = None) -> None:
+    """Records the process age at the end of the stage or the duration of the stage started at the passed time"""
+    startup_stats[f'{stage}_seconds'] = round(time.perf_counter() - started, 3) if started is not None \
+        else get_process_age()
+
+
+def log_startup_stats() -> None:
+    """Writes the startup statistics of the worker to the uvicorn log"""
+    stats = {**startup_stats, **get_memory_usage()}
+    logging.getLogger('uvicorn.error').info('Worker startup: ' + ', '.join(f'{key}={value}'
+                                                                           for key, value in stats.items()))
@@ -0,0 +1,88 @@
+"""
+This module contains incremental training of the models straight from the client table
+The table is read with a server-side cursor chunk by chunk, the scaler and the SGD logistic regression
+are fitted with partial_fit, so the training memory depends on the chunk size and not on the table size
+"""
+
+from .imports import time, np, pd, clone, Pipeline, SGDClassifier, Callable, Iterator, select, func, client_features
+from .db import engine
+from .models import TableClient
+
+
+def iter_client_chunks(chunk_size: int, columns: list[str] | None = None) -> Iterator[pd.DataFrame]:
+    """Reads the columns of the client table (the features and the target by default) in chunks ordered by ID"""
+    table = TableClient.__table__
+    columns = columns or client_features + ['TARGET']
+    query = select(*(table.c[column] for column in columns)).order_by(table.c.ID)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+        for partition in result.partitions():
+            yield pd.DataFrame(partition, columns=columns)
+
+
+def count_clients() -> int:
+    """Counts the rows of the client table"""
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(TableClient.__table__)).scalar_one()
+
+
+def fit_model_artifacts_streaming(model_type: str, base_artifacts: dict, chunk_size: int, epochs: int, alpha: float,
+                                  report: Callable[..., None] | None = None) -> dict:
+    """
+    Fits a SGD logistic regression with partial_fit on the chunks of the client table.
+    The regular model keeps the fitted column encoder and polynomial features of the base pipeline,
+    the tuned model keeps the fitted one-hot encoder and fits its scaler incrementally with an extra pass
+
+    :param base_artifacts: artifacts of the version the new one is based on
+    :param chunk_size: number of rows read and fitted at a time
+    :param epochs: number of passes over the table for the model
+    :param alpha: regularization strength of the SGD logistic regression
+    :param report: callback receiving the progress share, the name of the stage and the throughput statistics
+    :return: artifacts of the new version
+    """
+    report = report or (lambda progress, stage, **stats: None)
+    rng = np.random.default_rng(0)
+    # averaged SGD keeps the coefficients stable between the chunks of the table ordered by ID
+    model = SGDClassifier(loss='log_loss', alpha=alpha, average=True, random_state=0)
+    params = f'SGD log_loss, alpha={alpha}, epochs={epochs}, averaged'
+    artifacts = {**base_artifacts, 'created': None, 'params': params}
+
+    if model_type == 'regular':
+        encoder = base_artifacts['model'][:-1]
+
+        def transform(chunk_df: pd.DataFrame) -> np.ndarray:
+            return encoder.transform(chunk_df[client_features])
+    else:
+        ohe_enc, scaler = base_artifacts['ohe_enc'], clone(base_artifacts['scaler'])
+
+        def transform(chunk_df: pd.DataFrame) -> pd.DataFrame:
+            encoded_df = pd.DataFrame(ohe_enc.transform(chunk_df[client_features]))
+            return pd.DataFrame(scaler.transform(encoded_df), columns=encoded_df.columns)
+
+    total_rows = count_clients()
+    passes = epochs + (model_type != 'regular')
+    rows_done, started = 0, time.perf_counter()
+
+    def report_chunk(stage: str, rows: int) -> None:
+        nonlocal rows_done
+        rows_done += rows
+        elapsed = time.perf_counter() - started
+        report(rows_done / max(total_rows * passes, 1), stage, rows_processed=rows_done,
+               rows_per_sec=round(rows_done / elapsed, 1) if elapsed else None)
+
+    if model_type != 'regular':
+        for chunk_df in iter_client_chunks(chunk_size):
+            scaler.partial_fit(pd.DataFrame(ohe_enc.transform(chunk_df[client_features])))
+            report_chunk('fitting scaler', len(chunk_df))
+        artifacts['scaler'] = scaler
+
+    for epoch in range(epochs):
+        for chunk_df in iter_client_chunks(chunk_size):
+            # rows are read in the ID order, they are shuffled inside the chunk for the stochastic gradient
+            chunk_df = chunk_df.iloc[rng.permutation(len(chunk_df))]
+            model.partial_fit(transform(chunk_df), chunk_df['TARGET'].to_numpy(), classes=np.array([0, 1]))
+            report_chunk(f'fitting model, epoch {epoch + 1}', len(chunk_df))
+
+    artifacts['model'] = Pipeline([*base_artifacts['model'].steps[:-1], ('model', model)]) \
+        if model_type == 'regular' else model
+    return artifacts
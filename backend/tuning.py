@@ -0,0 +1,168 @@
+"""
+This module contains the hyperparameter search of the tuned model over the client table
+Candidates of the logistic regression are compared by successive halving with stratified cross-validation:
+every round fits the remaining candidates on a growing share of the training folds and keeps the best of them,
+so most candidates are dropped after cheap fits. The fold x candidate fits of a round run in a pool of processes.
+The table is encoded with the fitted one-hot encoder once and the scaler is fitted once per fold,
+the scaled folds are cached in .npy files memory-mapped by the pool processes
+"""
+
+from .imports import os, mp, np, pd, clone, loguniform, StratifiedKFold, ParameterSampler, roc_auc_score, \
+    ProcessPoolExecutor, TemporaryDirectory, as_completed, Callable, fit_chunk_size, client_features
+from .metrics import ThresholdMetrics
+from .training import iter_client_chunks
+
+# search space of the logistic regression, the inverse regularization strength is sampled on the log scale
+param_distributions = {'C': loguniform(1e-3, 1e2), 'class_weight': [None, 'balanced']}
+
+# smallest number of the training rows of a fold fitted in the first round
+min_round_rows = 500
+
+# parts of a cached fold
+fold_parts = ('X_train', 'y_train', 'X_val', 'y_val')
+
+# directory of the cached folds of the current pool process, it is set by the pool initializer
+worker_folds_dir = None
+
+
+def init_tuning_worker(folds_dir: str) -> None:
+    """Keeps the directory of the cached folds in the pool process"""
+    global worker_folds_dir
+    worker_folds_dir = folds_dir
+
+
+def get_stratified_order(y: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Shuffles the rows so that every prefix of the order keeps the share of the positive clients"""
+    order = rng.permutation(len(y))
+    # position of every row among the shuffled rows of its class, as a share of the class size
+    key = np.empty(len(y))
+    for label in np.unique(y):
+        positions = order[y[order] == label]
+        key[positions] = np.arange(len(positions)) / len(positions)
+    return order[np.argsort(key[order], kind='stable')]
+
+
+def cache_folds(X_encoded: pd.DataFrame, y: np.ndarray, scaler, cv: int, folds_dir: str,
+                seed: int) -> list[np.ndarray]:
+    """
+    Fits a copy of the scaler on the training part of every stratified fold and saves the scaled parts.
+    The training rows are saved in the stratified random order, so their prefix is a stratified subsample
+
+    :return: positions of the validation rows of every fold
+    """
+    rng = np.random.default_rng(seed)
+    val_positions = []
+    for fold, (train, val) in enumerate(StratifiedKFold(cv, shuffle=True, random_state=seed).split(X_encoded, y)):
+        train = train[get_stratified_order(y[train], rng)]
+        fold_scaler = clone(scaler).fit(X_encoded.iloc[train])
+        parts = (fold_scaler.transform(X_encoded.iloc[train]), y[train], fold_scaler.transform(X_encoded.iloc[val]),
+                 y[val])
+        for part, values in zip(fold_parts, parts):
+            np.save(os.path.join(folds_dir, f'{fold}_{part}.npy'), np.asarray(values))
+        val_positions.append(val)
+    return val_positions
+
+
+def score_candidate(model, fold: int, rows: int) -> tuple[float, np.ndarray]:
+    """
+    Fits the candidate on the first rows of the training part of the cached fold in the pool process
+
+    :return: ROC AUC and probabilities of the validation part of the fold
+    """
+    X_train, y_train, X_val, y_val = (np.load(os.path.join(worker_folds_dir, f'{fold}_{part}.npy'), mmap_mode='r')
+                                      for part in fold_parts)
+    model.fit(X_train[:rows], y_train[:rows])
+    preds = model.predict_proba(X_val)[:, 1]
+    return float(roc_auc_score(y_val, preds)), preds
+
+
+def get_halving_schedule(n_candidates: int, factor: int, max_rows: int) -> list[tuple[int, int]]:
+    """
+    Returns the number of the candidates and of the training rows of every round.
+    Every round keeps 1/factor of the candidates and fits factor times more rows, the last round fits all rows
+    """
+    counts = [n_candidates]
+    while counts[-1] > factor:
+        counts.append(-(-counts[-1] // factor))
+    return [(count, max(min(min_round_rows, max_rows), max_rows // factor ** (len(counts) - 1 - i)))
+            for i, count in enumerate(counts)]
+
+
+def tune_model_artifacts(base_artifacts: dict, n_candidates: int, cv: int, factor: int, workers: int,
+                         seed: int = 0, report: Callable[..., None] | None = None) -> dict:
+    """
+    Searches the parameters of the logistic regression of the tuned model and refits the best candidate
+    on the whole client table. The parameters of the base version compete with the sampled candidates.
+    The threshold of the new version maximizes f1 on the out-of-fold probabilities of the best candidate
+
+    :param base_artifacts: artifacts of the version the new one is based on
+    :param n_candidates: number of the compared parameter sets
+    :param cv: number of the stratified folds
+    :param factor: ratio of the candidates and of the training rows between the rounds
+    :param workers: number of the processes fitting the folds and candidates in parallel
+    :param seed: seed of the sampled candidates and of the folds
+    :param report: callback receiving the progress share, the name of the stage and the search statistics
+    :return: artifacts of the new version
+    """
+    report = report or (lambda progress, stage, **stats: None)
+    report(0.0, 'reading clients')
+    clients_df = pd.concat(iter_client_chunks(fit_chunk_size), ignore_index=True)
+    X_encoded = pd.DataFrame(base_artifacts['ohe_enc'].transform(clients_df[client_features]))
+    y = clients_df['TARGET'].to_numpy()
+
+    base_model = base_artifacts['model']
+    base_params = base_model.get_params()
+    candidates = [{name: base_params[name] for name in param_distributions}]
+    candidates += list(ParameterSampler(param_distributions, n_candidates - 1, random_state=seed))
+
+    with TemporaryDirectory(prefix='tuning_') as folds_dir:
+        report(0.05, 'caching folds')
+        val_positions = cache_folds(X_encoded, y, base_artifacts['scaler'], cv, folds_dir, seed)
+        schedule = get_halving_schedule(len(candidates), factor, min(len(y) - len(val) for val in val_positions))
+        fits_total, fits_done = cv * sum(count for count, _ in schedule), 0
+        remaining, rounds = list(range(len(candidates))), []
+
+        with ProcessPoolExecutor(max_workers=max(min(workers, cv * len(candidates)), 1),
+                                 mp_context=mp.get_context('spawn'), initializer=init_tuning_worker,
+                                 initargs=(folds_dir,)) as executor:
+            for round_number, (_, rows) in enumerate(schedule):
+                futures = {executor.submit(score_candidate, clone(base_model).set_params(**candidates[candidate]),
+                                           fold, rows): (candidate, fold)
+                           for candidate in remaining for fold in range(cv)}
+                results = {candidate: [None] * cv for candidate in remaining}
+                for future in as_completed(futures):
+                    candidate, fold = futures[future]
+                    results[candidate][fold] = future.result()
+                    fits_done += 1
+                    report(0.05 + 0.85 * fits_done / fits_total, f'round {round_number + 1} of {len(schedule)}',
+                           fits_done=fits_done, fits_total=fits_total)
+
+                scores = {candidate: float(np.mean([score for score, _ in results[candidate]]))
+                          for candidate in remaining}
+                # the sort is stable, so the earlier candidate wins a tie and the base parameters come first
+                ranked = sorted(remaining, key=lambda candidate: -scores[candidate])
+                rounds.append({'candidates': len(remaining), 'rows': rows, 'best_roc_auc': round(scores[ranked[0]], 4)})
+                remaining = ranked[:schedule[round_number + 1][0] if round_number + 1 < len(schedule) else 1]
+
+    # the last round fits all training rows, so its validation probabilities are the out-of-fold ones
+    best = remaining[0]
+    oof_preds = np.empty(len(y))
+    for val, (_, preds) in zip(val_positions, results[best]):
+        oof_preds[val] = preds
+    sweep = ThresholdMetrics(y, oof_preds).curve()
+    best_thr = sweep['thresholds'][int(np.argmax(sweep['f1']))]
+
+    report(0.9, 'fitting best candidate')
+    best_params = candidates[best]
+    scaler = clone(base_artifacts['scaler']).fit(X_encoded)
+    X_scaled = pd.DataFrame(scaler.transform(X_encoded), columns=X_encoded.columns, index=X_encoded.index)
+    model = clone(base_model).set_params(**best_params).fit(X_scaled, y)
+
+    best_score = scores[best]
+    params = ', '.join(f'{name}={value:.4g}' if isinstance(value, float) else f'{name}={value}'
+                       for name, value in {**best_params, 'max_iter': model.max_iter}.items())
+    params += f', successive halving of {len(candidates)} candidates, {cv}-fold ROC AUC {best_score:.4f}'
+    report(1.0, 'fitted', best_params=best_params, cv_roc_auc=round(best_score, 4), rounds=rounds,
+           best_thr=best_thr)
+    return {**base_artifacts, 'model': model, 'scaler': scaler, 'best_thr': best_thr, 'params': params,
+            'created': None}
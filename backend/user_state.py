@@ -0,0 +1,106 @@
+"""
+This module contains session-scoped state of the application users: selected model, threshold and single client.
+The state is keyed by the client token sent in the X-Client-Token header, so concurrent users do not overwrite
+each other's rows. Requests without the token keep working with the shared selected_model and single_client tables
+"""
+
+from fastapi import Header
+
+from .imports import time, threading, json, OrderedDict, Session, select, delete, pg_insert, sqlite_insert
+from .imports import user_state_store, user_state_ttl, user_state_max_entries
+from .models import TableSelectedModel, TableUserState
+
+
+class MemoryStateStore:
+    """In-process store of the user states expiring after the time to live since their last update"""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # token -> (updated at, state), the least recently updated states come first
+        self.states: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def get(self, db: Session, token: str) -> dict | None:
+        """Returns a copy of the state of the token or None if it is missing or expired"""
+        with self.lock:
+            entry = self.states.get(token)
+        if entry is None or entry[0] < time.time() - self.ttl:
+            return None
+        return dict(entry[1])
+
+    def save(self, db: Session, token: str, state: dict) -> None:
+        """Stores the state of the token and drops the expired and the oldest states above the limit"""
+        now = time.time()
+        with self.lock:
+            self.states[token] = (now, dict(state))
+            self.states.move_to_end(token)
+            while self.states:
+                updated_at, _ = next(iter(self.states.values()))
+                if updated_at >= now - self.ttl and len(self.states) <= self.max_entries:
+                    break
+                self.states.popitem(last=False)
+
+
+class DbStateStore:
+    """Store of the user states in the user_state table, one row per token, so users never write the same row"""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    def get(self, db: Session, token: str) -> dict | None:
+        """Returns the state of the token or None if it is missing or expired"""
+        row = db.get(TableUserState, token)
+        if row is None or row.updated_at < time.time() - self.ttl:
+            return None
+        single_client = json.loads(row.single_client) if row.single_client else None
+        return {'type_model': row.type_model, 'threshold': row.threshold, 'single_client': single_client}
+
+    def save(self, db: Session, token: str, state: dict) -> None:
+        """
+        Upserts the state row of the token with the insert on conflict update of the dialect, so concurrent first
+        requests of a token do not fail on the primary key. Expired rows are deleted when a new token appears
+        """
+        now = time.time()
+        table = TableUserState.__table__
+        values = {
+            'model_type': state['type_model'],
+            'threshold': state['threshold'],
+            'single_client': json.dumps(state['single_client']) if state['single_client'] else None,
+            'updated_at': now,
+        }
+        if db.execute(select(table.c.token).where(table.c.token == token)).first() is None:
+            db.execute(delete(table).where(table.c.updated_at < now - self.ttl))
+        dialect_name = db.get_bind().dialect.name
+        if dialect_name in ('postgresql', 'sqlite'):
+            insert = (pg_insert if dialect_name == 'postgresql' else sqlite_insert)(table).values(token=token, **values)
+            db.execute(insert.on_conflict_do_update(index_elements=['token'], set_=values))
+        elif not db.execute(table.update().where(table.c.token == token).values(**values)).rowcount:
+            db.execute(table.insert().values(token=token, **values))
+        db.commit()
+
+
+state_store = DbStateStore(user_state_ttl) if user_state_store == 'db' else \
+    MemoryStateStore(user_state_ttl, user_state_max_entries)
+
+
+def get_client_token(x_client_token: str | None = Header(None, max_length=128)) -> str | None:
+    """Reads the optional client token from the X-Client-Token header"""
+    return x_client_token
+
+
+def get_user_state(db: Session, token: str) -> dict:
+    """Returns the state of the token, a new user starts with the shared selection and without a single client"""
+    state = state_store.get(db, token)
+    if state is None:
+        selected = db.query(TableSelectedModel).first()
+        state = {'type_model': selected.type_model, 'threshold': selected.threshold, 'single_client': None}
+    return state
+
+
+def update_user_state(db: Session, token: str, **changes) -> dict:
+    """Changes the passed fields of the state of the token and saves it"""
+    state = get_user_state(db, token)
+    state.update(changes)
+    state_store.save(db, token, state)
+    return state
@@ -12,21 +12,21 @@ from random import choice
 import pickle
 import json
 import requests
+import uuid
 from io import StringIO
 from typing import Any
 
 # imports ML modules
 import pandas as pd
-from sklearn.metrics import confusion_matrix
+import pyarrow as pa
 
-from scripts import get_clients_df, get_targets_df, get_all_models_params_dict
+from scripts import get_clients_df, get_all_models_params_dict
 
 path = os.path.dirname(__file__)
 # pict_name = os.path.join(path, "bgr.png")
 
 # get main models and dataframes to get preds from API and build apps
 df = get_clients_df()
-y_test, prediction_regular, prediction_tuned = get_targets_df()
 models_params = get_all_models_params_dict()
 
 # necessary dictionaries for building the application
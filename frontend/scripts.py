@@ -2,11 +2,18 @@
 Module contains functions to work with API endpoints
 """
 
-from imports import st, pd, json, requests, StringIO, Any
+from imports import st, pd, pa, json, requests, uuid, StringIO, Any
 
 api_url = "https://bank-clients.onrender.com/"
 
 
+def get_client_headers() -> dict:
+    """Gets the headers with the token of the browser session, the backend keeps the user's selections by it"""
+    if 'client_token' not in st.session_state:
+        st.session_state['client_token'] = uuid.uuid4().hex
+    return {'X-Client-Token': st.session_state['client_token']}
+
+
 @st.cache_data
 def get_df_from_handlers_response(handler: str) -> pd.DataFrame:
     """Converts json received from API to dataframe"""
@@ -17,23 +24,47 @@ def get_df_from_handlers_response(handler: str) -> pd.DataFrame:
     return df
 
 
+@st.cache_data
+def get_df_from_export(handler: str) -> pd.DataFrame:
+    """Converts Arrow stream received from API bulk export to dataframe"""
+    handler_url = f"{api_url}export/{handler}?format=arrow"
+    response = requests.get(handler_url)
+    df = pa.ipc.open_stream(response.content).read_pandas()
+    return df
+
+
 @st.cache_data
 def get_clients_df() -> pd.DataFrame:
-    """Converts clients json received from API to dataframe"""
-    df = get_df_from_handlers_response(handler="clients")
+    """Converts clients export received from API to dataframe"""
+    df = get_df_from_export(handler="clients")
     return df
 
 
 @st.cache_data
 def get_targets_df() -> tuple[Any, pd.DataFrame, pd.DataFrame]:
-    """Converts different targets json received from API to different dataframes"""
-    all_df = get_df_from_handlers_response(handler="targets")
+    """Converts different targets export received from API to different dataframes"""
+    all_df = get_df_from_export(handler="targets")
     y_test = all_df['TARGET']
     prediction_regular = pd.DataFrame({'predictions': all_df['prediction_regular'].tolist()}, index=all_df.ID)
     prediction_tuned = pd.DataFrame({'predictions': all_df['prediction_tuned'].tolist()}, index=all_df.ID)
     return y_test, prediction_regular, prediction_tuned
 
 
+@st.cache_data
+def get_eda_aggregate(handler: str) -> dict:
+    """Gets the EDA aggregate computed by API instead of computing it over all clients"""
+    handler_url = f"{api_url}eda/{handler}"
+    response = requests.get(handler_url).json()
+    return response
+
+
+def get_value_counts_df(column: str) -> pd.DataFrame:
+    """Gets the counts of clients for every value of the column as a dataframe indexed by values"""
+    value_counts = get_eda_aggregate(f"value_counts/{column}")
+    df = pd.DataFrame({'count': value_counts['counts']}, index=pd.Index(value_counts['values'], name=column))
+    return df
+
+
 def get_single_model_params_dict(model_name: str) -> dict:
     """Gets the parameters of the selected model"""
     handler_url = f"{api_url}{model_name}/params"
@@ -44,25 +75,15 @@ def get_single_model_params_dict(model_name: str) -> dict:
 def get_user_params_dict() -> dict:
     """Gets the dict of user parameters"""
     handler_url = f"{api_url}get/user_params"
-    model_params_dict = requests.get(handler_url).json()
+    model_params_dict = requests.get(handler_url, headers=get_client_headers()).json()
     return model_params_dict
 
 
-def get_thresh_preds() -> tuple[bool, bool]:
-    """Gives the results of applying models on optimal and user thresholds"""
-    user_params_dict = get_user_params_dict()
-    model_type = user_params_dict['model_type']
-    threshold = user_params_dict['threshold']
-    best_thr = user_params_dict['best_thr']
-
-    _, prediction_regular, prediction_tuned = get_targets_df()
-
-    pred_probability = prediction_regular if model_type == 'regular' else prediction_tuned
-    y_thr = pred_probability > threshold
-    y_best_thr = pred_probability > best_thr
-    y_thr_tuple = (y_thr, y_best_thr)
-
-    return y_thr_tuple
+def get_confusion_matrices() -> dict:
+    """Gets confusion matrices for user and optimal thresholds of the selected model"""
+    handler_url = f"{api_url}get/confusion_matrix"
+    response = requests.get(handler_url, headers=get_client_headers()).json()
+    return response
 
 
 def get_all_models_params_dict() -> dict:
@@ -76,14 +97,14 @@ def get_all_models_params_dict() -> dict:
 def get_metrics_score():
     """Get metrics score for chosen model and threshold"""
     handler_url = f"{api_url}get/metrics_score"
-    response = requests.get(handler_url).json()
+    response = requests.get(handler_url, headers=get_client_headers()).json()
     return response
 
 
 def get_prediction() -> tuple[float, bool, bool]:
     """Gets the model prediction for selected params"""
     handler_url = f"{api_url}get/predictions"
-    response = requests.get(handler_url).json()
+    response = requests.get(handler_url, headers=get_client_headers()).json()
     single_pred = response['single_pred']
     is_recommend_thr = bool(response['is_recommend_thr'])
     is_recommend_best_thr = bool(response['is_recommend_best_thr'])
@@ -93,28 +114,28 @@ def get_prediction() -> tuple[float, bool, bool]:
 def update_model_name(new_value) -> dict:
     """Updates the selected model - makes a record to db"""
     handler_url = f"{api_url}update/selected/model_name?model_name={new_value}"
-    response = requests.patch(handler_url).json()
+    response = requests.patch(handler_url, headers=get_client_headers()).json()
     return response
 
 
 def update_threshold(new_value) -> dict:
     """Updates the selected threshold - makes a record to db"""
     handler_url = f"{api_url}update/selected/threshold?threshold={new_value}"
-    response = requests.patch(handler_url).json()
+    response = requests.patch(handler_url, headers=get_client_headers()).json()
     return response
 
 
 def write_single_dict_to_db(single_dict) -> None:
     """Write the selected dict dataframe to temporary db"""
     handler_url = f"{api_url}write/single_df"
-    requests.post(handler_url, json=single_dict)
+    requests.post(handler_url, json=single_dict, headers=get_client_headers())
     return None
 
 
 def erase_singl_df() -> None:
     """Erase records from temporary db after work with it"""
     handler_url = f"{api_url}delete/single_df"
-    requests.delete(handler_url)
+    requests.delete(handler_url, headers=get_client_headers())
     return None
 
 
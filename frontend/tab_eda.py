@@ -2,8 +2,9 @@
 Module responsible for content and display of the EDA tab in streamlit application
 """
 
-from imports import (st, pd, df, px, charts_dict, charts_texts, pie_dict, pie_texts, numeric_columns, target_distr_dict,
+from imports import (st, pd, px, charts_dict, charts_texts, pie_dict, pie_texts, target_distr_dict,
                      target_distr_texts)
+from scripts import get_eda_aggregate, get_value_counts_df
 
 
 def draw_barchart() -> None:
@@ -18,7 +19,8 @@ def draw_barchart() -> None:
     )
 
     st.subheader(f'🎢 Распределение заёмщиков в разрезе категории "{columns}"')
-    st.bar_chart(df, x=charts_dict[columns], y='ID')
+    category = charts_dict[columns]
+    st.bar_chart(get_value_counts_df(category).reset_index(), x=category, y='count')
     st.caption(charts_texts[columns])
 
 
@@ -35,7 +37,7 @@ def draw_pie() -> None:
     st.subheader(f'🍰 Распределение заёмщиков в разрезе категории "{columns}"')
 
     category = pie_dict[columns]
-    data_frame = pd.DataFrame(df[category].value_counts(), columns=['count'])
+    data_frame = get_value_counts_df(category)
     fig = px.pie(data_frame=data_frame, values='count', names=data_frame.index)
     st.plotly_chart(fig, theme="streamlit", use_container_width=True)
     st.caption(pie_texts[columns])
@@ -47,12 +49,7 @@ def draw_num_distribution() -> None:
     """
     st.divider()
     st.subheader('🔢 Характеристики распределения числовых столбцов')
-    st.dataframe(
-        df.drop(
-            columns=numeric_columns
-        )
-        .describe()
-    )
+    st.dataframe(pd.DataFrame(get_eda_aggregate('describe/numeric')))
 
 
 def draw_categorical_distribution() -> None:
@@ -60,7 +57,7 @@ def draw_categorical_distribution() -> None:
     Controls the display of a block drawing the distribution of categorical columns
     """
     st.subheader('📌 Характеристики распределения категориальных столбцов')
-    st.dataframe(df.describe(include='object'))
+    st.dataframe(pd.DataFrame(get_eda_aggregate('describe/categorical')))
     st.caption(
         'Любопытно было взглянуть на портрет среднего заёмщика: 36 летний продавец из Кемеровской области с '
         'семейным доходом до 20 тысяч рублей, имеющий одного ребенка и берущий микрозайм в 15 тысяч рублей на '
@@ -74,7 +71,7 @@ def draw_nun_distribution() -> None:
     """
     st.divider()
     st.subheader('🫗 Пропуски в данных')
-    st.dataframe(df.isna().sum())
+    st.dataframe(pd.Series(get_eda_aggregate('missing')))
     st.caption(
         'В данных нет пропусков, это обусловлено самой сборкой датасета, что описано в ноутбуке. Ну вот, '
         'зачем-то ещё раз убедились в этом.'
@@ -88,7 +85,7 @@ def draw_pearson_correlation() -> None:
 
     st.divider()
     st.subheader('🔗 Корреляция Пирсона')
-    st.dataframe(df.select_dtypes('float64').corr().style.background_gradient(cmap='coolwarm'))
+    st.dataframe(pd.DataFrame(get_eda_aggregate('corr')).style.background_gradient(cmap='coolwarm'))
     st.caption(
         'Есть сильная корреляция между доходом заёмщика, его первым платежом и размером кредита, '
         'и это совершенно понятно. Но вот корреляция между числовыми признаками и целевой переменной отсутствует '
@@ -111,5 +108,6 @@ def draw_target_correlation() -> None:
         f'🎯 Распределение целевой переменной в зависимости от возраста заёмщика и значений категории "{columns}"')
 
     category = target_distr_dict[columns]
-    st.scatter_chart(df[[category, 'AGE', "TARGET"]], x=category, y='AGE', color='TARGET', use_container_width=True)
+    scatter_df = pd.DataFrame(get_eda_aggregate(f'scatter?x={category}&y=AGE&color=TARGET'))
+    st.scatter_chart(scatter_df, x=category, y='AGE', color='TARGET', use_container_width=True)
     st.caption(target_distr_texts[columns])
@@ -2,10 +2,10 @@
 Module responsible for content and display of the "Прогнозы" tab in streamlit application
 """
 
-from imports import st, pd, choice, confusion_matrix
-from imports import y_test, models_params, df
-from scripts import get_metrics_score, update_threshold, update_model_name, get_user_params_dict, get_thresh_preds, \
-    write_single_dict_to_db, get_prediction, erase_singl_df
+from imports import st, pd, choice
+from imports import models_params, df
+from scripts import get_metrics_score, update_threshold, update_model_name, get_user_params_dict, \
+    get_confusion_matrices, write_single_dict_to_db, get_prediction, erase_singl_df
 
 
 def draw_model_select() -> None:
@@ -74,23 +74,23 @@ def draw_confusion_matrix() -> None:
     """
     Responsible for building the confusion matrix based on user and reference thresholds
     """
-    y_thr_tuple = get_thresh_preds()
+    matrices = get_confusion_matrices()
 
     st.divider()
     st.subheader('🫰 Влияние порога на затраты Банка')
     st.info('Продемонстрируем влияние выбранного порога на практические аспекты реальной жизни')
 
     col1, col2 = st.columns(2)
-    pairs = zip([0, 1], ['тобой', 'нами'], [col1, col2])
+    pairs = zip(['user', 'best'], ['тобой', 'нами'], [col1, col2])
 
-    for thr_num, me, col in pairs:
-        matrix = pd.DataFrame(confusion_matrix(y_test, y_thr_tuple[thr_num]))
+    for thr_name, me, col in pairs:
+        matrix = pd.DataFrame(matrices[thr_name])
         st.write(f'Это результат подобранного {me} порога:')
         st.dataframe(matrix.style.background_gradient(cmap='YlGnBu', axis=None))
         st.write(f'Здесь удастся правильно дозвониться {matrix[1][1]} клиентам, но мы не сделаем необходимые '
                  f'звонки {matrix[0][1]} потенциальным клиентам')
-    matrix_user = confusion_matrix(y_test, y_thr_tuple[0])[1][1] + confusion_matrix(y_test, y_thr_tuple[0])[0][1]
-    matrix_tuned = confusion_matrix(y_test, y_thr_tuple[1])[1][1] + confusion_matrix(y_test, y_thr_tuple[1])[0][1]
+    matrix_user = matrices['user'][1][1] + matrices['user'][0][1]
+    matrix_tuned = matrices['best'][1][1] + matrices['best'][0][1]
     delta = round(matrix_tuned / matrix_user, 1)
     st.write(f'Правильная для поставленной задачи тонкая настройка порога имеет свою материальную цену: нам придётся '
              f'заставить колл-центр Банка обзванивать в {delta} раз больше клиентов. Поэтому придётся считать, '